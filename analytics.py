@@ -0,0 +1,427 @@
+"""
+Store and category reporting from incrementally maintained rollups.
+
+Usage:
+    python analytics.py update            # also runs every minute inside the app
+    python analytics.py rebuild           # recompute from scratch (first deploy, or to check)
+    python analytics.py export --table items --start 2025-11-01 --end 2025-12-01 --output nov.parquet
+    python analytics.py export --table store_hourly --format arrow --output stores.arrow
+
+The rollups (models.StoreHourRollup, models.CategoryHourRollup) are fed from
+the earn ledger entries: every applied transaction has exactly one, written
+in the same DB transaction. Like balance snapshots (ledger.py), the next
+micro-batch is "the earn entries written after the last batch's visibility
+horizon, by writers that have all finished" (RollupState).
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import BigInteger, cast, func, text
+from sqlmodel import Session, select
+
+import ledger
+from catalog import from_cents
+from database import get_engine
+from models import Category, CategoryHourRollup, Item, Sku, StoreHourRollup, Transaction
+from services import PROMO_CATEGORY
+
+logger = logging.getLogger(__name__)
+
+ROLLUP = "store_category_hourly"
+
+# Ledger entries per micro-batch: keeps each batch's transaction (and locks) short
+BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "5000"))
+
+# Longest range one /analytics request may ask for
+MAX_RANGE = timedelta(days=int(os.getenv("ANALYTICS_MAX_RANGE_DAYS", "366")))
+
+# Rows per Arrow record batch (and Parquet row group) in exports
+EXPORT_CHUNK_SIZE = 100_000
+
+# -----------------------------------------------------------------------------
+# A. Fold transactions into the rollups
+# -----------------------------------------------------------------------------
+# The transactions a statement folds in ("tx"). A micro-batch reads them
+# through its xid range; a rebuild reads the whole table, minus the
+# transactions whose earn entry is at or past the new horizon (the next
+# micro-batch picks those up). An entry's source_timestamp pins its receipt to
+# one monthly partition; entries without one (written before the column, or by
+# a previous release mid-deploy) take the second branch, which probes them all.
+SOURCE_SQL = """
+    SELECT t.store_id, t.transaction_id, t."timestamp", t.basket_total, t.stickers_awarded
+    FROM ledgerentry l
+    JOIN "transaction" t ON t.transaction_id = l.source_id AND t."timestamp" = l.source_timestamp
+    WHERE l.kind = :earn AND l.id > :floor AND {entries}
+    UNION ALL
+    SELECT t.store_id, t.transaction_id, t."timestamp", t.basket_total, t.stickers_awarded
+    FROM ledgerentry l
+    JOIN "transaction" t ON t.transaction_id = l.source_id
+    WHERE l.kind = :earn AND l.id > :floor AND {entries} AND l.source_timestamp IS NULL
+"""
+BATCH_SOURCE = SOURCE_SQL.format(entries="l.xid >= :low AND l.xid < :high")
+# The first run also takes entries written before the xid column (NULL)
+FIRST_SOURCE = SOURCE_SQL.format(entries="(l.xid < :high OR l.xid IS NULL)")
+
+REBUILD_SOURCE = """
+    SELECT t.store_id, t.transaction_id, t."timestamp", t.basket_total, t.stickers_awarded
+    FROM "transaction" t
+    WHERE NOT EXISTS (
+        SELECT 1 FROM ledgerentry l
+        WHERE l.kind = :earn AND l.source_id = t.transaction_id AND l.xid >= :high
+    )
+"""
+
+STORE_SQL = """
+    WITH tx AS ({source})
+    INSERT INTO storehourrollup (store_id, hour, transactions, basket_total_cents, stickers_awarded, promo_units)
+    SELECT tx.store_id, date_trunc('hour', tx."timestamp"), count(*),
+           sum(round(tx.basket_total * 100))::bigint, sum(tx.stickers_awarded), COALESCE(sum(p.units), 0)
+    FROM tx
+    LEFT JOIN LATERAL (
+        SELECT sum(i.quantity) AS units FROM item i
+        WHERE i.transaction_id = tx.transaction_id AND i."timestamp" = tx."timestamp"
+          AND i.category_id = (SELECT id FROM category WHERE name = :promo)
+    ) p ON true
+    GROUP BY 1, 2
+    ON CONFLICT (store_id, hour) DO UPDATE SET
+        transactions = storehourrollup.transactions + excluded.transactions,
+        basket_total_cents = storehourrollup.basket_total_cents + excluded.basket_total_cents,
+        stickers_awarded = storehourrollup.stickers_awarded + excluded.stickers_awarded,
+        promo_units = storehourrollup.promo_units + excluded.promo_units
+"""
+
+CATEGORY_SQL = """
+    WITH tx AS ({source})
+    INSERT INTO categoryhourrollup (store_id, category_id, hour, units, sales_cents, lines)
+    SELECT tx.store_id, i.category_id, date_trunc('hour', tx."timestamp"),
+           sum(i.quantity), sum(i.quantity * i.unit_price_cents), count(*)
+    FROM tx
+    JOIN item i ON i.transaction_id = tx.transaction_id AND i."timestamp" = tx."timestamp"
+    GROUP BY 1, 2, 3
+    ON CONFLICT (store_id, category_id, hour) DO UPDATE SET
+        units = categoryhourrollup.units + excluded.units,
+        sales_cents = categoryhourrollup.sales_cents + excluded.sales_cents,
+        lines = categoryhourrollup.lines + excluded.lines
+"""
+
+SAVE_STATE_SQL = text("""
+    UPDATE rollupstate SET xid_horizon = :high, ledger_id_floor = :floor, updated_at = timezone('utc', now())
+    WHERE name = :name
+""")
+
+CURRENT_HORIZON_SQL = text(f"SELECT {ledger.HORIZON_SQL}")
+
+# Up to :batch entries past the mark, below the horizon. The batch ends
+# after the last writer it reaches, so one writer's entries are never split
+# between batches; it is counted in entries, not xids, so gaps can't stall it.
+HIGH_WATER_SQL = text("""
+    SELECT COALESCE(MAX(xid) + 1, :horizon), count(*) FROM (
+        SELECT xid FROM ledgerentry
+        WHERE xid >= :low AND xid < :horizon
+        ORDER BY xid
+        LIMIT :batch
+    ) batch
+""")
+
+FIRST_COUNT_SQL = text("""
+    SELECT count(*) FROM ledgerentry WHERE id > :floor AND (xid < :high OR xid IS NULL)
+""")
+
+
+def _lock_state(session: Session) -> Tuple[int, Optional[int]]:
+    # Two statements: the row may not exist yet, and FOR UPDATE needs a row
+    session.exec(text(
+        "INSERT INTO rollupstate (name, ledger_id_floor, updated_at) VALUES (:name, 0, timezone('utc', now())) "
+        "ON CONFLICT (name) DO NOTHING"
+    ), params={"name": ROLLUP})
+    return tuple(session.exec(
+        text("SELECT ledger_id_floor, xid_horizon FROM rollupstate WHERE name = :name FOR UPDATE"),
+        params={"name": ROLLUP},
+    ).one())
+
+
+def _fold(session: Session, source: str, floor: int, low: Optional[int], high: int) -> None:
+    params = {"earn": ledger.EARN, "promo": PROMO_CATEGORY, "floor": floor, "low": low, "high": high}
+    session.exec(text(STORE_SQL.format(source=source)), params=params)
+    session.exec(text(CATEGORY_SQL.format(source=source)), params=params)
+    session.exec(SAVE_STATE_SQL, params={"name": ROLLUP, "floor": floor, "high": high})
+
+
+def update_rollups(session: Session, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Folds the next micro-batch of transactions into the rollups, in one DB
+    transaction with the new mark. Returns how many ledger entries it
+    consumed (0 when caught up).
+
+    Key Decisions:
+    - Entries are consumed by writing transaction (xid), only below the
+      oldest one still in flight (ledger.HORIZON_SQL), like snapshots. A
+      slow writer's entries wait for a later batch instead of being skipped,
+      however long the writer stays open; there is no time lag to tune.
+    - Reads only the new transactions (through ix_ledgerentry_xid) and their
+      items, so the cost follows the write volume, not the table size.
+    - The mark moves in the same commit as the sums, so a crash never counts
+      a transaction twice or skips one.
+    - Redemptions and opening entries are in the same xid range; the join to
+      Transaction just skips them.
+    """
+    floor, low = _lock_state(session)
+    horizon = session.exec(CURRENT_HORIZON_SQL).scalar_one()
+    if low is None:
+        # First run: every settled entry past the old id mark, in one go
+        consumed = session.exec(FIRST_COUNT_SQL, params={"floor": floor, "high": horizon}).scalar_one()
+        _fold(session, FIRST_SOURCE, floor, None, horizon)
+        session.commit()
+        return consumed
+    high, consumed = session.exec(
+        HIGH_WATER_SQL, params={"low": low, "horizon": horizon, "batch": batch_size}
+    ).one()
+    if high == low:
+        session.rollback()
+        return 0
+    _fold(session, BATCH_SOURCE, floor, low, high)
+    session.commit()
+    return consumed
+
+
+def catch_up(session: Session, batch_size: int = BATCH_SIZE) -> int:
+    """Runs micro-batches until caught up. Returns the ledger entries consumed."""
+    consumed = 0
+    while True:
+        moved = update_rollups(session, batch_size)
+        if not moved:
+            return consumed
+        consumed += moved
+
+
+def rebuild_rollups(session: Session) -> int:
+    """
+    Recomputes the rollups from every transaction still in the database, in
+    one DB transaction, and moves the mark to the current horizon. Picks up
+    transactions from before the ledger existed (they have no earn entry).
+    Readers keep seeing the old rollups until it commits. Months that were
+    already archived (partitions.py) drop out of the rollups, so the
+    incremental path is the normal one. Returns the new horizon.
+    """
+    _lock_state(session)
+    horizon = session.exec(CURRENT_HORIZON_SQL).scalar_one()
+    session.exec(text("DELETE FROM storehourrollup"))
+    session.exec(text("DELETE FROM categoryhourrollup"))
+    # Every entry below the horizon is in now, so the id floor goes
+    _fold(session, REBUILD_SOURCE, 0, None, horizon)
+    session.commit()
+    return horizon
+
+
+async def rollup_forever(interval_seconds: float) -> None:
+    """Background task: keeps the rollups within a minute or two of the ledger."""
+    def run_once():
+        with Session(get_engine()) as session:
+            return catch_up(session)
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            consumed = await asyncio.to_thread(run_once)
+            logger.debug("Analytics rollups advanced %d ledger entries", consumed)
+        except Exception:
+            logger.exception("Analytics rollup failed")
+
+
+# -----------------------------------------------------------------------------
+# B. Queries (served by GET /analytics/...)
+# -----------------------------------------------------------------------------
+def check_range(start: datetime, end: datetime) -> Optional[str]:
+    """The problem with a requested [start, end) range, or None if it's fine."""
+    if end <= start:
+        return "end must be after start"
+    if end - start > MAX_RANGE:
+        return f"range is longer than {MAX_RANGE.days} days"
+    return None
+
+
+def store_hours_stmt(store_id: str, start: datetime, end: datetime):
+    return (
+        select(StoreHourRollup)
+        .where(StoreHourRollup.store_id == store_id)
+        .where(StoreHourRollup.hour >= start, StoreHourRollup.hour < end)
+        .order_by(StoreHourRollup.hour)
+    )
+
+
+def store_hour_dict(row: StoreHourRollup) -> dict:
+    return {
+        "hour": row.hour,
+        "transactions": row.transactions,
+        "basket_total": from_cents(row.basket_total_cents),
+        "stickers_awarded": row.stickers_awarded,
+        "promo_units": row.promo_units,
+    }
+
+
+def category_totals_stmt(start: datetime, end: datetime, store_id: Optional[str] = None):
+    query = (
+        select(
+            Category.name.label("category"),
+            # sum(bigint) is NUMERIC in Postgres; these stay well inside BIGINT
+            cast(func.sum(CategoryHourRollup.units), BigInteger).label("units"),
+            cast(func.sum(CategoryHourRollup.sales_cents), BigInteger).label("sales_cents"),
+            cast(func.sum(CategoryHourRollup.lines), BigInteger).label("lines"),
+        )
+        .join(Category, Category.id == CategoryHourRollup.category_id)
+        .where(CategoryHourRollup.hour >= start, CategoryHourRollup.hour < end)
+        .group_by(Category.name)
+        .order_by(func.sum(CategoryHourRollup.sales_cents).desc(), Category.name)
+    )
+    if store_id is not None:
+        query = query.where(CategoryHourRollup.store_id == store_id)
+    return query
+
+
+def category_total_dict(row) -> dict:
+    return {
+        "category": row.category,
+        "units": row.units,
+        "sales": from_cents(row.sales_cents),
+        "lines": row.lines,
+    }
+
+
+def state_stmt():
+    return text("SELECT xid_horizon, updated_at FROM rollupstate WHERE name = :name").bindparams(name=ROLLUP)
+
+
+# -----------------------------------------------------------------------------
+# C. Export to Parquet / Arrow IPC (streamed; requires pyarrow)
+# -----------------------------------------------------------------------------
+def _export_queries():
+    return {
+        "store_hourly": (
+            select(StoreHourRollup.store_id, StoreHourRollup.hour, StoreHourRollup.transactions,
+                   StoreHourRollup.basket_total_cents, StoreHourRollup.stickers_awarded,
+                   StoreHourRollup.promo_units),
+            StoreHourRollup.hour,
+        ),
+        "category_hourly": (
+            select(CategoryHourRollup.store_id, Category.name.label("category"), CategoryHourRollup.hour,
+                   CategoryHourRollup.units, CategoryHourRollup.sales_cents, CategoryHourRollup.lines)
+            .join(Category, Category.id == CategoryHourRollup.category_id),
+            CategoryHourRollup.hour,
+        ),
+        # Receipt detail; the timestamp range prunes to the months asked for
+        "items": (
+            select(Item.timestamp, Item.transaction_id, Transaction.store_id, Transaction.shopper_id,
+                   Sku.code.label("sku"), Sku.name, Category.name.label("category"),
+                   Item.quantity, Item.unit_price_cents)
+            .join(Transaction, (Transaction.transaction_id == Item.transaction_id)
+                  & (Transaction.timestamp == Item.timestamp))
+            .join(Sku, Sku.id == Item.sku_id)
+            .join(Category, Category.id == Item.category_id),
+            Item.timestamp,
+        ),
+    }
+
+
+EXPORT_TABLES = ("store_hourly", "category_hourly", "items")
+
+
+def _arrow_schema(pa, table: str):
+    if table == "store_hourly":
+        return pa.schema([
+            ("store_id", pa.string()), ("hour", pa.timestamp("us")), ("transactions", pa.int64()),
+            ("basket_total_cents", pa.int64()), ("stickers_awarded", pa.int64()), ("promo_units", pa.int64()),
+        ])
+    if table == "category_hourly":
+        return pa.schema([
+            ("store_id", pa.string()), ("category", pa.string()), ("hour", pa.timestamp("us")),
+            ("units", pa.int64()), ("sales_cents", pa.int64()), ("lines", pa.int64()),
+        ])
+    return pa.schema([
+        ("timestamp", pa.timestamp("us")), ("transaction_id", pa.string()), ("store_id", pa.string()),
+        ("shopper_id", pa.string()), ("sku", pa.string()), ("name", pa.string()), ("category", pa.string()),
+        ("quantity", pa.int64()), ("unit_price_cents", pa.int64()),
+    ])
+
+
+def _chunks(session: Session, query, chunk_size: int) -> Iterator[List[tuple]]:
+    # Server-side cursor: Postgres sends chunk_size rows at a time
+    result = session.exec(query.execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+
+def export(session: Session, table: str, path: str, fmt: str = "parquet",
+           start: Optional[datetime] = None, end: Optional[datetime] = None,
+           chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """
+    Writes one table (rollup or item detail) to a Parquet or Arrow IPC file,
+    optionally limited to [start, end). Returns the number of rows written.
+
+    Key Decisions:
+    - Rows are streamed with a server-side cursor and written one record
+      batch at a time, so memory is bounded by chunk_size, not the table.
+    - Money stays integer cents, so offline sums are exact.
+    - The file is written under a temporary name and renamed when complete.
+    """
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+
+    query, time_column = _export_queries()[table]
+    if start is not None:
+        query = query.where(time_column >= start)
+    if end is not None:
+        query = query.where(time_column < end)
+    schema = _arrow_schema(pa, table)
+
+    tmp_path = path + ".tmp"
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(tmp_path, schema)
+    rows = 0
+    try:
+        for chunk in _chunks(session, query, chunk_size):
+            columns = list(zip(*chunk))
+            writer.write_batch(pa.record_batch(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+            ))
+            rows += len(chunk)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_path)
+        raise
+    writer.close()
+    os.replace(tmp_path, path)
+    return rows
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["update", "rebuild", "export"])
+    parser.add_argument("--table", choices=EXPORT_TABLES, default="items")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="export: from this time (UTC, inclusive)")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="export: up to this time (UTC, exclusive)")
+    parser.add_argument("--output", help="export: file to write")
+    args = parser.parse_args(argv)
+
+    with Session(get_engine()) as session:
+        if args.command == "update":
+            print(f"{catch_up(session)} ledger entries folded in")
+        elif args.command == "rebuild":
+            print(f"rollups rebuilt up to xid horizon {rebuild_rollups(session)}")
+        else:
+            if not args.output:
+                parser.error("export needs --output")
+            rows = export(session, args.table, args.output, args.format, args.start, args.end)
+            print(f"{rows} rows written to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,235 @@
+"""
+Rescore historical transactions with (possibly changed) earn rules and report
+how each shopper's balance would move.
+
+Usage:
+    python backfill.py                         # active rule file, expect no deltas
+    python backfill.py --promo-bonus 2 --cap 8 --output deltas.csv
+    python backfill.py --rules candidate_rules.json [--shopper-prefix store-7-]
+
+With no flags, transactions are scored with the rule file the app loads
+(STICKER_RULES_PATH, default rules.json; the built-in rules if it is absent).
+--cents-per-sticker, --promo-bonus and --cap score with the flat default rules
+instead, each flag overriding one number. Rule files that scoring.py can't
+vectorize (store rates, multipliers, SKU bonuses, campaigns) are scored one
+transaction at a time with the same evaluator the app uses: slower, same answer.
+
+Nothing is written to the database; the report is the output.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Iterator, NamedTuple, Optional
+
+import numpy as np
+from sqlmodel import Session, select
+
+from catalog import from_cents
+from database import get_engine
+from models import Category, Item, Sku, Transaction
+from rules import CompiledRules
+from scoring import score_batch, score_with_rules
+from services import (
+    DEFAULT_RULES,
+    DOLLARS_PER_STICKER,
+    MAX_STICKERS_PER_TRANSACTION,
+    PROMO_BONUS_PER_UNIT,
+    rule_engine,
+)
+
+
+def load_rules(path: Optional[str] = None) -> CompiledRules:
+    """
+    The rule file at `path`, or the one the app serves with (services.rule_engine.path).
+    Unlike the app's reload, a broken file raises instead of falling back to
+    the built-in rules: a backfill against the wrong rules is a silent lie.
+    """
+    if path is None:
+        path = rule_engine.path
+        if not path or not os.path.exists(path):
+            return CompiledRules(DEFAULT_RULES)
+    with open(path) as f:
+        return CompiledRules(json.load(f))
+
+
+class Line(NamedTuple):
+    """An item as CompiledRules.evaluate reads it."""
+    sku: str
+    category: str
+    quantity: int
+    unit_price: Decimal
+
+
+class Chunk(NamedTuple):
+    """One chunk of transactions and their items, items in CSR layout."""
+    transactions: list
+    categories: np.ndarray
+    quantities: np.ndarray
+    offsets: np.ndarray
+    skus: np.ndarray
+    unit_prices_cents: np.ndarray
+
+
+def category_names(session: Session) -> np.ndarray:
+    """Category names indexed by category id (the catalog's category table is tiny)."""
+    rows = session.exec(select(Category.id, Category.name)).all()
+    names = np.empty(max((row.id for row in rows), default=0) + 1, dtype=object)
+    for row in rows:
+        names[row.id] = row.name
+    return names
+
+
+def stream_chunks(session: Session, chunk_size: int, shopper_prefix: str = "") -> Iterator[Chunk]:
+    """
+    Yields one Chunk at a time.
+
+    Transactions are paged by transaction_id (keyset, no OFFSET), and each
+    chunk's items come from one extra query, so memory stays bounded by
+    chunk_size no matter how big the tables are. Items carry category ids;
+    they are turned back into names with one array lookup per chunk. SKUs,
+    prices, stores and timestamps are only read by rules that can't be
+    vectorized, but they come with the same two queries.
+    """
+    categories_by_id = category_names(session)
+    last_id = None
+    while True:
+        query = (
+            select(Transaction.transaction_id, Transaction.shopper_id, Transaction.store_id,
+                   Transaction.timestamp, Transaction.basket_total, Transaction.stickers_awarded)
+            .order_by(Transaction.transaction_id)
+            .limit(chunk_size)
+        )
+        if shopper_prefix:
+            query = query.where(Transaction.shopper_id.startswith(shopper_prefix, autoescape=True))
+        if last_id is not None:
+            query = query.where(Transaction.transaction_id > last_id)
+        transactions = session.exec(query).all()
+        if not transactions:
+            return
+        last_id = transactions[-1].transaction_id
+
+        position = {tx.transaction_id: i for i, tx in enumerate(transactions)}
+        items = session.exec(
+            select(Item.transaction_id, Item.category_id, Item.quantity, Sku.code, Item.unit_price_cents)
+            .join(Sku, Sku.id == Item.sku_id)
+            .where(Item.transaction_id.in_(list(position)))
+        ).all()
+
+        # Group items by transaction (CSR layout) with a stable sort on position
+        owner = np.fromiter((position[it.transaction_id] for it in items), dtype=np.int64, count=len(items))
+        order = np.argsort(owner, kind="stable")
+        category_ids = np.fromiter((items[i].category_id for i in order), dtype=np.int64, count=len(items))
+        categories = categories_by_id[category_ids]
+        quantities = np.array([items[i].quantity for i in order], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=len(transactions)))))
+        skus = np.array([items[i].code for i in order], dtype=object)
+        unit_prices_cents = np.array([items[i].unit_price_cents for i in order], dtype=np.int64)
+
+        yield Chunk(transactions, categories, quantities, offsets, skus, unit_prices_cents)
+
+
+def score_each(compiled: CompiledRules, chunk: Chunk) -> np.ndarray:
+    """
+    Scores a chunk one transaction at a time with compiled.evaluate, for rule
+    sets score_with_rules can't vectorize. Item lines are rebuilt from the
+    chunk's columns, so the evaluator sees what calculate_stickers saw.
+    """
+    scored = np.empty(len(chunk.transactions), dtype=np.int64)
+    for i, tx in enumerate(chunk.transactions):
+        start, end = chunk.offsets[i], chunk.offsets[i + 1]
+        lines = [
+            Line(chunk.skus[j], chunk.categories[j], int(chunk.quantities[j]),
+                 from_cents(int(chunk.unit_prices_cents[j])))
+            for j in range(start, end)
+        ]
+        scored[i] = compiled.evaluate(tx.basket_total, lines, tx.store_id, tx.timestamp)
+    return scored
+
+
+def run_backfill(chunk_size: int, compiled: CompiledRules = None, shopper_prefix: str = "", **rules) -> Dict[str, int]:
+    """
+    Rescores every transaction and returns {shopper_id: balance delta} for shoppers that change.
+    Pass a CompiledRules to score with a rule file, or keyword overrides for score_batch.
+    """
+    deltas: Dict[str, int] = defaultdict(int)
+    scanned = changed = 0
+    vectorized = True
+
+    with Session(get_engine()) as session:
+        for chunk in stream_chunks(session, chunk_size, shopper_prefix):
+            transactions = chunk.transactions
+            totals_cents = np.array([int(tx.basket_total * 100) for tx in transactions], dtype=np.int64)
+            awarded = np.array([tx.stickers_awarded for tx in transactions], dtype=np.int64)
+
+            if compiled is None:
+                rescored = score_batch(totals_cents, chunk.categories, chunk.quantities, chunk.offsets, **rules)
+            elif vectorized:
+                try:
+                    rescored = score_with_rules(
+                        compiled, totals_cents, chunk.categories, chunk.quantities, chunk.offsets
+                    )
+                except ValueError:
+                    print(f"   rules version {compiled.version} can't be vectorized; "
+                          f"scoring one transaction at a time", file=sys.stderr)
+                    vectorized = False
+                    rescored = score_each(compiled, chunk)
+            else:
+                rescored = score_each(compiled, chunk)
+            diff = rescored - awarded
+
+            for i in np.flatnonzero(diff):
+                deltas[transactions[i].shopper_id] += int(diff[i])
+            scanned += len(transactions)
+            changed += int(np.count_nonzero(diff))
+            print(f"   scanned {scanned} transactions, {changed} would change", file=sys.stderr)
+
+    return {shopper_id: delta for shopper_id, delta in deltas.items() if delta}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--cents-per-sticker", type=int, help=f"default {DOLLARS_PER_STICKER * 100}")
+    parser.add_argument("--promo-bonus", type=int, help=f"default {PROMO_BONUS_PER_UNIT}")
+    parser.add_argument("--cap", type=int, help=f"default {MAX_STICKERS_PER_TRANSACTION}")
+    parser.add_argument("--rules", help="score with this rule file instead of the active one")
+    parser.add_argument("--shopper-prefix", default="", help="only rescore shoppers whose id starts with this")
+    parser.add_argument("--output", help="write every shopper delta to this CSV file")
+    args = parser.parse_args()
+
+    get_engine().echo = False
+    overrides = {
+        "cents_per_sticker": args.cents_per_sticker,
+        "promo_bonus_per_unit": args.promo_bonus,
+        "cap": args.cap,
+    }
+    if args.rules or all(value is None for value in overrides.values()):
+        compiled = load_rules(args.rules)
+        print(f"scoring with rules version {compiled.version}", file=sys.stderr)
+        deltas = run_backfill(args.chunk_size, compiled, args.shopper_prefix)
+    else:
+        deltas = run_backfill(
+            args.chunk_size,
+            shopper_prefix=args.shopper_prefix,
+            cents_per_sticker=args.cents_per_sticker or DOLLARS_PER_STICKER * 100,
+            promo_bonus_per_unit=PROMO_BONUS_PER_UNIT if args.promo_bonus is None else args.promo_bonus,
+            cap=MAX_STICKERS_PER_TRANSACTION if args.cap is None else args.cap,
+        )
+
+    print(f"{len(deltas)} shoppers would change, net delta {sum(deltas.values())} stickers")
+    for shopper_id, delta in sorted(deltas.items(), key=lambda kv: -abs(kv[1]))[:20]:
+        print(f"  {shopper_id}: {delta:+d}")
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["shopper_id", "delta"])
+            writer.writerows(sorted(deltas.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from sqlalchemy import func, literal_column, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import BalanceShard, Shopper
+
+# -----------------------------------------------------------------------------
+# Atomic balance statements
+#
+# Balances are never read into Python, changed and written back. Every change
+# is a single SQL statement that does the arithmetic inside Postgres, so
+# concurrent requests for the same shopper can't lose each other's updates.
+#
+# A shopper's balance is Shopper.sticker_balance plus its BalanceShard rows
+# (only hot shoppers have any, see hot_shoppers.py). Every statement here
+# returns that total, so callers never need to know which mode a shopper is in.
+# -----------------------------------------------------------------------------
+
+
+def shard_total():
+    """
+    Sum of the current shopper row's shards (0 for ordinary shoppers): one
+    probe of the BalanceShard primary key. Correlated by name, because
+    SQLAlchemy doesn't correlate subqueries in an INSERT's RETURNING clause.
+    """
+    return (
+        select(func.coalesce(func.sum(BalanceShard.balance), 0))
+        .where(BalanceShard.shopper_id == literal_column("shopper.shopper_id"))
+        .scalar_subquery()
+    )
+
+
+def credit_stmt():
+    """
+    INSERT ... ON CONFLICT DO UPDATE that adds stickers to a shopper,
+    creating the shopper on first sight. RETURNING gives the new balance.
+
+    Execute it with {"shopper_id": ..., "sticker_balance": delta},
+    or with a list of those to credit many shoppers in one statement.
+    """
+    stmt = pg_insert(Shopper)
+    return stmt.on_conflict_do_update(
+        index_elements=[Shopper.shopper_id],
+        set_={"sticker_balance": Shopper.sticker_balance + stmt.excluded.sticker_balance},
+    ).returning(Shopper.shopper_id, (Shopper.sticker_balance + shard_total()).label("sticker_balance"))
+
+
+def debit_stmt(shopper_id: str, cost: int):
+    """
+    Conditional UPDATE that spends stickers only if the shopper can afford it.
+    Returns the new balance, or no row at all when the shopper is unknown
+    or the balance is too low.
+    """
+    return (
+        update(Shopper)
+        .where(Shopper.shopper_id == shopper_id, Shopper.sticker_balance >= cost)
+        .values(sticker_balance=Shopper.sticker_balance - cost)
+        .returning((Shopper.sticker_balance + shard_total()).label("sticker_balance"))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def balance_stmt(shopper_id: str):
+    """The shopper's balance, or no row for an unknown shopper."""
+    return select((Shopper.sticker_balance + shard_total()).label("sticker_balance")).where(
+        Shopper.shopper_id == shopper_id
+    )
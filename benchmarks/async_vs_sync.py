@@ -0,0 +1,84 @@
+"""
+Load benchmark: async request path (asyncpg + AsyncSession) vs the old
+sync path (psycopg2 + threadpool).
+
+Both variants serve the same shopper balance lookup against the same
+Postgres database. The sync variant is a twin of the pre-async handler,
+mounted on a throwaway app so the comparison isolates the request path.
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.async_vs_sync --requests 2000 --concurrency 1 50 500
+"""
+import argparse
+import asyncio
+import logging
+import uuid
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException
+from sqlmodel import Session, select
+
+import database
+from benchmarks.common import print_table, run_load
+from main import app as async_app
+from models import Shopper, Transaction
+
+
+def build_sync_app() -> FastAPI:
+    sync_app = FastAPI()
+
+    @sync_app.get("/shoppers/{shopper_id}")
+    def get_shopper_sync(shopper_id: str, session: Session = Depends(database.get_session)):
+        shopper = session.get(Shopper, shopper_id)
+        if not shopper:
+            raise HTTPException(status_code=404, detail="Shopper not found")
+        transactions = session.exec(select(Transaction).where(Transaction.shopper_id == shopper_id)).all()
+        return {"shopper_id": shopper.shopper_id, "sticker_balance": shopper.sticker_balance, "transactions": transactions}
+
+    return sync_app
+
+
+def seed_shoppers(count: int):
+    shopper_ids = [f"bench-{uuid.uuid4()}" for _ in range(count)]
+    with Session(database.engine) as session:
+        session.add_all(Shopper(shopper_id=s, sticker_balance=10) for s in shopper_ids)
+        session.commit()
+    return shopper_ids
+
+
+async def measure(app: FastAPI, shopper_ids, total: int, concurrency: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(i):
+            response = await client.get(f"/shoppers/{shopper_ids[i % len(shopper_ids)]}")
+            return response.status_code
+
+        return await run_load(send, total, concurrency)
+
+
+async def main(args):
+    shopper_ids = seed_shoppers(args.shoppers)
+    sync_app = build_sync_app()
+
+    rows = []
+    for concurrency in args.concurrency:
+        for name, app in (("sync", sync_app), ("async", async_app)):
+            result = await measure(app, shopper_ids, args.requests, concurrency)
+            rows.append({"path": name, "concurrency": concurrency, **result})
+    print_table("GET /shoppers/{id}", rows)
+    await database.async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--shoppers", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 50, 500])
+    args = parser.parse_args()
+
+    # Keep the terminal (and the measurement) free of per-request log output
+    logging.disable(logging.CRITICAL)
+    database.engine.echo = False
+    database.async_engine.echo = False
+
+    asyncio.run(main(args))
@@ -0,0 +1,85 @@
+"""
+Benchmark: one shopper_id at many tills, Shopper row vs balance shards.
+
+Fires the same burst of new receipts for a single shopper at
+POST /transactions (in-process, via httpx.ASGITransport) twice: first
+through the current create_transaction path, where every credit waits for
+the Shopper row lock, then after promoting the shopper to balance shards
+(hot_shoppers.py). It checks that the final balance is exact both times.
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.hot_shopper --requests 2000 --concurrency 8 32 --shards 8
+"""
+import argparse
+import asyncio
+import logging
+import uuid
+
+import httpx
+
+import cache
+import database
+import migrations
+import hot_shoppers
+import metrics
+from benchmarks.common import print_table, run_load
+from main import app
+
+
+async def burst(client: httpx.AsyncClient, shopper_id: str, total: int, concurrency: int):
+    run_id = uuid.uuid4().hex[:8]
+
+    async def send(i):
+        response = await client.post("/transactions", json={
+            "transaction_id": f"hot-{run_id}-{i}",
+            "shopper_id": shopper_id,
+            "store_id": f"store-{i % 40}",
+            "timestamp": "2025-11-28T09:00:00Z",
+            "items": [{"sku": "SKU-1", "name": "Coffee", "quantity": 1, "unit_price": "10.00", "category": "grocery"}],
+        })
+        return response.status_code
+
+    return await run_load(send, total, concurrency)
+
+
+async def balance(client: httpx.AsyncClient, shopper_id: str) -> int:
+    cache.balance_cache.delete(shopper_id)
+    response = await client.get(f"/shoppers/{shopper_id}", params={"balance_only": "true"})
+    return response.json()["sticker_balance"]
+
+
+async def main(args):
+    rows = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        for concurrency in args.concurrency:
+            shopper_id = f"hot-shopper-{uuid.uuid4().hex[:8]}"
+            for mode in ("shopper row", f"{args.shards} shards"):
+                if mode != "shopper row":
+                    with database.engine.begin() as connection:
+                        hot_shoppers.promote(connection, shopper_id, args.shards)
+                    hot_shoppers.directory.refresh(database.engine)
+                contended = sum(metrics.CONTENDED_CREDITS.values().values())
+                before = await balance(client, shopper_id) if mode != "shopper row" else 0
+                result = await burst(client, shopper_id, args.requests, concurrency)
+                after = await balance(client, shopper_id)
+                rows.append({
+                    "concurrency": concurrency, "mode": mode, **result,
+                    "slow_credits": sum(metrics.CONTENDED_CREDITS.values().values()) - contended,
+                    "balance_exact": after - before == args.requests,
+                })
+    await database.async_engine.dispose()
+    print_table(f"POST /transactions, one shopper, {args.requests} receipts per run", rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--shards", type=int, default=8)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    migrations.upgrade(database.engine)
+    hot_shoppers.directory.refresh(database.engine)
+    asyncio.run(main(args))
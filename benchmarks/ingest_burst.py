@@ -0,0 +1,94 @@
+"""
+Benchmark: POS edge latency during a burst, sync ingest vs queue mode.
+
+Fires the same burst of new transactions at POST /transactions twice
+(in-process, via httpx.ASGITransport): once applied inside the request,
+once with "Prefer: respond-async" so the request only enqueues. Then it
+starts ingest_queue.py workers and times how long they take to drain the
+backlog.
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.ingest_burst --requests 5000 --concurrency 500 --processes 4
+"""
+import argparse
+import asyncio
+import logging
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+from sqlmodel import Session, text
+
+import database
+import migrations
+from benchmarks.common import print_table, run_load
+from main import app
+
+
+async def burst(total: int, concurrency: int, shoppers: int, headers: dict):
+    run_id = uuid.uuid4().hex[:8]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def send(i):
+            response = await client.post("/transactions", headers=headers, json={
+                "transaction_id": f"burst-{run_id}-{i}",
+                "shopper_id": f"burst-shopper-{i % shoppers}",
+                "store_id": "bench-store",
+                "timestamp": "2025-11-28T09:00:00Z",
+                "items": [{"sku": "SKU-1", "name": "TV", "quantity": 1, "unit_price": "49.99", "category": "electronics"}],
+            })
+            return response.status_code
+
+        return await run_load(send, total, concurrency)
+
+
+def pending_count() -> int:
+    with Session(database.engine) as session:
+        return session.exec(text(
+            "SELECT count(*) FROM ingestqueueitem WHERE status IN ('queued', 'processing')"
+        )).scalar_one()
+
+
+def drain_with_workers(processes: int, batch_size: int) -> float:
+    started = time.perf_counter()
+    workers = subprocess.Popen(
+        [sys.executable, "ingest_queue.py", "--processes", str(processes), "--batch-size", str(batch_size)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while pending_count():
+            time.sleep(0.1)
+    finally:
+        workers.terminate()
+        workers.wait()
+    return time.perf_counter() - started
+
+
+async def main(args):
+    rows = []
+    sync = await burst(args.requests, args.concurrency, args.shoppers, {})
+    rows.append({"mode": "sync", **sync})
+    queued = await burst(args.requests, args.concurrency, args.shoppers, {"Prefer": "respond-async"})
+    rows.append({"mode": "queue (edge only)", **queued})
+    await database.async_engine.dispose()
+
+    seconds = drain_with_workers(args.processes, args.batch_size)
+    print_table(f"POST /transactions burst, concurrency {args.concurrency}", rows)
+    print(f"\n{args.processes} workers drained {args.requests} queued transactions "
+          f"in {seconds:.1f}s ({args.requests / seconds:.0f}/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--shoppers", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    migrations.upgrade(database.engine)
+    asyncio.run(main(args))
@@ -0,0 +1,212 @@
+"""
+Benchmark: item table footprint and ingest throughput, string columns vs catalog keys.
+
+1. Storage: generates the same N items (default 10M) twice inside Postgres,
+   in a scratch schema: once in the old layout (sku / name / category strings,
+   NUMERIC price) and once in the catalog layout (sku_id / category_id /
+   integer cents). Compares on-disk size (table + indexes + TOAST; the catalog
+   side includes its sku and category tables).
+2. Throughput: inserts the same generated baskets from Python into both
+   layouts (the catalog runs include Catalog.resolve, cold and then warm), then
+   runs the real ingest.ingest_transactions end to end.
+
+The scratch schema is dropped at the end. App tables are only written by the
+catalog interning and the end-to-end run (ids start with "bench-items-").
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.item_storage --items 10000000 --skus 50000 --ingest-items 200000
+"""
+import argparse
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+from benchmarks.common import print_table
+from catalog import Catalog, to_cents
+from database import engine
+from ingest import ingest_transactions
+import migrations
+from schemas import ItemCreate, TransactionCreate
+
+SCHEMA = "bench_items"
+CATEGORIES = ["grocery", "dairy", "bakery", "produce", "household", "electronics",
+              "toys", "promo", "frozen", "beverages", "snacks", "personal-care"]
+ITEMS_PER_BASKET = 8
+
+# Same column types and order as models.Item before / after (unpartitioned,
+# without the timestamp partition key). No foreign keys,
+# so the throughput run can insert ids interned in the app's catalog tables.
+SETUP_SQL = [
+    f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE",
+    f"CREATE SCHEMA {SCHEMA}",
+    f"""CREATE TABLE {SCHEMA}.item_strings (
+        id SERIAL PRIMARY KEY, transaction_id VARCHAR NOT NULL, sku VARCHAR NOT NULL,
+        name VARCHAR NOT NULL, category VARCHAR NOT NULL, quantity INTEGER NOT NULL,
+        unit_price NUMERIC(10, 2) NOT NULL)""",
+    f"CREATE TABLE {SCHEMA}.category (id SMALLSERIAL PRIMARY KEY, name VARCHAR NOT NULL UNIQUE)",
+    f"""CREATE TABLE {SCHEMA}.sku (
+        id SERIAL PRIMARY KEY, code VARCHAR NOT NULL, name VARCHAR NOT NULL, UNIQUE (code, name))""",
+    f"""CREATE TABLE {SCHEMA}.item (
+        unit_price_cents BIGINT NOT NULL, id SERIAL PRIMARY KEY, sku_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL, category_id SMALLINT NOT NULL, transaction_id VARCHAR NOT NULL)""",
+]
+
+# Synthetic lines: UUID transaction ids like the POS sends, ITEMS_PER_BASKET
+# lines per receipt, SKU popularity skewed toward the low ids.
+GENERATED = f"""
+WITH g AS (
+    SELECT md5((n / {ITEMS_PER_BASKET})::text)::uuid::text AS transaction_id,
+           floor(power(random(), 2) * :skus)::int + 1 AS sku_id,
+           1 + n % 3 AS quantity,
+           50 + (n % 5000) * 7919 % 5000 AS cents
+    FROM generate_series(0, :items - 1) AS n
+)
+"""
+
+LAYOUTS = [
+    ("strings (before)", [f"{SCHEMA}.item_strings"], f"""
+        INSERT INTO {SCHEMA}.item_strings (transaction_id, sku, name, category, quantity, unit_price)
+        SELECT g.transaction_id, s.code, s.name, c.name, g.quantity, g.cents / 100.0
+        FROM g JOIN {SCHEMA}.sku s ON s.id = g.sku_id
+               JOIN {SCHEMA}.category c ON c.id = 1 + g.sku_id % {len(CATEGORIES)}
+    """),
+    ("catalog keys (after)", [f"{SCHEMA}.item", f"{SCHEMA}.sku", f"{SCHEMA}.category"], f"""
+        INSERT INTO {SCHEMA}.item (transaction_id, sku_id, category_id, quantity, unit_price_cents)
+        SELECT g.transaction_id, g.sku_id, 1 + g.sku_id % {len(CATEGORIES)}, g.quantity, g.cents
+        FROM g
+    """),
+]
+
+
+def setup(skus: int) -> None:
+    with engine.begin() as connection:
+        for sql in SETUP_SQL:
+            connection.execute(text(sql))
+        connection.execute(text(f"INSERT INTO {SCHEMA}.category (name) SELECT unnest(CAST(:names AS text[]))"),
+                           {"names": CATEGORIES})
+        connection.execute(text(
+            f"INSERT INTO {SCHEMA}.sku (code, name) "
+            f"SELECT 'SKU-' || lpad(n::text, 6, '0'), 'Product ' || n || ' ' || left('Family Size Value', n % 18) "
+            f"FROM generate_series(0, :skus - 1) AS n"
+        ), {"skus": skus})
+
+
+def storage(items: int, skus: int) -> list:
+    rows = []
+    for label, tables, insert_sql in LAYOUTS:
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(text("SET LOCAL synchronous_commit = off"))
+            connection.execute(text(GENERATED + insert_sql), {"items": items, "skus": skus})
+        seconds = time.perf_counter() - started
+        with engine.connect() as connection:
+            size = sum(
+                connection.execute(text("SELECT pg_total_relation_size(:t)"), {"t": table}).scalar_one()
+                for table in tables
+            )
+        rows.append({"layout": label, "items": items, "MB": round(size / 2**20, 1),
+                     "bytes/item": round(size / items, 1), "generate_s": round(seconds, 1)})
+    rows.append({"layout": "saved", "items": items, "MB": round(rows[0]["MB"] - rows[1]["MB"], 1),
+                 "bytes/item": f"{1 - rows[1]['MB'] / rows[0]['MB']:.0%}", "generate_s": ""})
+    return rows
+
+
+def baskets(total_items: int, skus: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    run = uuid.uuid4().hex[:8]
+    transactions = []
+    for t in range(total_items // ITEMS_PER_BASKET):
+        lines = []
+        for _ in range(ITEMS_PER_BASKET):
+            n = int(rng.random() ** 2 * skus)
+            lines.append(ItemCreate(
+                sku=f"SKU-{n:06d}", name=f"Product {n}", category=CATEGORIES[n % len(CATEGORIES)],
+                quantity=1 + n % 3, unit_price=Decimal(50 + n % 5000) / 100,
+            ))
+        transactions.append(TransactionCreate(
+            transaction_id=f"bench-items-{run}-{t}", shopper_id=f"bench-items-{t % 5000}",
+            store_id="bench-store", timestamp="2025-11-28T09:00:00Z", items=lines,
+        ))
+    return transactions
+
+
+def throughput(total_items: int, skus: int, batch: int) -> list:
+    transactions = baskets(total_items, skus)
+    chunks = [transactions[i:i + batch] for i in range(0, len(transactions), batch)]
+    rows = []
+
+    def timed(label, run):
+        started = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - started
+        rows.append({"path": label, "items": total_items, "items/s": round(total_items / seconds)})
+
+    def strings():
+        with engine.begin() as connection:
+            for chunk in chunks:
+                connection.execute(text(
+                    f"INSERT INTO {SCHEMA}.item_strings (transaction_id, sku, name, category, quantity, unit_price) "
+                    "VALUES (:transaction_id, :sku, :name, :category, :quantity, :unit_price)"
+                ), [
+                    {"transaction_id": tx.transaction_id, "sku": item.sku, "name": item.name,
+                     "category": item.category, "quantity": item.quantity, "unit_price": item.unit_price}
+                    for tx in chunk for item in tx.items
+                ])
+
+    catalog = Catalog()
+
+    def keys():
+        with Session(engine) as session:
+            for chunk in chunks:
+                lines = [(tx, item) for tx in chunk for item in tx.items]
+                ids = catalog.resolve(session, [item for _, item in lines])
+                session.exec(text(
+                    f"INSERT INTO {SCHEMA}.item (transaction_id, sku_id, category_id, quantity, unit_price_cents) "
+                    "VALUES (:transaction_id, :sku_id, :category_id, :quantity, :unit_price_cents)"
+                ), params=[
+                    {"transaction_id": tx.transaction_id, "sku_id": sku_id, "category_id": category_id,
+                     "quantity": item.quantity, "unit_price_cents": to_cents(item.unit_price)}
+                    for (tx, item), (sku_id, category_id) in zip(lines, ids)
+                ])
+            session.commit()
+
+    def end_to_end():
+        with Session(engine) as session:
+            for chunk in chunks:
+                ingest_transactions(session, chunk)
+
+    timed("items insert, strings", strings)
+    timed("items insert, catalog keys (cold LRU)", keys)
+    timed("items insert, catalog keys (warm LRU)", keys)
+    timed("ingest_transactions end to end", end_to_end)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=10_000_000)
+    parser.add_argument("--skus", type=int, default=50_000)
+    parser.add_argument("--ingest-items", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=500, help="transactions per ingest batch")
+    parser.add_argument("--keep", action="store_true", help=f"keep the {SCHEMA} schema afterwards")
+    args = parser.parse_args()
+
+    migrations.upgrade(engine)
+    setup(args.skus)
+    try:
+        print_table(f"Item storage, {args.items:,} generated items", storage(args.items, args.skus))
+        print()
+        print_table(f"Ingest throughput, {args.ingest_items:,} items in baskets of {ITEMS_PER_BASKET}",
+                    throughput(args.ingest_items, args.skus, args.batch))
+    finally:
+        if not args.keep:
+            with engine.begin() as connection:
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+
+
+if __name__ == "__main__":
+    main()
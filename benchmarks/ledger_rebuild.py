@@ -0,0 +1,110 @@
+"""
+Benchmark: rebuilding shopper balances from the sticker ledger.
+
+Generates a synthetic ledger (server-side, with generate_series) for a set
+of throwaway shoppers, then times:
+- rebuild-full:     no snapshots, every entry is replayed
+- snapshot:         folding the whole ledger into per-shopper snapshots
+- rebuild-snapshot: snapshots plus a small tail of newer entries
+
+Peak RSS is reported to show the rebuild's memory stays flat as the
+ledger grows. The target size from the design review is 100M rows:
+    python -m benchmarks.ledger_rebuild --rows 100000000 --shoppers 1000000
+That needs roughly 15 GB of disk and a long coffee; the default is 1M rows.
+"""
+import argparse
+import resource
+import time
+import uuid
+
+from sqlmodel import Session, text
+
+import database
+import migrations
+import ledger
+from benchmarks.common import print_table
+
+GENERATE_BATCH = 5_000_000
+
+
+def seed(session: Session, prefix: str, rows: int, shoppers: int):
+    session.exec(text("""
+        INSERT INTO shopper (shopper_id, sticker_balance)
+        SELECT :prefix || g, 0 FROM generate_series(1, :n) g
+    """), params={"prefix": prefix, "n": shoppers})
+    session.commit()
+
+    for start in range(1, rows + 1, GENERATE_BATCH):
+        stop = min(start + GENERATE_BATCH - 1, rows)
+        session.exec(text("""
+            INSERT INTO ledgerentry (shopper_id, kind, source_id, delta, created_at)
+            SELECT :prefix || (1 + g % :shoppers), 'earn', :prefix || 'tx-' || g, 1 + g % 5,
+                   timezone('utc', now()) - interval '1 day'
+            FROM generate_series(CAST(:start AS bigint), :stop) g
+        """), params={"prefix": prefix, "shoppers": shoppers, "start": start, "stop": stop})
+        session.commit()
+    session.exec(text("ANALYZE ledgerentry"))
+
+
+def add_tail(session: Session, prefix: str, shoppers: int, count: int):
+    session.exec(text("""
+        INSERT INTO ledgerentry (shopper_id, kind, source_id, delta)
+        SELECT :prefix || (1 + g % :shoppers), 'earn', :prefix || 'tail-' || g, 1
+        FROM generate_series(1, :n) g
+    """), params={"prefix": prefix, "shoppers": shoppers, "n": count})
+    session.commit()
+
+
+def cleanup(session: Session, prefix: str):
+    for table in ("ledgerentry", "balancesnapshot", "shopper"):
+        session.exec(text(f"DELETE FROM {table} WHERE shopper_id LIKE :p"), params={"p": prefix + "%"})
+    session.commit()
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, round(time.perf_counter() - started, 2)
+
+
+def peak_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def main(args):
+    database.engine.echo = False
+    migrations.upgrade(database.engine)
+    prefix = f"bench-ledger-{uuid.uuid4().hex[:8]}-"
+    rows = []
+
+    with Session(database.engine) as session:
+        _, seconds = timed(lambda: seed(session, prefix, args.rows, args.shoppers))
+        print(f"generated {args.rows} ledger rows in {seconds}s")
+        try:
+            corrected, seconds = timed(lambda: ledger.rebuild_balances(session, args.chunk_size, prefix))
+            rows.append({"step": "rebuild-full", "seconds": seconds, "rows_per_s": int(args.rows / seconds),
+                         "balances_changed": corrected, "peak_rss_mb": peak_rss_mb()})
+
+            written, seconds = timed(lambda: ledger.take_snapshots(session))
+            rows.append({"step": "snapshot", "seconds": seconds, "rows_per_s": int(args.rows / seconds),
+                         "balances_changed": written, "peak_rss_mb": peak_rss_mb()})
+
+            add_tail(session, prefix, args.shoppers, args.tail)
+            corrected, seconds = timed(lambda: ledger.rebuild_balances(session, args.chunk_size, prefix))
+            rows.append({"step": "rebuild-snapshot", "seconds": seconds, "rows_per_s": int((args.rows + args.tail) / seconds),
+                         "balances_changed": corrected, "peak_rss_mb": peak_rss_mb()})
+        finally:
+            if not args.keep:
+                cleanup(session, prefix)
+
+    print_table(f"Ledger rebuild ({args.rows} rows, {args.shoppers} shoppers, chunk {args.chunk_size})", rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--shoppers", type=int, default=50_000)
+    parser.add_argument("--tail", type=int, default=10_000, help="entries added after the snapshot")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--keep", action="store_true", help="leave the generated rows in place")
+    main(parser.parse_args())
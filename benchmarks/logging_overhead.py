@@ -0,0 +1,100 @@
+"""
+Benchmark: what logging costs on POST /transactions.
+
+Each variant sends the same number of new transactions through the real
+app (in-process, via httpx.ASGITransport) with all log output going to
+os.devnull, so the numbers measure formatting and handler overhead, not
+the terminal.
+
+Variants:
+- disabled:    logging.disable(), the floor
+- sync-stream: a plain StreamHandler on the request path (the old setup)
+- queue-all:   logging_config queue pipeline, every success line kept
+- queue-1pct:  logging_config queue pipeline, default 1% success sampling
+- sql-echo:    queue-1pct plus SQLAlchemy statement logging (what SQL_ECHO=1 turns on)
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.logging_overhead --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+
+import httpx
+
+import database
+import migrations
+import logging_config
+from benchmarks.common import print_table, run_load
+from main import app
+
+
+def use_sync_stream(devnull) -> None:
+    root = logging.getLogger()
+    root.handlers.clear()
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def use_queue(devnull, sample_rate: str) -> None:
+    logging.getLogger().handlers.clear()
+    os.environ["LOG_SUCCESS_SAMPLE_RATE"] = sample_rate
+    logging_config.configure_logging(stream=devnull)
+
+
+async def measure(total: int, concurrency: int):
+    run_id = uuid.uuid4().hex[:8]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(i):
+            response = await client.post("/transactions", json={
+                "transaction_id": f"log-{run_id}-{i}",
+                "shopper_id": f"log-shopper-{i % 100}",
+                "store_id": "bench-store",
+                "timestamp": "2025-01-01T12:00:00Z",
+                "items": [{"sku": "SKU-1", "name": "Milk", "quantity": 2, "unit_price": "4.50", "category": "dairy"}],
+                "total_amount": "9.00",
+            })
+            return response.status_code
+
+        return await run_load(send, total, concurrency)
+
+
+async def main(args):
+    devnull = open(os.devnull, "w")
+    # Same records echo=True produces, but routed through our handler to devnull
+    sql_logger = logging.getLogger("sqlalchemy.engine")
+    variants = [
+        ("disabled", lambda: logging.disable(logging.CRITICAL)),
+        ("sync-stream", lambda: use_sync_stream(devnull)),
+        ("queue-all", lambda: use_queue(devnull, "1.0")),
+        ("queue-1pct", lambda: use_queue(devnull, "0.01")),
+        ("sql-echo", lambda: (use_queue(devnull, "0.01"), sql_logger.setLevel(logging.INFO))),
+    ]
+
+    rows = []
+    for name, setup in variants:
+        logging.disable(logging.NOTSET)
+        sql_logger.setLevel(logging.WARNING)
+        setup()
+        result = await measure(args.requests, args.concurrency)
+        rows.append({"logging": name, **result})
+
+    logging.disable(logging.CRITICAL)
+    print_table(f"POST /transactions, concurrency {args.concurrency}", rows)
+    await database.async_engine.dispose()
+    devnull.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    migrations.upgrade(database.engine)
+    asyncio.run(main(args))
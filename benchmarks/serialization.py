@@ -0,0 +1,128 @@
+"""
+Benchmark: request/response serialization, FastAPI default path vs fast path.
+
+No database involved; two throwaway apps do the same work on the same
+payloads, so the difference is purely parsing, validation and encoding.
+
+- POST /transactions-shaped endpoint, baskets of 1 to 500 lines:
+    default: body param (json.loads + validate), response_model re-validation,
+             jsonable_encoder + json.dumps
+    fast:    serialization.transaction_body (model_validate_json from bytes),
+             pre-encoded Response from model_dump_json
+- GET /shoppers-shaped history page of 50 / 500 Transaction rows:
+    default: ORM objects through jsonable_encoder
+    fast:    model_dump dicts through ORJSONResponse
+
+Usage:
+    python -m benchmarks.serialization --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import httpx
+from fastapi import Depends, FastAPI
+from fastapi.responses import Response
+
+import serialization
+from benchmarks.common import print_table
+from models import Transaction
+from schemas import TransactionCreate, TransactionResponse
+from serialization import ORJSONResponse
+
+
+def build_apps(history):
+    default_app, fast_app = FastAPI(), FastAPI()
+
+    def respond(transaction_in: TransactionCreate) -> TransactionResponse:
+        basket_total = sum(item.unit_price * item.quantity for item in transaction_in.items)
+        return TransactionResponse(
+            transaction_id=transaction_in.transaction_id, shopper_id=transaction_in.shopper_id,
+            store_id=transaction_in.store_id, basket_total=basket_total,
+            stickers_awarded=5, shopper_sticker_balance=42,
+        )
+
+    @default_app.post("/transactions", response_model=TransactionResponse, status_code=201)
+    async def default_create(transaction_in: TransactionCreate):
+        return respond(transaction_in)
+
+    @fast_app.post("/transactions", response_model=TransactionResponse, status_code=201)
+    async def fast_create(transaction_in: TransactionCreate = Depends(serialization.transaction_body)):
+        return Response(respond(transaction_in).model_dump_json(), status_code=201, media_type="application/json")
+
+    @default_app.get("/history")
+    async def default_history():
+        return {"shopper_id": "s", "sticker_balance": 42, "transactions": history, "next_cursor": None}
+
+    @fast_app.get("/history")
+    async def fast_history():
+        return ORJSONResponse({
+            "shopper_id": "s", "sticker_balance": 42,
+            "transactions": [tx.model_dump() for tx in history], "next_cursor": None,
+        })
+
+    return default_app, fast_app
+
+
+def basket(lines: int) -> bytes:
+    return json.dumps({
+        "transaction_id": "tx-1", "shopper_id": "s", "store_id": "store-1",
+        "timestamp": "2025-11-28T09:00:00Z",
+        "items": [
+            {"sku": f"SKU-{i}", "name": f"Item {i}", "category": "promo" if i % 7 == 0 else "grocery",
+             "quantity": 1 + i % 3, "unit_price": f"{1 + i % 40}.99"}
+            for i in range(lines)
+        ],
+    }).encode()
+
+
+async def time_requests(app, method: str, url: str, body: bytes, total: int) -> float:
+    """Mean microseconds per request, sequential, in-process."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        headers = {"content-type": "application/json"}
+        for _ in range(20):  # warm-up
+            await client.request(method, url, content=body, headers=headers)
+        started = time.perf_counter()
+        for _ in range(total):
+            response = await client.request(method, url, content=body, headers=headers)
+            assert response.status_code < 400, response.text
+        return (time.perf_counter() - started) / total * 1e6
+
+
+async def main(args):
+    history = [
+        Transaction(transaction_id=f"tx-{i}", shopper_id="s", store_id="store-1",
+                    timestamp=datetime(2025, 11, 28, 9, 0, i % 60), basket_total=Decimal("123.45"),
+                    stickers_awarded=5)
+        for i in range(max(args.history))
+    ]
+
+    rows = []
+    for lines in args.lines:
+        default_app, fast_app = build_apps(history)
+        body = basket(lines)
+        default_us = await time_requests(default_app, "POST", "/transactions", body, args.requests)
+        fast_us = await time_requests(fast_app, "POST", "/transactions", body, args.requests)
+        rows.append({"case": f"POST /transactions, {lines} lines", "default_us": round(default_us),
+                     "fast_us": round(fast_us), "speedup": round(default_us / fast_us, 2)})
+
+    for size in args.history:
+        default_app, fast_app = build_apps(history[:size])
+        default_us = await time_requests(default_app, "GET", "/history", b"", args.requests)
+        fast_us = await time_requests(fast_app, "GET", "/history", b"", args.requests)
+        rows.append({"case": f"GET history, {size} rows", "default_us": round(default_us),
+                     "fast_us": round(fast_us), "speedup": round(default_us / fast_us, 2)})
+
+    print_table("Serialization, mean time per request (in-process)", rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--lines", type=int, nargs="+", default=[1, 50, 200, 500])
+    parser.add_argument("--history", type=int, nargs="+", default=[50, 500])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,146 @@
+"""
+Startup profile: where a worker's cold start goes, and how soon it serves.
+
+    imports  Runs `python -X importtime -c "import main"` in fresh processes
+             and breaks the import down by top-level package (self time) and
+             by this repository's modules (cumulative time).
+    ready    Starts `uvicorn main:app` on a free port and measures, from the
+             moment the process is spawned:
+             - ready: first 200 from GET /healthz (imports + startup hooks)
+             - first request: first GET /shoppers/{id}, which also builds the
+               async engine and opens its first connection
+
+Each figure is the median over --runs fresh processes, and the ready median
+is checked against READY_TARGET_MS; Python's bytecode
+cache is warm, as it is on a redeploy of the same image. The schema must be
+migrated first (`python migrations.py upgrade`), or workers refuse to start.
+
+Usage (from the repository root, with Postgres running):
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.common import print_table
+from benchmarks.worker_scaling import free_port
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_MODULES = {name[:-3] for name in os.listdir(REPO_ROOT) if name.endswith(".py")}
+
+# A restarted worker should serve within this
+READY_TARGET_MS = 1000
+
+
+# -----------------------------------------------------------------------------
+# A. Import-time breakdown
+# -----------------------------------------------------------------------------
+def import_profile() -> Dict[str, Dict[str, int]]:
+    """One fresh `import main`; microseconds by package (self) and by repo module (cumulative)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+    )
+    packages: Dict[str, int] = defaultdict(int)
+    modules: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        packages[name.split(".")[0]] += int(self_us)
+        if name.split(".")[0] in REPO_MODULES:
+            modules[name] = int(cumulative_us)
+    return {"packages": dict(packages), "modules": modules}
+
+
+def import_breakdown(runs: int, top: int) -> Dict[str, List[Dict[str, object]]]:
+    profiles = [import_profile() for _ in range(runs)]
+
+    def median_ms(section: str, name: str) -> float:
+        return round(statistics.median(p[section].get(name, 0) for p in profiles) / 1000, 1)
+
+    totals = [sum(p["packages"].values()) for p in profiles]
+    packages = sorted({name for p in profiles for name in p["packages"]}, key=lambda n: -median_ms("packages", n))
+    modules = sorted({name for p in profiles for name in p["modules"]}, key=lambda n: -median_ms("modules", n))
+    return {
+        "total_ms": round(statistics.median(totals) / 1000, 1),
+        "packages": [{"package": name, "self_ms": median_ms("packages", name)} for name in packages[:top]],
+        "modules": [{"module": name, "cumulative_ms": median_ms("modules", name)} for name in modules[:top]],
+    }
+
+
+# -----------------------------------------------------------------------------
+# B. Time to ready / first request
+# -----------------------------------------------------------------------------
+def time_to_ready(timeout: float = 30) -> Dict[str, float]:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=base_url, timeout=timeout) as client:
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError("server exited during startup (is the schema migrated?)")
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError("server did not start")
+                try:
+                    if client.get("/healthz").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            ready = time.perf_counter() - started
+            client.get("/shoppers/startup-probe", params={"balance_only": "true"})
+            first_request = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+    return {"ready_ms": round(ready * 1000, 1), "first_request_ms": round(first_request * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="rows per import table")
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    imports = import_breakdown(args.runs, args.top)
+    print(f"\n`import main`: {imports['total_ms']} ms (median of {args.runs}, -X importtime adds overhead)")
+    print_table("Self time by package", imports["packages"])
+    print_table("Cumulative time of this repository's modules", imports["modules"])
+
+    samples = [time_to_ready() for _ in range(args.runs)]
+    startup = {
+        key: {"median": statistics.median(s[key] for s in samples), "max": max(s[key] for s in samples)}
+        for key in ("ready_ms", "first_request_ms")
+    }
+    print_table(f"Worker startup (uvicorn main:app, {args.runs} runs)", [
+        {"milestone": key, "median_ms": value["median"], "max_ms": value["max"]} for key, value in startup.items()
+    ])
+    ready = startup["ready_ms"]["median"]
+    verdict = "met" if ready < READY_TARGET_MS else "MISSED"
+    print(f"\nready {ready} ms (median) against a target of {READY_TARGET_MS} ms: {verdict}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"imports": imports, "startup": startup}, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
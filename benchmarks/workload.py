@@ -0,0 +1,86 @@
+"""
+Synthetic workload for the benchmark suite: shoppers, baskets and retry streams.
+
+Everything comes from one seeded random.Random, so the same seed produces
+the same request bodies (in the same order) on every machine and commit.
+Only the ids carry a per-run prefix, so reruns never collide with earlier data.
+
+- Basket sizes are log-normal: median about 5 lines, a long tail up to
+  MAX_LINES (end-of-week family shops).
+- SKU popularity and shopper visits are skewed: a few SKUs and regulars
+  account for most lines and receipts.
+- Retry streams resend earlier bodies byte-for-byte, the way a POS does when
+  a response times out, often several times in a row.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+CATEGORIES = ["grocery", "dairy", "bakery", "produce", "household", "electronics", "toys", "promo"]
+CATEGORY_WEIGHTS = [35, 12, 8, 12, 12, 5, 6, 10]
+MAX_LINES = 120
+STORES = 25
+
+
+class Workload:
+    def __init__(self, seed: int, run_id: str, shoppers: int = 5000, skus: int = 20000,
+                 base_time: Optional[datetime] = None):
+        self.rng = random.Random(seed)
+        self.run_id = run_id
+        self.shopper_ids = [f"bench-{run_id}-shopper-{n}" for n in range(shoppers)]
+        # A SKU always has the same category, like in the real catalog
+        self.sku_categories = self.rng.choices(CATEGORIES, CATEGORY_WEIGHTS, k=skus)
+        # Start of the current month: inside a partition that exists
+        now = datetime.utcnow()
+        self.base_time = base_time or datetime(now.year, now.month, 1)
+        self._sequence = 0
+
+    def shopper(self) -> str:
+        # Squaring a uniform draw skews visits toward the low ids (the regulars)
+        return self.shopper_ids[int(self.rng.random() ** 2 * len(self.shopper_ids))]
+
+    def basket(self) -> List[dict]:
+        size = min(MAX_LINES, max(1, int(self.rng.lognormvariate(1.6, 0.8))))
+        lines = []
+        for _ in range(size):
+            n = int(self.rng.random() ** 3 * len(self.sku_categories))
+            lines.append({
+                "sku": f"SKU-{n:06d}",
+                "name": f"Product {n}",
+                "category": self.sku_categories[n],
+                "quantity": 1 if self.rng.random() < 0.8 else self.rng.randint(2, 6),
+                "unit_price": f"{max(0.25, self.rng.lognormvariate(1.3, 0.9)):.2f}",
+            })
+        return lines
+
+    def transaction(self) -> Dict:
+        self._sequence += 1
+        return {
+            "transaction_id": f"bench-{self.run_id}-tx-{self._sequence}",
+            "shopper_id": self.shopper(),
+            "store_id": f"store-{self.rng.randint(1, STORES):02d}",
+            "timestamp": (self.base_time + timedelta(seconds=self.rng.randint(0, 3600 * 24 * 25))).isoformat() + "Z",
+            "items": self.basket(),
+        }
+
+    def redemption(self, reward_code: str) -> Dict:
+        self._sequence += 1
+        return {
+            "redemption_id": f"bench-{self.run_id}-red-{self._sequence}",
+            "shopper_id": self.shopper(),
+            "reward_code": reward_code,
+        }
+
+    def with_retries(self, make, total: int, retry_rate: float, window: int = 50) -> List[Dict]:
+        """
+        `total` request bodies from `make()`, where a fraction `retry_rate` are
+        resends of one of the last `window` bodies (bursts of up to 3 in a row).
+        """
+        bodies: List[Dict] = []
+        while len(bodies) < total:
+            if bodies and self.rng.random() < retry_rate:
+                original = bodies[-self.rng.randint(1, min(window, len(bodies)))]
+                bodies.extend([original] * min(self.rng.randint(1, 3), total - len(bodies)))
+            else:
+                bodies.append(make())
+        return bodies
@@ -0,0 +1,186 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# -----------------------------------------------------------------------------
+# Balance Cache
+#
+# Read-through cache in front of Shopper lookups. Readers try the cache first
+# and fill it on a miss; writers put the new balance in right after commit
+# (write-through), so the cache never needs to ask Postgres twice.
+# -----------------------------------------------------------------------------
+
+
+class LRUCache:
+    """
+    In-process LRU cache with a TTL and a size bound.
+
+    Key Decisions:
+    - OrderedDict gives O(1) get/set/evict. The least recently used entry is
+      dropped once max_size is reached (counted as an eviction).
+    - Entries older than ttl_seconds are treated as misses. The TTL bounds how
+      stale a balance can get when another worker process changed it.
+    - A lock makes it safe for both the event loop and threadpool handlers.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_size: int = 10_000, ttl_seconds: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, self._clock() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # Async handlers call these; in-process there is no I/O to wait for
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        return self.get(key)
+
+    async def aset(self, key: Hashable, value: Any) -> None:
+        self.set(key, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+        }
+
+
+class RedisCache:
+    """
+    Shared cache backed by Redis, so every worker process sees the same balances.
+
+    Any client with Redis-style get/set(ex=...)/delete works, which lets tests
+    pass in a small in-memory fake. Redis does its own evicting, so the
+    eviction counter here stays at 0; use Redis INFO for that number.
+
+    Key Decisions:
+    - get/set are for the sync paths (batch ingest, CLIs). Async handlers use
+      aget/aset, which await `async_client` (redis.asyncio) so a Redis round
+      trip never blocks the event loop. Without an async client they run the
+      sync call in a worker thread instead.
+    """
+
+    backend = "redis"
+
+    def __init__(self, client, ttl_seconds: float = 30.0, prefix: str = "looplink:balance:", async_client=None):
+        self.client = client
+        self.async_client = async_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _count(self, raw) -> Optional[int]:
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return int(raw)
+
+    def get(self, key: Hashable) -> Optional[int]:
+        return self._count(self.client.get(f"{self.prefix}{key}"))
+
+    def set(self, key: Hashable, value: int) -> None:
+        self.client.set(f"{self.prefix}{key}", value, ex=max(1, int(self.ttl_seconds)))
+
+    async def aget(self, key: Hashable) -> Optional[int]:
+        if self.async_client is None:
+            return await asyncio.to_thread(self.get, key)
+        return self._count(await self.async_client.get(f"{self.prefix}{key}"))
+
+    async def aset(self, key: Hashable, value: int) -> None:
+        if self.async_client is None:
+            await asyncio.to_thread(self.set, key, value)
+            return
+        await self.async_client.set(f"{self.prefix}{key}", value, ex=max(1, int(self.ttl_seconds)))
+
+    def delete(self, key: Hashable) -> None:
+        self.client.delete(f"{self.prefix}{key}")
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match=f"{self.prefix}*"):
+            self.client.delete(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class NullCache(LRUCache):
+    """Disables caching (every lookup is a miss) without changing any call sites."""
+
+    backend = "none"
+
+    def __init__(self):
+        super().__init__(max_size=0, ttl_seconds=0)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        pass
+
+
+def build_balance_cache():
+    """
+    Picks the backend from the environment:
+    - BALANCE_CACHE_BACKEND: memory (default), redis or none
+    - BALANCE_CACHE_SIZE / BALANCE_CACHE_TTL: size bound and TTL in seconds
+    - REDIS_URL: used by the redis backend
+    """
+    backend = os.getenv("BALANCE_CACHE_BACKEND", "memory")
+    ttl = float(os.getenv("BALANCE_CACHE_TTL", "30"))
+
+    if backend == "none":
+        return NullCache()
+    if backend == "redis":
+        import redis  # Optional dependency, only needed for this backend
+        import redis.asyncio
+
+        url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        return RedisCache(redis.Redis.from_url(url), ttl_seconds=ttl, async_client=redis.asyncio.Redis.from_url(url))
+    return LRUCache(max_size=int(os.getenv("BALANCE_CACHE_SIZE", "100000")), ttl_seconds=ttl)
+
+
+balance_cache = build_balance_cache()
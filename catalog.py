@@ -0,0 +1,289 @@
+"""
+Item catalog: interns SKU and category strings into small integer keys.
+
+Usage:
+    python catalog.py stats        # catalog sizes and item table footprint
+
+String-based item tables from older deployments are converted by
+`python migrations.py upgrade` (migration 2).
+"""
+import argparse
+import asyncio
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import String, and_, bindparam, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from cache import LRUCache
+from database import get_engine
+from models import Category, Item, Sku, Transaction
+from schemas import ItemCreate
+
+# -----------------------------------------------------------------------------
+# Catalog Interning
+#
+# Item rows store (sku_id, category_id) instead of three strings. Ingest maps
+# each line's strings to ids through an in-process LRU; only keys it has not
+# seen yet go to Postgres. Catalog rows are never updated or deleted, so a
+# cached id can never go stale and needs no TTL; the LRU bound only caps memory.
+# -----------------------------------------------------------------------------
+
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "100000"))
+
+CENT = Decimal("0.01")
+
+
+def to_cents(amount: Decimal) -> int:
+    """Money to integer cents, rounded like the old NUMERIC(10, 2) column."""
+    return int(amount.quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def from_cents(cents: int) -> Decimal:
+    return Decimal(cents).scaleb(-2)
+
+
+def basket_total_of(items: List[ItemCreate]) -> Decimal:
+    """The receipt's total as the database stores it: whole cents, two places."""
+    return from_cents(to_cents(sum((item.unit_price * item.quantity for item in items), Decimal(0))))
+
+
+class Catalog:
+    """
+    Maps category names and (sku, name) pairs to their ids.
+
+    Key Decisions:
+    - Misses are interned on a connection of their own and committed right
+      away. A request that later rolls back therefore never leaves an id in
+      the cache that points at an uncommitted row, and two requests with the
+      same new SKU never wait on each other's transactions.
+    - Call it before the session runs its first query (or after ending the
+      session's transaction): the intern connection is then the only one the
+      request holds. `cached` answers without any connection.
+    - One intern at a time per process. A burst of receipts with the same new
+      SKU (e.g. right after a deploy) costs one round trip, not one per
+      request and one pool connection each; the waiters find it cached.
+    - Existing keys are looked up before inserting, so a miss after an LRU
+      eviction doesn't burn a sequence value.
+    - Keys are inserted in sorted order, so concurrent interns take their
+      row locks in the same order.
+    """
+
+    def __init__(self, max_size: int = CATALOG_CACHE_SIZE):
+        self.categories = LRUCache(max_size=max_size, ttl_seconds=float("inf"))
+        self.skus = LRUCache(max_size=max_size, ttl_seconds=float("inf"))
+        self._lock = threading.Lock()
+        self._async_lock = asyncio.Lock()
+
+    def resolve(self, session: Session, items: Iterable[ItemCreate]) -> List[Tuple[int, int]]:
+        """(sku_id, category_id) for each item, in order."""
+        items = list(items)
+        found, missing = self._from_cache(items)
+        if any(missing):
+            if not self._lock.acquire(blocking=False):
+                self._lock.acquire()
+                found, missing = self._recheck(found, missing)
+            try:
+                if any(missing):
+                    with session.get_bind().begin() as connection:
+                        interned = self._intern(connection, *missing)
+                    found = self._remember(found, interned)
+            finally:
+                self._lock.release()
+        return self._ids(items, found)
+
+    def cached(self, items: Iterable[ItemCreate]) -> Optional[List[Tuple[int, int]]]:
+        """The ids if every string is already cached (no query, no lock); None otherwise."""
+        items = list(items)
+        found, missing = self._from_cache(items)
+        return None if any(missing) else self._ids(items, found)
+
+    async def resolve_async(self, session: AsyncSession, items: Iterable[ItemCreate]) -> List[Tuple[int, int]]:
+        items = list(items)
+        found, missing = self._from_cache(items)
+        if any(missing):
+            waited = self._async_lock.locked()
+            async with self._async_lock:
+                if waited:
+                    found, missing = self._recheck(found, missing)
+                if any(missing):
+                    async with session.bind.begin() as connection:
+                        interned = await connection.run_sync(self._intern, *missing)
+                    found = self._remember(found, interned)
+        return self._ids(items, found)
+
+    def _from_cache(self, items: List[ItemCreate]):
+        categories: Dict[str, int] = {}
+        skus: Dict[tuple, int] = {}
+        missing_categories, missing_skus = set(), set()
+        for item in items:
+            if item.category not in categories and item.category not in missing_categories:
+                category_id = self.categories.get(item.category)
+                if category_id is None:
+                    missing_categories.add(item.category)
+                else:
+                    categories[item.category] = category_id
+            key = (item.sku, item.name)
+            if key not in skus and key not in missing_skus:
+                sku_id = self.skus.get(key)
+                if sku_id is None:
+                    missing_skus.add(key)
+                else:
+                    skus[key] = sku_id
+        return (categories, skus), (missing_categories, missing_skus)
+
+    def _recheck(self, found, missing):
+        # We waited for another intern; it has probably cached our keys too
+        categories, skus = found
+        missing_categories, missing_skus = missing
+        for name in list(missing_categories):
+            category_id = self.categories.get(name)
+            if category_id is not None:
+                categories[name] = category_id
+                missing_categories.discard(name)
+        for key in list(missing_skus):
+            sku_id = self.skus.get(key)
+            if sku_id is not None:
+                skus[key] = sku_id
+                missing_skus.discard(key)
+        return found, missing
+
+    def _intern(self, connection, categories: set, skus: set):
+        return (
+            _intern_keys(connection, Category, [Category.name], {(name,) for name in categories}),
+            _intern_keys(connection, Sku, [Sku.code, Sku.name], skus),
+        )
+
+    def _remember(self, found, interned):
+        categories, skus = found
+        new_categories, new_skus = interned
+        # Only cached once the intern transaction has committed
+        for (name,), category_id in new_categories.items():
+            self.categories.set(name, category_id)
+            categories[name] = category_id
+        for key, sku_id in new_skus.items():
+            self.skus.set(key, sku_id)
+            skus[key] = sku_id
+        return categories, skus
+
+    @staticmethod
+    def _ids(items: List[ItemCreate], found) -> List[Tuple[int, int]]:
+        categories, skus = found
+        return [(skus[(item.sku, item.name)], categories[item.category]) for item in items]
+
+
+def _intern_keys(connection, model, columns, keys: set) -> Dict[tuple, int]:
+    """Ids for `keys` (tuples of `columns` values), inserting the ones that don't exist yet."""
+    if not keys:
+        return {}
+
+    def fetch(wanted):
+        # Join against unnest()ed key arrays: unlike a long IN list of row
+        # values, this uses the unique index on the key columns.
+        wanted = list(wanted)
+        lookup = select(*(
+            func.unnest(bindparam(f"k{i}", [key[i] for key in wanted], type_=ARRAY(String))).label(column.key)
+            for i, column in enumerate(columns)
+        )).subquery()
+        rows = connection.execute(
+            select(model.id, *columns).join(lookup, and_(*(column == lookup.c[column.key] for column in columns)))
+        )
+        return {tuple(row[1:]): row[0] for row in rows}
+
+    ids = fetch(keys)
+    new_keys = sorted(keys - ids.keys())
+    if new_keys:
+        connection.execute(
+            pg_insert(model).on_conflict_do_nothing(),
+            [{column.key: value for column, value in zip(columns, key)} for key in new_keys],
+        )
+        ids.update(fetch(set(new_keys)))
+    return ids
+
+
+def item_rows(transaction_id: str, timestamp: datetime, items: List[ItemCreate],
+              ids: List[Tuple[int, int]]) -> List[dict]:
+    """Insert parameters for insert(Item), given the ids from Catalog.resolve."""
+    return [
+        {
+            "transaction_id": transaction_id,
+            "timestamp": timestamp,
+            "sku_id": sku_id,
+            "category_id": category_id,
+            "quantity": item.quantity,
+            "unit_price_cents": to_cents(item.unit_price),
+        }
+        for item, (sku_id, category_id) in zip(items, ids)
+    ]
+
+
+def items_stmt(transactions: List[Transaction]):
+    """
+    Items of these transactions with their strings joined back in (API shape).
+    The timestamp range lets Postgres skip the months outside the page.
+    """
+    timestamps = [tx.timestamp for tx in transactions]
+    return (
+        select(
+            Item.id, Item.transaction_id, Sku.code, Sku.name, Category.name.label("category"),
+            Item.quantity, Item.unit_price_cents,
+        )
+        .join(Sku, Sku.id == Item.sku_id)
+        .join(Category, Category.id == Item.category_id)
+        .where(Item.transaction_id.in_([tx.transaction_id for tx in transactions]))
+        .where(Item.timestamp.between(min(timestamps, default=None), max(timestamps, default=None)))
+        .order_by(Item.id)
+    )
+
+
+def items_by_transaction(rows) -> Dict[str, List[dict]]:
+    """Groups items_stmt rows into the item dicts the API has always returned."""
+    grouped: Dict[str, List[dict]] = defaultdict(list)
+    for row in rows:
+        grouped[row.transaction_id].append({
+            "id": row.id,
+            "transaction_id": row.transaction_id,
+            "sku": row.code,
+            "name": row.name,
+            "category": row.category,
+            "quantity": row.quantity,
+            "unit_price": from_cents(row.unit_price_cents),
+        })
+    return grouped
+
+
+catalog = Catalog()
+
+
+def footprint(session: Session) -> Dict[str, int]:
+    """Row counts and on-disk bytes (table + indexes + TOAST) for the item tables."""
+    stats = {}
+    for table in ("item", "sku", "category", "item_legacy"):
+        exists = session.exec(text("SELECT to_regclass(:t) IS NOT NULL"), params={"t": table}).scalar_one()
+        if exists:
+            stats[f"{table}_rows"] = session.exec(text(f"SELECT count(*) FROM {table}")).scalar_one()
+            stats[f"{table}_bytes"] = session.exec(
+                text("SELECT pg_total_relation_size(:t)"), params={"t": table}
+            ).scalar_one()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["stats"])
+    parser.parse_args()
+
+    with Session(get_engine()) as session:
+        for name, value in footprint(session).items():
+            print(f"{name:<20} {value:>15,}")
+
+
+if __name__ == "__main__":
+    main()
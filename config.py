@@ -0,0 +1,104 @@
+import os
+import uuid
+
+from sqlalchemy.pool import NullPool
+
+# -----------------------------------------------------------------------------
+# Serving & Database Configuration
+#
+# Everything comes from environment variables so the same code runs under
+# `fastapi dev`, serve.py (N worker processes) and the test suite.
+#
+# Connection math: every worker process has its own pool, so Postgres sees up
+# to  WEB_CONCURRENCY x (DB_POOL_SIZE + DB_MAX_OVERFLOW)  connections per
+# engine. When DB_POOL_SIZE is not set explicitly, DB_CONNECTION_BUDGET is
+# split across the workers so adding workers never exceeds max_connections.
+# -----------------------------------------------------------------------------
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, "1" if default else "0").lower() in ("1", "true", "yes")
+
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://localhost/sticker_db")
+
+# Worker processes (serve.py sets this for its children)
+WEB_CONCURRENCY = _env_int("WEB_CONCURRENCY", 1)
+
+# Connections each engine (sync and async) may hold, across all workers.
+# Keep 2 x budget below Postgres' max_connections minus headroom for admin/cron.
+DB_CONNECTION_BUDGET = _env_int("DB_CONNECTION_BUDGET", 40)
+
+# "none": we pool. "pgbouncer": PgBouncer (transaction mode) pools; we hold
+# no idle connections and turn off server-side prepared statement caching,
+# which can't survive a connection being swapped between transactions.
+DB_POOLER = os.getenv("DB_POOLER", "none")
+
+DB_POOL_TIMEOUT = _env_int("DB_POOL_TIMEOUT", 10)  # seconds to wait for a free connection
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)  # reconnect before server/LB idle cut-offs
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", True)  # drop dead connections after a DB restart
+# 0 (the default) disables; serve.py turns it on for API workers, while
+# CLIs like backfill.py and ledger.py keep long-running statements.
+DB_STATEMENT_TIMEOUT_MS = _env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+# asyncpg caches prepared statements per connection; SQLAlchemy caches compiled SQL per engine
+DB_PREPARED_STATEMENT_CACHE_SIZE = _env_int("DB_PREPARED_STATEMENT_CACHE_SIZE", 256)
+DB_QUERY_CACHE_SIZE = _env_int("DB_QUERY_CACHE_SIZE", 1200)
+
+SQL_ECHO = _env_bool("SQL_ECHO", False)
+
+
+def pool_sizes(workers: int = WEB_CONCURRENCY):
+    """
+    (pool_size, max_overflow) for one worker. Explicit DB_POOL_SIZE /
+    DB_MAX_OVERFLOW win; otherwise half of this worker's share of the budget
+    is kept open and the other half is burst headroom.
+    """
+    share = max(2, DB_CONNECTION_BUDGET // max(1, workers))
+    pool_size = _env_int("DB_POOL_SIZE", max(1, share // 2))
+    max_overflow = _env_int("DB_MAX_OVERFLOW", share - pool_size)
+    return pool_size, max_overflow
+
+
+def _pool_kwargs() -> dict:
+    if DB_POOLER == "pgbouncer":
+        # PgBouncer already pools; a second pool here just pins its server slots
+        return {"poolclass": NullPool}
+    pool_size, max_overflow = pool_sizes()
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def sync_engine_kwargs() -> dict:
+    """create_engine() options for the psycopg2 engine."""
+    kwargs = {"echo": SQL_ECHO, "query_cache_size": DB_QUERY_CACHE_SIZE, **_pool_kwargs()}
+    if DB_STATEMENT_TIMEOUT_MS and DB_POOLER != "pgbouncer":
+        kwargs["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return kwargs
+
+
+def async_engine_kwargs() -> dict:
+    """create_async_engine() options for the asyncpg engine."""
+    kwargs = {"echo": SQL_ECHO, "query_cache_size": DB_QUERY_CACHE_SIZE, **_pool_kwargs()}
+    if DB_POOLER == "pgbouncer":
+        # Transaction pooling: no named prepared statements may outlive a transaction.
+        # (Set statement_timeout on the database role instead; PgBouncer drops
+        # unknown startup parameters.)
+        kwargs["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    else:
+        kwargs["connect_args"] = {"prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE}
+        if DB_STATEMENT_TIMEOUT_MS:
+            kwargs["connect_args"]["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return kwargs
@@ -1,21 +1,73 @@
-from sqlmodel import SQLModel, create_engine, Session
+import functools
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import config
+import metrics
 
 # 1. Connection String
 # On Mac, the default user is usually your system username, and there is no password.
-# We connect to localhost and the 'sticker_db' we created earlier.
-DATABASE_URL = "postgresql://localhost/sticker_db"
+# By default we connect to localhost and the 'sticker_db' we created earlier;
+# set DATABASE_URL to point somewhere else (e.g. PgBouncer on port 6432).
+DATABASE_URL = config.DATABASE_URL
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
 # 2. The Engine (The Connection Factory)
-# echo=True means "Print all SQL commands to the terminal" (Debug mode)
-engine = create_engine(DATABASE_URL, echo=True)
+# Built on first use, not at import: importing this module loads no database
+# driver and creates no pool, so a CLI that only needs psycopg2 never imports
+# asyncpg and a worker's import does no database work at all.
+# Pool size, recycle, pre-ping, statement timeout and echo (SQL_ECHO=1, debug
+# only) all come from config.py. Engines don't connect until first use either.
+SQL_ECHO = config.SQL_ECHO
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    engine = create_engine(DATABASE_URL, **config.sync_engine_kwargs())
+    metrics.register_pool("sync", engine.pool)
+    return engine
+
 
-# 3. Create Tables Function
-# We call this to create the tables (Shopper, Transaction, Item) in the DB
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+# 2b. The Async Engine (same database, asyncpg driver)
+# Async handlers await the database instead of parking a threadpool thread,
+# so one worker can keep thousands of requests in flight.
+# The pool is the real concurrency limit here: requests beyond
+# pool_size + max_overflow wait for a free connection (config.pool_sizes).
+@functools.lru_cache(maxsize=None)
+def get_async_engine():
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **config.async_engine_kwargs())
+    metrics.register_pool("async", async_engine.pool)
+    return async_engine
+
+
+# `database.engine` / `from database import engine` still work (scripts and
+# tests); they build the engine at that point. Library modules call
+# get_engine() where they need it, so importing them stays free.
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# 3. Tables
+# Created and changed only by migrations.py (`python migrations.py upgrade`),
+# once per deploy, never by the API workers.
 
 # 4. Session Dependency
 # This allows the API to borrow a connection and automatically close it later.
+# Sessions are lazy: a connection is only checked out at the first query, so a
+# request answered from a cache never touches the pool.
 def get_session():
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+    with Session(get_engine()) as session:
+        yield session
+
+# 5. Async Session Dependency
+# expire_on_commit=False keeps attributes readable after commit without
+# another round trip (async sessions cannot lazy-load).
+async def get_async_session():
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
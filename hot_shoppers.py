@@ -0,0 +1,335 @@
+"""
+Hot shoppers: split a shared account's balance over several rows.
+
+Usage:
+    python hot_shoppers.py list
+    python hot_shoppers.py promote corp-acme --shards 8
+    python hot_shoppers.py demote corp-acme
+
+Corporate and family accounts share one shopper_id across many tills. Every
+credit locks the Shopper row until its request commits, so their receipts
+are applied one at a time. A promoted shopper gets BalanceShard rows instead:
+earns add to a random shard, reads sum the shards (balances.py), and
+redemptions spend from one shard that covers the cost, or else from the
+consolidated total.
+
+Promotion is opt-in. With HOT_SHOPPER_AUTO_PROMOTE=1, each worker promotes
+shoppers whose credits keep waiting on the row lock: HOT_SHOPPER_PROMOTE_AFTER
+credits slower than HOT_SHOPPER_SLOW_MS within HOT_SHOPPER_WINDOW_SECONDS.
+The list of sharded shoppers is cached per worker and versioned like the
+reward catalog, so a promotion reaches every worker within
+HOT_SHOPPER_CHECK_SECONDS.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, select, text, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import metrics
+from models import BalanceShard, ResourceVersion, Shopper
+from rewards import BUMP_SQL
+
+logger = logging.getLogger(__name__)
+
+RESOURCE = "balance_shards"
+
+SHARDS = int(os.getenv("HOT_SHOPPER_SHARDS", "8"))
+AUTO_PROMOTE = os.getenv("HOT_SHOPPER_AUTO_PROMOTE", "0") == "1"
+SLOW_SECONDS = float(os.getenv("HOT_SHOPPER_SLOW_MS", "25")) / 1000
+PROMOTE_AFTER = int(os.getenv("HOT_SHOPPER_PROMOTE_AFTER", "20"))
+WINDOW_SECONDS = float(os.getenv("HOT_SHOPPER_WINDOW_SECONDS", "60"))
+CHECK_SECONDS = float(os.getenv("HOT_SHOPPER_CHECK_SECONDS", "5"))
+
+
+class ShardDirectory:
+    """
+    Which shoppers are sharded, and into how many shards.
+
+    Key Decisions:
+    - Reading it is a dict lookup. Like the reward catalog, each worker
+      polls one ResourceVersion row and reloads only after a promotion or
+      demotion.
+    - A stale copy is never wrong, only slower: a credit to a shard that no
+      longer exists falls back to the Shopper row, and the Shopper row is
+      always part of the balance.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.shards: Dict[str, int] = {}
+
+    def refresh(self, engine, force: bool = False) -> Dict[str, int]:
+        with engine.connect() as connection:
+            version = connection.execute(
+                select(ResourceVersion.version).where(ResourceVersion.name == RESOURCE)
+            ).scalar()
+            if version is None or (version == self.version and not force):
+                return self.shards
+            rows = connection.execute(
+                select(BalanceShard.shopper_id, func.count()).group_by(BalanceShard.shopper_id)
+            ).all()
+        # Replaced, never mutated, so readers never see a half-loaded dict
+        self.shards = {shopper_id: count for shopper_id, count in rows}
+        self.version = version
+        logger.info("Balance shard directory loaded: version %d, %d sharded shoppers", version, len(rows))
+        return self.shards
+
+
+class ContentionDetector:
+    """
+    Counts, per shopper, the credits that took longer than `slow_seconds`.
+    When that statement is slow, it is almost always waiting for another
+    request's lock on the Shopper row. A shopper with `promote_after` slow
+    credits in one window is queued for promotion.
+
+    Fast credits return after one comparison. Counts are dropped when a
+    window ends, so memory follows the number of contended shoppers.
+    Only called from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, enabled: bool = AUTO_PROMOTE, slow_seconds: float = SLOW_SECONDS,
+                 promote_after: int = PROMOTE_AFTER, window_seconds: float = WINDOW_SECONDS):
+        self.enabled = enabled
+        self.slow_seconds = slow_seconds
+        self.promote_after = promote_after
+        self.window_seconds = window_seconds
+        self.pending: set = set()
+        self._counts: Dict[str, int] = {}
+        self._window_start = time.monotonic()
+
+    def record(self, shopper_id: str, seconds: float) -> None:
+        if seconds < self.slow_seconds:
+            return
+        metrics.CONTENDED_CREDITS.inc()
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._window_start > self.window_seconds:
+            self._counts = {}
+            self._window_start = now
+        count = self._counts[shopper_id] = self._counts.get(shopper_id, 0) + 1
+        if count >= self.promote_after:
+            self.pending.add(shopper_id)
+
+    def take_pending(self) -> List[str]:
+        pending, self.pending = self.pending, set()
+        return sorted(pending)
+
+
+directory = ShardDirectory()
+detector = ContentionDetector()
+metrics.SHARDED_SHOPPERS.set_function(lambda: len(directory.shards))
+
+
+def _spread(total: int, shards: int) -> List[int]:
+    """`total` split into `shards` parts that differ by at most one."""
+    share, extra = divmod(total, shards)
+    return [share + (1 if i < extra else 0) for i in range(shards)]
+
+
+# -----------------------------------------------------------------------------
+# A. Statements used by the request path
+#
+# The total is the shard we changed plus the other shards and the Shopper
+# row as of the statement's snapshot, all in one round trip.
+# -----------------------------------------------------------------------------
+CREDIT_SQL = text("""
+    WITH credited AS (
+        UPDATE balanceshard SET balance = balance + :delta
+        WHERE shopper_id = :shopper_id AND shard = :shard
+        RETURNING shard, balance
+    )
+    SELECT c.balance
+           + (SELECT COALESCE(SUM(b.balance), 0) FROM balanceshard b
+              WHERE b.shopper_id = :shopper_id AND b.shard <> c.shard)
+           + (SELECT s.sticker_balance FROM shopper s WHERE s.shopper_id = :shopper_id) AS sticker_balance
+    FROM credited c
+""")
+
+# The fullest unlocked shard that covers the cost. Shards other requests
+# are writing are skipped, not waited for.
+DEBIT_SQL = text("""
+    WITH picked AS (
+        SELECT shard FROM balanceshard
+        WHERE shopper_id = :shopper_id AND balance >= :cost
+        ORDER BY balance DESC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), debited AS (
+        UPDATE balanceshard b SET balance = b.balance - :cost
+        FROM picked p
+        WHERE b.shopper_id = :shopper_id AND b.shard = p.shard
+        RETURNING b.shard, b.balance
+    )
+    SELECT d.balance
+           + (SELECT COALESCE(SUM(b.balance), 0) FROM balanceshard b
+              WHERE b.shopper_id = :shopper_id AND b.shard <> d.shard)
+           + (SELECT s.sticker_balance FROM shopper s WHERE s.shopper_id = :shopper_id) AS sticker_balance
+    FROM debited d
+""")
+
+# Consolidation takes shard locks in shard order, then the Shopper row, so
+# two consolidations (or a consolidation and a demotion) never deadlock.
+LOCK_SHARDS_SQL = text("""
+    SELECT shard, balance FROM balanceshard WHERE shopper_id = :shopper_id ORDER BY shard FOR UPDATE
+""")
+LOCK_SHOPPER_SQL = text("""
+    SELECT sticker_balance FROM shopper WHERE shopper_id = :shopper_id FOR NO KEY UPDATE
+""")
+SPREAD_SQL = text("""
+    UPDATE balanceshard b SET balance = v.balance
+    FROM unnest(CAST(:shards AS smallint[]), CAST(:balances AS integer[])) AS v(shard, balance)
+    WHERE b.shopper_id = :shopper_id AND b.shard = v.shard
+""")
+
+
+async def credit(session: AsyncSession, shopper_id: str, delta: int, shards: int) -> Optional[int]:
+    """
+    Adds `delta` to a random shard and returns the new balance. None if the
+    shard doesn't exist (the shopper was demoted since the directory loaded).
+    """
+    result = await session.exec(CREDIT_SQL, params={
+        "shopper_id": shopper_id, "delta": delta, "shard": random.randrange(shards),
+    })
+    return result.scalar_one_or_none()
+
+
+async def debit(session: AsyncSession, shopper_id: str, cost: int) -> Optional[int]:
+    """
+    Spends `cost` and returns the new balance, or None when the shopper
+    can't afford it (or has no shards).
+
+    Key Decisions:
+    - First choice is a single shard that covers the cost: one statement,
+      and concurrent earns and redemptions keep working on the other shards.
+    - Otherwise, the consolidated check locks every shard and the Shopper
+      row, so the total can't change underneath it. It spends from the total
+      and spreads what is left evenly over the shards again. The following
+      redemptions then usually find a single shard that covers them.
+    - Run it in the redemption's DB transaction, so a rollback undoes it.
+    """
+    params = {"shopper_id": shopper_id}
+    balance = (await session.exec(DEBIT_SQL, params={**params, "cost": cost})).scalar_one_or_none()
+    if balance is not None:
+        return balance
+
+    shards = (await session.exec(LOCK_SHARDS_SQL, params=params)).all()
+    if not shards:
+        return None
+    base = (await session.exec(LOCK_SHOPPER_SQL, params=params)).scalar_one()
+    total = base + sum(row.balance for row in shards)
+    if total < cost:
+        return None
+    remaining = total - cost
+    await session.exec(SPREAD_SQL, params={
+        **params, "shards": [row.shard for row in shards], "balances": _spread(remaining, len(shards)),
+    })
+    if base:
+        await session.exec(
+            update(Shopper).where(Shopper.shopper_id == shopper_id).values(sticker_balance=0)
+            .execution_options(synchronize_session=False)
+        )
+    return remaining
+
+
+# -----------------------------------------------------------------------------
+# B. Promotion and demotion (each bumps the version in the same DB transaction)
+# -----------------------------------------------------------------------------
+def promote(connection, shopper_id: str, shards: int = SHARDS) -> bool:
+    """
+    Moves the shopper's balance into `shards` BalanceShard rows, spread
+    evenly. Returns False for unknown or already sharded shoppers. It holds
+    the Shopper row lock for a moment, like any credit.
+    """
+    base = connection.execute(LOCK_SHOPPER_SQL, {"shopper_id": shopper_id}).scalar()
+    if base is None:
+        return False
+    if connection.execute(select(BalanceShard.shard).where(BalanceShard.shopper_id == shopper_id).limit(1)).first():
+        return False
+    connection.execute(insert(BalanceShard), [
+        {"shopper_id": shopper_id, "shard": shard, "balance": balance}
+        for shard, balance in enumerate(_spread(base, shards))
+    ])
+    connection.execute(update(Shopper).where(Shopper.shopper_id == shopper_id).values(sticker_balance=0))
+    connection.execute(BUMP_SQL, {"name": RESOURCE})
+    return True
+
+
+def demote(connection, shopper_id: str) -> bool:
+    """Folds the shards back into the Shopper row. Returns False if there were none."""
+    shards = connection.execute(LOCK_SHARDS_SQL, {"shopper_id": shopper_id}).all()
+    if not shards:
+        return False
+    connection.execute(
+        update(Shopper).where(Shopper.shopper_id == shopper_id)
+        .values(sticker_balance=Shopper.sticker_balance + sum(row.balance for row in shards))
+    )
+    connection.execute(delete(BalanceShard).where(BalanceShard.shopper_id == shopper_id))
+    connection.execute(BUMP_SQL, {"name": RESOURCE})
+    return True
+
+
+def promote_pending(engine, shopper_ids: List[str]) -> List[str]:
+    """Promotes the shoppers the detector queued, then reloads the directory."""
+    promoted = []
+    for shopper_id in shopper_ids:
+        if shopper_id in directory.shards:
+            continue
+        with engine.begin() as connection:
+            if promote(connection, shopper_id, SHARDS):
+                promoted.append(shopper_id)
+                metrics.SHOPPERS_SHARDED.inc()
+                logger.warning("Shopper %s is contended, balance split into %d shards", shopper_id, SHARDS)
+    directory.refresh(engine)
+    return promoted
+
+
+async def maintain(engine, interval_seconds: float) -> None:
+    """Background task: promotes contended shoppers and picks up other workers' promotions."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(promote_pending, engine, detector.take_pending())
+        except Exception:
+            logger.exception("Hot shopper check failed")
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["list", "promote", "demote"])
+    parser.add_argument("shopper_id", nargs="?")
+    parser.add_argument("--shards", type=int, default=SHARDS, help="promote: number of shards")
+    args = parser.parse_args(argv)
+
+    from database import engine
+
+    if args.command == "list":
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(BalanceShard.shopper_id, func.count(), func.sum(BalanceShard.balance), Shopper.sticker_balance)
+                .join(Shopper, Shopper.shopper_id == BalanceShard.shopper_id)
+                .group_by(BalanceShard.shopper_id, Shopper.sticker_balance)
+                .order_by(BalanceShard.shopper_id)
+            )
+            for shopper_id, shards, in_shards, base in rows:
+                print(f"{shopper_id:<40} {shards:>3} shards  balance {in_shards + base:>10}")
+        return
+    if not args.shopper_id:
+        parser.error(f"{args.command} needs a shopper id")
+    with engine.begin() as connection:
+        if args.command == "promote":
+            done = promote(connection, args.shopper_id, args.shards)
+        else:
+            done = demote(connection, args.shopper_id)
+    print(f"{args.shopper_id} {args.command}d" if done else f"{args.shopper_id}: nothing to do")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
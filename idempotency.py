@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from pydantic import BaseModel
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import select
+
+from cache import LRUCache
+from models import IdempotencyRecord
+
+TRANSACTION = "transaction"
+REDEMPTION = "redemption"
+
+
+class StoredResponse(NamedTuple):
+    request_hash: str
+    response: str
+
+
+class IdempotencyConflictError(Exception):
+    """The same idempotency key was reused with a different payload."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        super().__init__(f"Payload does not match the original request for: {self.keys}")
+
+
+# Bounded in-memory layer in front of the table. Records never change once
+# written, so entries only leave when evicted or after the (long) TTL.
+recent_responses = LRUCache(
+    max_size=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "50000")),
+    ttl_seconds=float(os.getenv("IDEMPOTENCY_CACHE_TTL", "3600")),
+)
+
+
+def _canonical(value):
+    # 50.0 and 50.00 are the same price; hash them the same way
+    if isinstance(value, Decimal):
+        return format(value.normalize(), "f")
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot hash {type(value).__name__}")
+
+
+def request_hash(payload: BaseModel) -> str:
+    """SHA-256 of the request payload in a canonical JSON form."""
+    canonical = json.dumps(payload.model_dump(), default=_canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def cached(kind: str, key: str) -> Optional[StoredResponse]:
+    """Checks the in-memory layer only."""
+    return recent_responses.get((kind, key))
+
+
+def lookup_stmt(kind: str, keys: Iterable[str]):
+    """SELECT for the stored responses of one or many keys (run on any session)."""
+    return select(IdempotencyRecord.key, IdempotencyRecord.request_hash, IdempotencyRecord.response).where(
+        IdempotencyRecord.kind == kind, IdempotencyRecord.key.in_(list(keys))
+    )
+
+
+def record_stmt():
+    """
+    INSERT for new records; execute with one or a list of dicts holding
+    kind/key/request_hash/response. Run it inside the write's own transaction.
+    """
+    return pg_insert(IdempotencyRecord).on_conflict_do_nothing()
+
+
+def remember(kind: str, key: str, stored: StoredResponse) -> None:
+    """Puts a committed record into the in-memory layer."""
+    recent_responses.set((kind, key), stored)
+
+
+def rows_to_stored(rows) -> Dict[str, StoredResponse]:
+    return {row.key: StoredResponse(row.request_hash, row.response) for row in rows}
@@ -0,0 +1,261 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List
+
+from sqlalchemy import DateTime, String, func, insert, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlmodel import Session
+
+from models import IdempotencyRecord, Item, LedgerEntry, Shopper, Transaction
+from schemas import TransactionCreate, TransactionResponse
+from services import calculate_stickers
+from balances import credit_stmt, shard_total
+import ledger
+import cache
+from catalog import basket_total_of, catalog, item_rows
+import idempotency
+from idempotency import IdempotencyConflictError, StoredResponse
+import metrics
+
+# How many times we re-run a batch if another writer inserted one of our
+# transaction_ids between our duplicate check and our insert.
+MAX_BATCH_ATTEMPTS = 3
+
+
+class BatchConflictError(Exception):
+    """Raised when concurrent writers keep racing us for the same transaction_ids."""
+
+
+def ingest_transactions(
+    session: Session, transactions_in: List[TransactionCreate]
+) -> List[TransactionResponse]:
+    """
+    Writes a whole batch of receipts using set-based SQL instead of one
+    round trip per row.
+
+    Key Decisions:
+    - Duplicates are found with ONE query against the earn ledger entries and
+      the transaction table (joined to the idempotency records, which hold the
+      original responses). The ledger keeps archived months' receipts known.
+      A transaction_id repeated inside the batch is treated like a retry:
+      the first copy wins, later copies get the same response back.
+    - A duplicate whose payload hash differs from the original fails the whole
+      batch with IdempotencyConflictError before anything is written.
+    - Each shopper's summed sticker delta is applied by a single upsert
+      (INSERT ... ON CONFLICT DO UPDATE), so every shopper row is touched once.
+      Shoppers are sorted by id so concurrent batches lock rows in the same order.
+    - Item strings are mapped to catalog ids before any row is written
+      (catalog.py), so the items insert carries only integers.
+    - Transactions and items go in as multi-row INSERTs. The earn ledger
+      entries go first with ON CONFLICT DO NOTHING: if a concurrent writer
+      beat us to an id, we roll back and re-run the batch so no stickers are
+      double-awarded.
+    - Responses come back in request order. The balance on each response is the
+      shopper's balance right after that receipt was applied.
+    """
+    # Catalog ids first, before the session takes its connection (cache hits cost no query)
+    ids = catalog.resolve(session, [item for tx in transactions_in for item in tx.items])
+    item_ids: Dict[str, list] = {}
+    start = 0
+    for tx in transactions_in:
+        item_ids.setdefault(tx.transaction_id, ids[start:start + len(tx.items)])
+        start += len(tx.items)
+
+    for _ in range(MAX_BATCH_ATTEMPTS):
+        responses = _try_ingest(session, transactions_in, item_ids)
+        if responses is not None:
+            return responses
+        session.rollback()
+    raise BatchConflictError("Batch kept conflicting with concurrent writers")
+
+
+def _try_ingest(session: Session, transactions_in: List[TransactionCreate], item_ids: Dict[str, list]):
+    hashes = [idempotency.request_hash(tx) for tx in transactions_in]
+
+    # A. Idempotency Check (one query for the whole batch). An id counts as
+    #    applied if it has an earn ledger entry (kept forever) or, for receipts
+    #    from before the ledger, a transaction row. Transaction rows alone are
+    #    not enough: an archived month's receipts are gone from that table.
+    #    Each id is looked up with its payload timestamp, so the transaction
+    #    row lookup probes one monthly partition instead of all of them.
+    timestamps: Dict[str, datetime] = {}
+    for tx in transactions_in:
+        timestamps.setdefault(tx.transaction_id, tx.timestamp)
+    existing: Dict[str, tuple] = {}
+    if timestamps:
+        key = func.unnest(
+            literal(list(timestamps), ARRAY(String)), literal(list(timestamps.values()), ARRAY(DateTime))
+        ).table_valued("transaction_id", "timestamp").render_derived()
+        rows = session.exec(
+            select(
+                key.c.transaction_id,
+                func.coalesce(LedgerEntry.shopper_id, Transaction.shopper_id).label("shopper_id"),
+                Transaction.store_id,
+                Transaction.basket_total,
+                func.coalesce(Transaction.stickers_awarded, LedgerEntry.delta).label("stickers_awarded"),
+                (Shopper.sticker_balance + shard_total()).label("sticker_balance"),
+                IdempotencyRecord.request_hash,
+                IdempotencyRecord.response,
+            )
+            .select_from(key)
+            .outerjoin(
+                LedgerEntry,
+                (LedgerEntry.kind == ledger.EARN) & (LedgerEntry.source_id == key.c.transaction_id),
+            )
+            .outerjoin(
+                Transaction,
+                (Transaction.transaction_id == key.c.transaction_id) & (Transaction.timestamp == key.c.timestamp),
+            )
+            .outerjoin(
+                IdempotencyRecord,
+                (IdempotencyRecord.kind == idempotency.TRANSACTION)
+                & (IdempotencyRecord.key == key.c.transaction_id),
+            )
+            # Inner join: ids with neither a ledger entry nor a row drop out here
+            .join(Shopper, Shopper.shopper_id == func.coalesce(LedgerEntry.shopper_id, Transaction.shopper_id))
+        ).all()
+        existing = {row.transaction_id: row for row in rows}
+
+    # B. Calculate (pure Python, no DB access)
+    new_transactions = []
+    hash_by_id: Dict[str, str] = {}
+    conflicts = []
+    stickers_by_id: Dict[str, int] = {}
+    totals_by_id = {}
+    shopper_deltas: Dict[str, int] = defaultdict(int)
+
+    for tx, payload_hash in zip(transactions_in, hashes):
+        known_hash = hash_by_id.get(tx.transaction_id)
+        if known_hash is None and tx.transaction_id in existing:
+            # Rows written before records existed have no hash to compare
+            known_hash = existing[tx.transaction_id].request_hash or payload_hash
+            hash_by_id[tx.transaction_id] = known_hash
+        if known_hash is not None:
+            if known_hash != payload_hash:
+                conflicts.append(tx.transaction_id)
+            continue
+        hash_by_id[tx.transaction_id] = payload_hash
+
+        basket_total = basket_total_of(tx.items)
+        stickers = calculate_stickers(basket_total, tx.items, tx.store_id, tx.timestamp)
+
+        new_transactions.append(tx)
+        totals_by_id[tx.transaction_id] = basket_total
+        stickers_by_id[tx.transaction_id] = stickers
+        shopper_deltas[tx.shopper_id] += stickers
+
+    if conflicts:
+        raise IdempotencyConflictError(conflicts)
+
+    # C. Upsert Shoppers (one statement, one row update per shopper)
+    final_balances: Dict[str, int] = {}
+    if shopper_deltas:
+        result = session.exec(
+            credit_stmt(),
+            params=[
+                {"shopper_id": shopper_id, "sticker_balance": delta}
+                for shopper_id, delta in sorted(shopper_deltas.items())
+            ],
+        )
+        final_balances = {row.shopper_id: row.sticker_balance for row in result}
+
+    # D. Append one ledger entry per new transaction. Its unique
+    #    (kind, source_id) is the duplicate guard: a lost race means we retry.
+    if new_transactions:
+        result = session.exec(ledger.earn_stmt(), params=[
+            {
+                "shopper_id": tx.shopper_id,
+                "kind": ledger.EARN,
+                "source_id": tx.transaction_id,
+                "source_timestamp": tx.timestamp,
+                "delta": stickers_by_id[tx.transaction_id],
+            }
+            for tx in new_transactions
+        ])
+        if len(result.all()) != len(new_transactions):
+            return None
+
+        # D2. Save Transactions (multi-row insert, routed to monthly partitions)
+        session.exec(insert(Transaction), params=[
+            {
+                "transaction_id": tx.transaction_id,
+                "shopper_id": tx.shopper_id,
+                "store_id": tx.store_id,
+                "timestamp": tx.timestamp,
+                "basket_total": totals_by_id[tx.transaction_id],
+                "stickers_awarded": stickers_by_id[tx.transaction_id],
+            }
+            for tx in new_transactions
+        ])
+
+    # E. Save Items (multi-row insert)
+    rows = []
+    for tx in new_transactions:
+        rows += item_rows(tx.transaction_id, tx.timestamp, tx.items, item_ids[tx.transaction_id])
+    if rows:
+        session.exec(insert(Item), params=rows)
+
+    # F. Build responses. Walk backwards from each shopper's final balance
+    #    so every new receipt reports the balance it produced.
+    balance_after: Dict[str, int] = {}
+    running = dict(final_balances)
+    for tx in reversed(new_transactions):
+        balance_after[tx.transaction_id] = running[tx.shopper_id]
+        running[tx.shopper_id] -= stickers_by_id[tx.transaction_id]
+
+    new_responses: Dict[str, TransactionResponse] = {
+        tx.transaction_id: TransactionResponse(
+            transaction_id=tx.transaction_id,
+            shopper_id=tx.shopper_id,
+            store_id=tx.store_id,
+            basket_total=totals_by_id[tx.transaction_id],
+            stickers_awarded=stickers_by_id[tx.transaction_id],
+            shopper_sticker_balance=balance_after[tx.transaction_id],
+        )
+        for tx in new_transactions
+    }
+
+    # G. Remember responses (same DB transaction as the writes)
+    stored_by_id = {
+        tx_id: StoredResponse(hash_by_id[tx_id], response.model_dump_json())
+        for tx_id, response in new_responses.items()
+    }
+    if stored_by_id:
+        session.exec(idempotency.record_stmt(), params=[
+            {
+                "kind": idempotency.TRANSACTION,
+                "key": tx_id,
+                "request_hash": stored.request_hash,
+                "response": stored.response,
+            }
+            for tx_id, stored in stored_by_id.items()
+        ])
+
+    session.commit()
+    if len(new_transactions) < len(transactions_in):
+        metrics.DUPLICATES.inc(idempotency.TRANSACTION, amount=len(transactions_in) - len(new_transactions))
+    for shopper_id, balance in final_balances.items():
+        cache.balance_cache.set(shopper_id, balance)
+    for tx_id, stored in stored_by_id.items():
+        idempotency.remember(idempotency.TRANSACTION, tx_id, stored)
+
+    responses = []
+    for tx in transactions_in:
+        if tx.transaction_id in new_responses:
+            responses.append(new_responses[tx.transaction_id])
+            continue
+        row = existing[tx.transaction_id]
+        if row.response is not None:
+            responses.append(TransactionResponse.model_validate_json(row.response))
+        else:
+            # No stored response. If the receipt's month was archived too, only
+            # the ledger entry is left; the request supplies the rest.
+            responses.append(TransactionResponse(
+                transaction_id=row.transaction_id,
+                shopper_id=row.shopper_id,
+                store_id=row.store_id or tx.store_id,
+                basket_total=row.basket_total if row.basket_total is not None else basket_total_of(tx.items),
+                stickers_awarded=row.stickers_awarded,
+                shopper_sticker_balance=final_balances.get(row.shopper_id, row.sticker_balance),
+            ))
+    return responses
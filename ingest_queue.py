@@ -0,0 +1,235 @@
+"""
+Queue-mode ingest: drain the IngestQueueItem table in micro-batches.
+
+Usage:
+    python ingest_queue.py --processes 4 --batch-size 500
+
+POST /transactions only enqueues when INGEST_MODE=queue is set or the client
+sends "Prefer: respond-async"; it answers 202 with a status URL. These
+workers then run the normal batch ingest (ingest.ingest_transactions:
+calculate_stickers, balance upserts, ledger, idempotency records).
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session
+
+from database import get_engine
+from idempotency import IdempotencyConflictError
+from ingest import ingest_transactions
+from logging_config import configure_logging
+from models import IngestQueueItem
+from schemas import TransactionCreate
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+# A claimed row whose worker hasn't finished within this many seconds is
+# handed to another worker (ingest is idempotent, so a repeat is harmless).
+LEASE_SECONDS = int(os.getenv("INGEST_QUEUE_LEASE_SECONDS", "60"))
+# A row that keeps failing for reasons other than an idempotency conflict
+# is parked as "failed" after this many attempts.
+MAX_ATTEMPTS = int(os.getenv("INGEST_QUEUE_MAX_ATTEMPTS", "5"))
+# Finished rows only exist to answer status checks; purge them after this.
+RETENTION_HOURS = int(os.getenv("INGEST_QUEUE_RETENTION_HOURS", "24"))
+
+
+# -----------------------------------------------------------------------------
+# A. Enqueue (request path: one statement)
+# -----------------------------------------------------------------------------
+def enqueue_stmt():
+    """
+    INSERT ... ON CONFLICT (transaction_id) DO NOTHING RETURNING id.
+    No row back means the transaction_id is already queued (or was).
+    """
+    return (
+        pg_insert(IngestQueueItem)
+        .on_conflict_do_nothing(index_elements=[IngestQueueItem.transaction_id])
+        .returning(IngestQueueItem.id)
+    )
+
+
+def status_url(transaction_id: str) -> str:
+    return f"/transactions/{transaction_id}/status"
+
+
+# -----------------------------------------------------------------------------
+# B. Claim / finish (worker side)
+# -----------------------------------------------------------------------------
+CLAIM_SQL = text("""
+    UPDATE ingestqueueitem
+    SET status = 'processing', claimed_at = timezone('utc', now()), attempts = attempts + 1
+    WHERE id IN (
+        SELECT q.id FROM ingestqueueitem q
+        WHERE q.status = 'queued'
+          AND NOT EXISTS (
+              SELECT 1 FROM ingestqueueitem earlier
+              WHERE earlier.shopper_id = q.shopper_id
+                AND earlier.id < q.id
+                AND earlier.status IN ('queued', 'processing')
+          )
+        ORDER BY q.id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, transaction_id, payload, attempts
+""")
+
+RELEASE_STALE_SQL = text("""
+    UPDATE ingestqueueitem SET status = 'queued'
+    WHERE status = 'processing'
+      AND claimed_at < timezone('utc', now()) - make_interval(secs => :lease)
+""")
+
+FINISH_SQL = text("""
+    UPDATE ingestqueueitem
+    SET status = :status, error = :error, processed_at = timezone('utc', now())
+    WHERE id = ANY(:ids)
+""")
+
+PURGE_SQL = text("""
+    DELETE FROM ingestqueueitem
+    WHERE status = 'done' AND processed_at < timezone('utc', now()) - make_interval(hours => :hours)
+""")
+
+
+def claim_batch(session: Session, limit: int) -> list:
+    """
+    Claims up to `limit` rows in enqueue order, at most one per shopper
+    (a shopper's next row becomes claimable once this one is done).
+    Committed straight away, so the lease is visible to other workers.
+    """
+    rows = session.exec(CLAIM_SQL, params={"limit": limit}).all()
+    session.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+
+def finish(session: Session, ids: List[int], status: str, error: Optional[str] = None) -> None:
+    if ids:
+        session.exec(FINISH_SQL, params={"ids": ids, "status": status, "error": error})
+        session.commit()
+
+
+def process_batch(session: Session, batch_size: int = 500) -> int:
+    """
+    Claims one micro-batch and ingests it. Returns how many rows were claimed.
+
+    Key Decisions:
+    - The whole batch goes through ingest_transactions, so set-based writes
+      and transaction-id dedupe are exactly the same as POST /transactions/batch.
+    - If the batch fails (e.g. one row conflicts with an already applied
+      transaction), its rows are retried one at a time, so a single poison
+      payload fails alone instead of holding up everyone else.
+    """
+    session.exec(RELEASE_STALE_SQL, params={"lease": LEASE_SECONDS})
+    session.commit()
+
+    rows = claim_batch(session, batch_size)
+    if not rows:
+        return 0
+    try:
+        ingest_transactions(session, [TransactionCreate.model_validate_json(row.payload) for row in rows])
+    except Exception:
+        session.rollback()
+        logger.warning("Ingest batch of %d failed, retrying rows one by one", len(rows))
+        for row in rows:
+            _process_one(session, row)
+    else:
+        finish(session, [row.id for row in rows], DONE)
+    return len(rows)
+
+
+def _process_one(session: Session, row) -> None:
+    try:
+        ingest_transactions(session, [TransactionCreate.model_validate_json(row.payload)])
+    except IdempotencyConflictError:
+        session.rollback()
+        finish(session, [row.id], FAILED, "Idempotency key already used with a different payload")
+    except Exception as e:
+        session.rollback()
+        _handle_failure(session, row, e)
+    else:
+        finish(session, [row.id], DONE)
+
+
+def _handle_failure(session: Session, row, error: Exception) -> None:
+    logger.exception("Ingest of queued transaction %s failed", row.transaction_id)
+    if row.attempts >= MAX_ATTEMPTS:
+        finish(session, [row.id], FAILED, str(error)[:500])
+    else:
+        # Back to the queue; the shopper's later rows wait behind it
+        session.exec(text("UPDATE ingestqueueitem SET status = 'queued' WHERE id = :id"), params={"id": row.id})
+        session.commit()
+
+
+def drain(session: Session, batch_size: int = 500) -> int:
+    """Processes batches until nothing is claimable. Returns rows processed."""
+    total = 0
+    while True:
+        claimed = process_batch(session, batch_size)
+        if not claimed:
+            return total
+        total += claimed
+
+
+# -----------------------------------------------------------------------------
+# C. Worker processes
+# -----------------------------------------------------------------------------
+def run_worker(batch_size: int, idle_sleep: float) -> None:
+    """One worker process: drain, sleep when idle, purge old finished rows now and then."""
+    configure_logging()
+    engine = get_engine()
+    engine.echo = False
+    last_purge = 0.0
+    with Session(engine) as session:
+        while True:
+            if not process_batch(session, batch_size):
+                if time.monotonic() - last_purge > 600:
+                    session.exec(PURGE_SQL, params={"hours": RETENTION_HOURS})
+                    session.commit()
+                    last_purge = time.monotonic()
+                time.sleep(idle_sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--idle-sleep", type=float, default=0.2, help="seconds to wait when the queue is empty")
+    args = parser.parse_args()
+
+    # Only the CLI needs it; the API imports this module for enqueue_stmt()
+    import multiprocessing
+
+    # spawn: each worker builds its own engine and connection pool
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(args.batch_size, args.idle_sleep), daemon=True)
+        for _ in range(args.processes)
+    ]
+    # SIGTERM (e.g. from a process manager) must take the workers down too;
+    # daemon=True only covers a normal exit of this supervisor.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == "__main__":
+    main()
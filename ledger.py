@@ -0,0 +1,260 @@
+"""
+Sticker ledger maintenance: seed, snapshot and rebuild balances.
+
+Usage:
+    python ledger.py seed                    # once, when the ledger is first deployed
+    python ledger.py snapshot                # also runs periodically inside the app
+    python ledger.py rebuild --chunk-size 5000 [--shopper-prefix store-7-]
+
+Shopper.sticker_balance is a projection of the ledger. `rebuild` recomputes
+it from the latest snapshot plus the entries after it, one chunk of shoppers
+at a time, and reports how many balances it corrected.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import Optional
+
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session
+
+import cache
+from database import get_engine
+from models import LedgerEntry
+
+logger = logging.getLogger(__name__)
+
+EARN = "earn"
+SPEND = "spend"
+OPENING = "opening"
+
+# The oldest transaction still in flight, as a bigint like LedgerEntry.xid.
+# Every entry written by an older transaction has committed (or never will),
+# so "xid below the horizon" is a set that no later commit can add to.
+# Ids and timestamps can't promise that: a slow writer commits id N (stamped
+# with its start time) after id N+1 is visible.
+HORIZON_SQL = "pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+# Serializes snapshot runs (every app worker has a snapshot task); arbitrary constant
+SNAPSHOT_LOCK_KEY = 7_245_003
+
+
+def entry_stmt():
+    """
+    Multi-row capable INSERT for ledger entries. Execute it with
+    {"shopper_id", "kind", "source_id", "delta"} dicts, in the same DB
+    transaction as the balance change they describe. Earn entries also
+    carry "source_timestamp" (see earn_stmt).
+    """
+    return insert(LedgerEntry)
+
+
+def earn_stmt():
+    """
+    entry_stmt for new transactions that doubles as their duplicate guard.
+    (kind, source_id) is unique, so a transaction_id that was already applied
+    inserts nothing and returns no row. The partitioned transaction table
+    can't enforce a unique transaction_id on its own. Pass the receipt's
+    "source_timestamp" too: it tells readers which month holds the receipt.
+    """
+    return (
+        pg_insert(LedgerEntry)
+        .on_conflict_do_nothing(constraint="uq_ledgerentry_source")
+        .returning(LedgerEntry.source_id)
+    )
+
+
+# -----------------------------------------------------------------------------
+# A. Seed: carry pre-ledger balances over as one "opening" entry per shopper
+# -----------------------------------------------------------------------------
+SEED_SQL = text("""
+    INSERT INTO ledgerentry (shopper_id, kind, source_id, delta, created_at)
+    SELECT s.shopper_id, :opening, s.shopper_id,
+           s.sticker_balance - COALESCE(SUM(l.delta), 0),
+           timezone('utc', now())
+    FROM shopper s
+    LEFT JOIN ledgerentry l ON l.shopper_id = s.shopper_id
+    GROUP BY s.shopper_id, s.sticker_balance
+    ON CONFLICT ON CONSTRAINT uq_ledgerentry_source DO NOTHING
+""")
+
+
+def seed_opening_entries(session: Session) -> int:
+    """
+    Gives every shopper an "opening" entry equal to the part of their balance
+    the ledger doesn't explain yet. Safe to re-run (at most one per shopper),
+    but meant to run once: run it later and it would also bake in any drift.
+    """
+    result = session.exec(SEED_SQL, params={"opening": OPENING})
+    session.commit()
+    return result.rowcount
+
+
+# -----------------------------------------------------------------------------
+# B. Snapshot: fold each shopper's new entries into their snapshot
+# -----------------------------------------------------------------------------
+# {since} picks the entries settled since the previous run: xid in
+# [previous horizon, this horizon). The first run also takes the entries from
+# before the xid column (NULL), which had all committed by then.
+SNAPSHOT_SQL = """
+    WITH horizon AS (SELECT {horizon} AS xid)
+    INSERT INTO balancesnapshot (shopper_id, balance, ledger_id, xid_horizon, taken_at)
+    SELECT l.shopper_id, COALESCE(s.balance, 0) + SUM(l.delta),
+           GREATEST(MAX(l.id), COALESCE(s.ledger_id, 0)), h.xid, timezone('utc', now())
+    FROM ledgerentry l
+    CROSS JOIN horizon h
+    LEFT JOIN balancesnapshot s ON s.shopper_id = l.shopper_id
+    WHERE {since}
+      AND (s.xid_horizon IS NULL OR l.xid >= s.xid_horizon)
+    GROUP BY l.shopper_id, s.balance, s.ledger_id, h.xid
+    ON CONFLICT (shopper_id) DO UPDATE
+    SET balance = excluded.balance, ledger_id = excluded.ledger_id,
+        xid_horizon = excluded.xid_horizon, taken_at = excluded.taken_at
+"""
+SNAPSHOT_SINCE_SQL = text(SNAPSHOT_SQL.format(
+    horizon=HORIZON_SQL, since="l.xid >= :previous AND l.xid < h.xid",
+))
+SNAPSHOT_FIRST_SQL = text(SNAPSHOT_SQL.format(
+    horizon=HORIZON_SQL, since="(l.xid < h.xid OR l.xid IS NULL)",
+))
+
+
+def take_snapshots(session: Session) -> int:
+    """
+    Folds every settled entry into its shopper's snapshot. Returns the
+    number of snapshots written.
+
+    Key Decisions:
+    - "Settled" means written by a transaction older than the oldest one
+      still in flight (HORIZON_SQL). An entry from a long-running writer
+      (a big batch or import chunk) waits for a later run instead of being
+      skipped, however long the writer stays open.
+    - Each snapshot records that horizon; rebuild adds the shopper's entries
+      at or above it. The previous run's horizon (the highest recorded) is
+      where this run starts, and ix_ledgerentry_xid makes that a range
+      scan, so the cost follows the write volume, not the ledger size.
+    - Runs take turns (advisory lock): two overlapping runs could otherwise
+      leave a shopper on the older horizon while the next run starts from
+      the newer one.
+    """
+    session.exec(text("SELECT pg_advisory_xact_lock(:key)"), params={"key": SNAPSHOT_LOCK_KEY})
+    previous = session.exec(text("SELECT MAX(xid_horizon) FROM balancesnapshot")).scalar_one()
+    if previous is None:
+        result = session.exec(SNAPSHOT_FIRST_SQL)
+    else:
+        result = session.exec(SNAPSHOT_SINCE_SQL, params={"previous": previous})
+    session.commit()
+    return result.rowcount
+
+
+async def snapshot_forever(interval_seconds: float) -> None:
+    """Background task: keeps snapshots recent so a rebuild has little to replay."""
+    def run_once():
+        with Session(get_engine()) as session:
+            return take_snapshots(session)
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            written = await asyncio.to_thread(run_once)
+            logger.info("Ledger snapshots written: %d", written)
+        except Exception:
+            logger.exception("Ledger snapshot failed")
+
+
+# -----------------------------------------------------------------------------
+# C. Rebuild: recompute Shopper.sticker_balance from snapshot + later entries
+# -----------------------------------------------------------------------------
+CHUNK_SQL = text("""
+    SELECT shopper_id FROM shopper
+    WHERE shopper_id > :after AND shopper_id LIKE :prefix
+    ORDER BY shopper_id
+    LIMIT :limit
+    FOR UPDATE
+""")
+
+REBUILD_SQL = text("""
+    WITH computed AS (
+        SELECT s.shopper_id,
+               COALESCE(snap.balance, 0) + COALESCE((
+                   SELECT SUM(l.delta) FROM ledgerentry l
+                   WHERE l.shopper_id = s.shopper_id
+                     AND (snap.shopper_id IS NULL OR l.xid >= snap.xid_horizon)
+               ), 0) AS balance,
+               COALESCE((
+                   SELECT SUM(b.balance) FROM balanceshard b WHERE b.shopper_id = s.shopper_id
+               ), 0) AS in_shards
+        FROM shopper s
+        LEFT JOIN balancesnapshot snap ON snap.shopper_id = s.shopper_id
+        WHERE s.shopper_id = ANY(:ids)
+    )
+    UPDATE shopper SET sticker_balance = computed.balance - computed.in_shards
+    FROM computed
+    WHERE shopper.shopper_id = computed.shopper_id
+      AND shopper.sticker_balance + computed.in_shards <> computed.balance
+    RETURNING shopper.shopper_id
+""")
+
+
+def rebuild_balances(session: Session, chunk_size: int = 5000, shopper_prefix: str = "", progress=None) -> int:
+    """
+    Streams over shoppers in keyset order and rewrites any balance that
+    disagrees with the ledger. Returns how many balances were corrected.
+
+    Key Decisions:
+    - Memory is bounded by chunk_size: only one chunk of shopper ids is ever
+      held in Python; the sums happen inside Postgres.
+    - Each chunk locks its shopper rows (FOR UPDATE) before summing. Writers
+      lock the shopper row before appending their entry, so a concurrent
+      earn or spend either finishes first (and is counted) or waits for us.
+    - Hot shoppers' shards are left alone; the difference goes into
+      Shopper.sticker_balance. A shard write appends its ledger entry
+      before committing, and the entry's foreign key check waits for our
+      row lock, so an in-flight shard write is either in both the shards
+      and the ledger, or in neither.
+    - One DB transaction per chunk keeps lock times short.
+    - Corrected shoppers are dropped from the balance cache.
+    """
+    after = ""
+    corrected = 0
+    while True:
+        ids = session.exec(CHUNK_SQL, params={
+            "after": after, "prefix": shopper_prefix + "%", "limit": chunk_size,
+        }).scalars().all()
+        if not ids:
+            return corrected
+        changed = session.exec(REBUILD_SQL, params={"ids": list(ids)}).scalars().all()
+        session.commit()
+
+        for shopper_id in changed:
+            cache.balance_cache.delete(shopper_id)
+        corrected += len(changed)
+        after = ids[-1]
+        if progress:
+            progress(after, corrected)
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["seed", "snapshot", "rebuild"])
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--shopper-prefix", default="", help="only rebuild shoppers whose id starts with this")
+    args = parser.parse_args(argv)
+
+    with Session(get_engine()) as session:
+        if args.command == "seed":
+            print(f"{seed_opening_entries(session)} opening entries written")
+        elif args.command == "snapshot":
+            print(f"{take_snapshots(session)} snapshots written")
+        else:
+            corrected = rebuild_balances(
+                session, args.chunk_size, args.shopper_prefix,
+                progress=lambda after, n: print(f"   up to {after}: {n} corrected", file=sys.stderr),
+            )
+            print(f"{corrected} balances corrected")
+
+
+if __name__ == "__main__":
+    main()
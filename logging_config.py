@@ -0,0 +1,107 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# -----------------------------------------------------------------------------
+# Non-blocking, structured logging
+#
+# Request handlers only build a LogRecord and drop it on a queue. A single
+# background thread (QueueListener) does the formatting and the I/O, so a
+# slow terminal or disk never adds latency to /transactions.
+# -----------------------------------------------------------------------------
+
+# Attributes every LogRecord has; anything else came from `extra=` and is
+# emitted as a structured field.
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sampled"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any `extra` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS})
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class SuccessSampler(logging.Filter):
+    """
+    Keeps only a fraction of high-volume success lines.
+    Log them with extra={"sampled": True}; everything else always passes.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    The stock QueueHandler formats the message before enqueueing it (on the
+    request thread). We hand over the record untouched; %-style args are
+    merged later, on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_listener = None
+
+
+def configure_logging(stream=None) -> None:
+    """
+    Wires the root logger to a queue + background listener.
+
+    Environment:
+    - LOG_LEVEL: default INFO
+    - LOG_FORMAT: json (default) or text
+    - LOG_SUCCESS_SAMPLE_RATE: fraction of success lines kept, default 0.01
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    if os.getenv("LOG_FORMAT", "json") == "text":
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    else:
+        formatter = JsonFormatter()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SuccessSampler(float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "0.01"))))
+
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if isinstance(h, DeferredQueueHandler)]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def _flush_on_exit() -> None:
+    if _listener is not None:
+        _listener.stop()
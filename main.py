@@ -1,40 +1,123 @@
+import asyncio
+import base64
 import logging  # <--- NEW: Python's logging tool
-from fastapi import FastAPI, Depends, HTTPException, Request, status
+import os
+import tempfile
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from datetime import datetime
+from sqlalchemy import insert, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlmodel import Session, select
-from typing import List
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Optional
+import orjson
 
 # Import our modules
-from database import create_db_and_tables, get_session
-from models import Transaction, Shopper, Item, Redemption
-from schemas import TransactionCreate, TransactionResponse, ItemCreate, RedemptionRequest, RedemptionResponse
-from services import calculate_stickers
+from database import get_engine, get_session, get_async_session
+from models import Transaction, Item, Redemption, IngestQueueItem
+from schemas import TransactionCreate, TransactionResponse, RedemptionRequest, RedemptionResponse, to_naive_utc
+from services import calculate_stickers, rule_engine
+from logging_config import configure_logging
+from ingest import ingest_transactions
+from balances import balance_stmt, credit_stmt, debit_stmt
+import hot_shoppers
+import ledger
+import migrations
+import rewards
+from rewards import reward_catalog
+import ingest_queue
+import cache
+import idempotency
+from catalog import basket_total_of, catalog, item_rows, items_by_transaction, items_stmt
+import serialization
+from serialization import ORJSONResponse
+from idempotency import IdempotencyConflictError, StoredResponse
+import metrics
+from metrics import StageTimer
 
-# The Hardcoded Price List
-REWARD_OPTIONS = {
-    "MUG": 10,
-    "TOTE": 20,
-    "HOODIE": 50,
-    "STICKER_PACK": 5,
-    "FERARI": 10000
-}
+# "sync" applies every transaction inside the request. "queue" only validates
+# and enqueues it (202 + status URL) and ingest_queue.py workers apply it.
+# Clients can also opt in per request with the "Prefer: respond-async" header.
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
 
 # -----------------------------------------------------------------------------
 # 1. SETUP LOGGING (The "Black Box" Recorder)
 # -----------------------------------------------------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+# Formatting and I/O happen on a background thread (see logging_config.py).
+# Hot paths use %-style args so messages are only built if actually emitted.
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Looplink Sticker Engine")
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.on_event("startup")
 def on_startup():
-    create_db_and_tables()
-    logger.info("✅ Application Startup: Database tables checked.")
+    # Tables belong to `python migrations.py upgrade`, run once per deploy.
+    # A worker only reads the schema version (and refuses to serve an older
+    # schema), so a fleet restart never turns into a burst of DDL checks.
+    version = migrations.check(get_engine())
+    reward_catalog.refresh(get_engine())
+    hot_shoppers.directory.refresh(get_engine())
+    logger.info("Application startup: schema version %d", version)
+
+@app.on_event("startup")
+async def start_rules_watcher():
+    # Re-reads rules.json when it changes, so rule edits need no redeploy.
+    # Set STICKER_RULES_WATCH_SECONDS=0 to only reload via POST /rules/reload.
+    interval = float(os.getenv("STICKER_RULES_WATCH_SECONDS", "10"))
+    if interval > 0:
+        app.state.rules_watcher = asyncio.create_task(rule_engine.watch(interval))
+
+@app.on_event("startup")
+async def start_reward_catalog_watcher():
+    # Checks the reward catalog's version and reloads it when another process
+    # edited it. 0 disables (then only POST /rewards/reload picks up edits).
+    if rewards.CHECK_SECONDS > 0:
+        app.state.reward_catalog_watcher = asyncio.create_task(reward_catalog.watch(get_engine(), rewards.CHECK_SECONDS))
+
+@app.on_event("startup")
+async def start_ledger_snapshots():
+    # Folds new ledger entries into per-shopper snapshots, so a balance
+    # rebuild only replays recent entries. 0 disables (e.g. run the CLI from cron).
+    interval = float(os.getenv("LEDGER_SNAPSHOT_SECONDS", "3600"))
+    if interval > 0:
+        app.state.ledger_snapshots = asyncio.create_task(ledger.snapshot_forever(interval))
+
+@app.on_event("startup")
+async def start_partition_maintenance():
+    # Creates next months' Transaction / Item partitions ahead of time: once
+    # within a minute of startup, then daily. 0 disables (e.g. run the CLI from cron).
+    interval = float(os.getenv("PARTITION_MAINTENANCE_SECONDS", "86400"))
+    if interval > 0:
+        import partitions
+        app.state.partition_maintenance = asyncio.create_task(partitions.maintain_forever(get_engine(), interval))
+
+@app.on_event("startup")
+async def start_analytics_rollups():
+    # Folds new transactions into the /analytics rollups in micro-batches.
+    # 0 disables (e.g. run `python analytics.py update` from cron).
+    interval = float(os.getenv("ANALYTICS_ROLLUP_SECONDS", "60"))
+    if interval > 0:
+        import analytics
+        app.state.analytics_rollups = asyncio.create_task(analytics.rollup_forever(interval))
+
+@app.on_event("startup")
+async def start_hot_shopper_maintenance():
+    # Promotes contended shoppers to sharded balances (HOT_SHOPPER_AUTO_PROMOTE=1)
+    # and reloads the shard directory after any worker's promotion. 0 disables.
+    if hot_shoppers.CHECK_SECONDS > 0:
+        app.state.hot_shoppers = asyncio.create_task(hot_shoppers.maintain(get_engine(), hot_shoppers.CHECK_SECONDS))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for name in ("rules_watcher", "reward_catalog_watcher", "ledger_snapshots", "partition_maintenance",
+                 "analytics_rollups", "hot_shoppers"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
 
 # -----------------------------------------------------------------------------
 # 2. THE SECURITY CAMERA (Validation Exception Handler)
@@ -61,8 +144,9 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         clean_errors.append(f"Field '{field_path}': {message}")
 
     # 2. Log the clean errors (so you can read them easily in the terminal)
-    logger.error(f"❌ VALIDATION FAILED at {request.url}")
-    logger.error(f"   Issues: {clean_errors}")
+    logger.error("Validation failed", extra={"path": request.url.path, "issues": clean_errors})
+    route = request.scope.get("route")
+    metrics.VALIDATION_FAILURES.inc(route.path if route is not None else "unmatched")
     
     # 3. Send the clean list to the user
     return JSONResponse(
@@ -76,176 +160,711 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 # -----------------------------------------------------------------------------
 # ENDPOINT 1: Ingest Transaction
 # -----------------------------------------------------------------------------
-@app.post("/transactions", response_model=TransactionResponse, status_code=201)
-def create_transaction(
-    transaction_in: TransactionCreate, 
-    session: Session = Depends(get_session)
+async def read_balance(session: AsyncSession, shopper_id: str) -> Optional[int]:
+    """
+    Read-through balance lookup: the cache first, Postgres on a miss
+    (which then fills the cache). Returns None for unknown shoppers.
+    """
+    balance = await cache.balance_cache.aget(shopper_id)
+    if balance is None:
+        balance = (await session.exec(balance_stmt(shopper_id))).scalar_one_or_none()
+        if balance is None:
+            return None
+        await cache.balance_cache.aset(shopper_id, balance)
+    return balance
+
+async def find_stored_response(session: AsyncSession, kind: str, key: str) -> Optional[StoredResponse]:
+    """One key lookup: the in-memory layer first, then the idempotency table."""
+    stored = idempotency.cached(kind, key)
+    if stored is None:
+        rows = (await session.exec(idempotency.lookup_stmt(kind, [key]))).all()
+        if rows:
+            stored = idempotency.rows_to_stored(rows)[key]
+            idempotency.remember(kind, key, stored)
+    return stored
+
+def replay_stored_response(stored: StoredResponse, payload_hash: str, kind: str, key: str) -> Response:
+    """Returns the original response, unless the payload changed since then."""
+    if stored.request_hash != payload_hash:
+        logger.error("Idempotency conflict: %s was already used with a different payload", key)
+        raise HTTPException(status_code=409, detail="Idempotency key already used with a different payload")
+    logger.warning("Duplicate detected: %s, returning stored response", key)
+    metrics.DUPLICATES.inc(kind)
+    return Response(content=stored.response, status_code=201, media_type="application/json")
+
+async def replay_transaction(session: AsyncSession, transaction_id: str, timestamp: datetime) -> TransactionResponse:
+    """
+    Builds the response for a transaction that was already processed
+    but has no idempotency record (written before the record table existed).
+    The retry's timestamp selects the one monthly partition to look in.
+    """
+    metrics.DUPLICATES.inc(idempotency.TRANSACTION)
+    existing_tx = (await session.exec(
+        select(Transaction).where(
+            Transaction.transaction_id == transaction_id,
+            Transaction.timestamp == timestamp,
+        )
+    )).first()
+    if existing_tx is None:
+        # Applied long ago and its month archived since (partitions.py), or
+        # the "retry" names another time: either way we can't rebuild it
+        raise HTTPException(status_code=409, detail="Transaction was already processed")
+    return TransactionResponse(
+        transaction_id=existing_tx.transaction_id,
+        shopper_id=existing_tx.shopper_id,
+        store_id=existing_tx.store_id,
+        basket_total=existing_tx.basket_total,
+        stickers_awarded=existing_tx.stickers_awarded,
+        shopper_sticker_balance=await read_balance(session, existing_tx.shopper_id)
+    )
+
+async def enqueue_transaction(session: AsyncSession, transaction_in: TransactionCreate, payload_hash: str) -> ORJSONResponse:
+    """
+    Queue mode: one INSERT, then 202. A retry of a queued transaction gets the
+    same answer; a retry with a different payload gets 409, like in sync mode.
+    """
+    result = await session.exec(ingest_queue.enqueue_stmt(), params={
+        "transaction_id": transaction_in.transaction_id,
+        "shopper_id": transaction_in.shopper_id,
+        "request_hash": payload_hash,
+        "payload": transaction_in.model_dump_json()
+    })
+    queue_status = ingest_queue.QUEUED
+    if result.first() is None:
+        await session.rollback()
+        existing = (await session.exec(
+            select(IngestQueueItem.request_hash, IngestQueueItem.status)
+            .where(IngestQueueItem.transaction_id == transaction_in.transaction_id)
+        )).one()
+        if existing.request_hash != payload_hash:
+            logger.error("Idempotency conflict: %s was already used with a different payload", transaction_in.transaction_id)
+            raise HTTPException(status_code=409, detail="Idempotency key already used with a different payload")
+        metrics.DUPLICATES.inc(idempotency.TRANSACTION)
+        queue_status = existing.status
+    else:
+        await session.commit()
+
+    url = ingest_queue.status_url(transaction_in.transaction_id)
+    return ORJSONResponse(
+        status_code=202,
+        content={"transaction_id": transaction_in.transaction_id, "status": queue_status, "status_url": url},
+        headers={"Location": url},
+    )
+
+@app.post(
+    "/transactions", response_model=TransactionResponse, status_code=201,
+    openapi_extra=serialization.request_body_schema(TransactionCreate),
+)
+async def create_transaction(
+    transaction_in: TransactionCreate = Depends(serialization.transaction_body),
+    session: AsyncSession = Depends(get_async_session),
+    prefer: Optional[str] = Header(default=None)
 ):
     # Log the attempt
-    logger.info(f"📥 Processing Transaction: {transaction_in.transaction_id} for {transaction_in.shopper_id}")
-
-    # A. Idempotency Check
-    existing_tx = session.get(Transaction, transaction_in.transaction_id)
-    if existing_tx:
-        logger.warning(f"⚠️ Duplicate Transaction detected: {transaction_in.transaction_id}. Returning existing.")
-        return TransactionResponse(
-            transaction_id=existing_tx.transaction_id,
-            shopper_id=existing_tx.shopper_id,
-            store_id=existing_tx.store_id,
-            basket_total=existing_tx.basket_total,
-            stickers_awarded=existing_tx.stickers_awarded,
-            shopper_sticker_balance=existing_tx.shopper.sticker_balance
-        )
+    logger.debug("Processing transaction %s for %s", transaction_in.transaction_id, transaction_in.shopper_id)
+    timer = StageTimer("create_transaction")
+    payload_hash = idempotency.request_hash(transaction_in)
+
+    # Queue mode: accept now, apply later (see ingest_queue.py)
+    if INGEST_MODE == "queue" or (prefer and "respond-async" in prefer):
+        response = await enqueue_transaction(session, transaction_in, payload_hash)
+        timer.mark("enqueue")
+        return response
+
+    # A. Idempotency Check (one key lookup, no ORM objects). First, so a
+    #    POS retry costs nothing more.
+    stored = await find_stored_response(session, idempotency.TRANSACTION, transaction_in.transaction_id)
+    timer.mark("idempotency_lookup")
+    if stored:
+        return replay_stored_response(stored, payload_hash, idempotency.TRANSACTION, transaction_in.transaction_id)
+
+    # Catalog ids for the item lines (in-process LRU; misses interned once).
+    # Interning uses a connection of its own, so on a miss we first hand back
+    # the one the lookup may have taken: a request never holds two at once.
+    item_ids = catalog.cached(transaction_in.items)
+    if item_ids is None:
+        await session.rollback()
+        item_ids = await catalog.resolve_async(session, transaction_in.items)
+    timer.mark("catalog_lookup")
 
     # B. Calculate
-    basket_total = sum(item.unit_price * item.quantity for item in transaction_in.items)
-    stickers_earned = calculate_stickers(basket_total, transaction_in.items)
-
-    # C. Handle Shopper
-    shopper = session.get(Shopper, transaction_in.shopper_id)
-    if not shopper:
-        logger.info(f"   New Shopper detected: {transaction_in.shopper_id}")
-        shopper = Shopper(shopper_id=transaction_in.shopper_id, sticker_balance=0)
-        session.add(shopper)
-    
-    shopper.sticker_balance += stickers_earned
-    session.add(shopper)
-
-    # D. Save Transaction
-    db_transaction = Transaction(
-        transaction_id=transaction_in.transaction_id,
-        shopper_id=transaction_in.shopper_id,
-        store_id=transaction_in.store_id,
-        timestamp=transaction_in.timestamp,
-        basket_total=basket_total,
-        stickers_awarded=stickers_earned
+    basket_total = basket_total_of(transaction_in.items)
+    stickers_earned = calculate_stickers(
+        basket_total, transaction_in.items, transaction_in.store_id, transaction_in.timestamp
     )
-    session.add(db_transaction)
+    timer.mark("calculate_stickers")
 
-    # E. Save Items
-    for item_in in transaction_in.items:
-        db_item = Item(
+    try:
+        # C. Upsert Shopper & add stickers in ONE statement (no read-modify-write).
+        #    Hot shoppers shared by many tills add to one of their balance
+        #    shards instead, so their receipts don't queue on one row lock.
+        new_balance = None
+        shards = hot_shoppers.directory.shards.get(transaction_in.shopper_id)
+        if shards:
+            new_balance = await hot_shoppers.credit(session, transaction_in.shopper_id, stickers_earned, shards)
+        if new_balance is None:
+            result = await session.exec(
+                credit_stmt(),
+                params={"shopper_id": transaction_in.shopper_id, "sticker_balance": stickers_earned},
+            )
+            new_balance = result.one().sticker_balance
+        waited = timer.mark("shopper_upsert")
+        if not shards:
+            hot_shoppers.detector.record(transaction_in.shopper_id, waited)
+
+        # D. Append the ledger entry for this balance change. It is also the
+        #    duplicate guard: ON CONFLICT DO NOTHING on (kind, source_id), so if
+        #    a concurrent retry got here first, undo our credit and answer
+        #    like any other duplicate.
+        result = await session.exec(ledger.earn_stmt(), params={
+            "shopper_id": transaction_in.shopper_id,
+            "kind": ledger.EARN,
+            "source_id": transaction_in.transaction_id,
+            "source_timestamp": transaction_in.timestamp,
+            "delta": stickers_earned
+        })
+        timer.mark("ledger_insert")
+        if result.first() is None:
+            await session.rollback()
+            stored = await find_stored_response(session, idempotency.TRANSACTION, transaction_in.transaction_id)
+            if stored:
+                return replay_stored_response(stored, payload_hash, idempotency.TRANSACTION, transaction_in.transaction_id)
+            logger.warning("Duplicate transaction detected: %s, returning existing", transaction_in.transaction_id)
+            return await replay_transaction(session, transaction_in.transaction_id, transaction_in.timestamp)
+
+        # D2. Save Transaction (routed to its month's partition)
+        await session.exec(
+            insert(Transaction).values(
+                transaction_id=transaction_in.transaction_id,
+                shopper_id=transaction_in.shopper_id,
+                store_id=transaction_in.store_id,
+                timestamp=transaction_in.timestamp,
+                basket_total=basket_total,
+                stickers_awarded=stickers_earned
+            )
+        )
+        timer.mark("transaction_insert")
+
+        # E. Save Items (one multi-row insert, integers only)
+        if transaction_in.items:
+            await session.exec(
+                insert(Item),
+                params=item_rows(transaction_in.transaction_id, transaction_in.timestamp, transaction_in.items, item_ids)
+            )
+        timer.mark("item_insert")
+
+        # F. Remember the response (same DB transaction as the writes)
+        response = TransactionResponse(
             transaction_id=transaction_in.transaction_id,
-            sku=item_in.sku,
-            name=item_in.name,
-            category=item_in.category,
-            quantity=item_in.quantity,
-            unit_price=item_in.unit_price
+            shopper_id=transaction_in.shopper_id,
+            store_id=transaction_in.store_id,
+            basket_total=basket_total,
+            stickers_awarded=stickers_earned,
+            shopper_sticker_balance=new_balance
+        )
+        stored = StoredResponse(payload_hash, response.model_dump_json())
+        timer.mark("serialize")
+        await session.exec(idempotency.record_stmt(), params={
+            "kind": idempotency.TRANSACTION,
+            "key": transaction_in.transaction_id,
+            "request_hash": stored.request_hash,
+            "response": stored.response
+        })
+        timer.mark("idempotency_record")
+
+        await session.commit()
+        timer.mark("commit")
+        await cache.balance_cache.aset(transaction_in.shopper_id, new_balance)
+        idempotency.remember(idempotency.TRANSACTION, transaction_in.transaction_id, stored)
+        logger.info(
+            "Transaction %s awarded %d stickers, balance %d",
+            transaction_in.transaction_id, stickers_earned, new_balance,
+            extra={"sampled": True},
         )
-        session.add(db_item)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Database error for transaction %s", transaction_in.transaction_id)
+        raise HTTPException(status_code=500, detail="Database commit failed")
+
+    return Response(content=stored.response, status_code=201, media_type="application/json")
+
+@app.get("/transactions/{transaction_id}/status")
+async def get_transaction_status(
+    transaction_id: str,
+    session: AsyncSession = Depends(get_async_session)
+):
+    """
+    Where a transaction is: queued, processing, done (with the same body
+    POST /transactions would have returned) or failed (with the reason).
+    """
+    item = (await session.exec(
+        select(IngestQueueItem.status, IngestQueueItem.error)
+        .where(IngestQueueItem.transaction_id == transaction_id)
+    )).first()
+
+    stored = None
+    if item is None or item.status == ingest_queue.DONE:
+        # Applied (by a worker, or synchronously without the queue)
+        stored = await find_stored_response(session, idempotency.TRANSACTION, transaction_id)
+    if item is None and stored is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+
+    return ORJSONResponse({
+        "transaction_id": transaction_id,
+        "status": ingest_queue.DONE if stored else item.status,
+        "error": item.error if item else None,
+        "result": orjson.loads(stored.response) if stored else None
+    })
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 1b: Bulk Ingest (End-of-day POS replays)
+# -----------------------------------------------------------------------------
+@app.post(
+    "/transactions/batch", response_model=List[TransactionResponse], status_code=201,
+    openapi_extra=serialization.request_body_schema(serialization.transaction_list_adapter),
+)
+def create_transactions_batch(
+    transactions_in: List[TransactionCreate] = Depends(serialization.transaction_list_body),
+    session: Session = Depends(get_session)
+):
+    logger.info("Processing batch of %d transactions", len(transactions_in))
 
     try:
-        session.commit()
-        session.refresh(db_transaction)
-        logger.info(f"✅ Success: Awarded {stickers_earned} stickers. New Balance: {shopper.sticker_balance}")
-    except Exception as e:
-        logger.error(f"❌ DATABASE ERROR: {e}")
+        responses = ingest_transactions(session, transactions_in)
+    except IdempotencyConflictError as e:
+        logger.error("Idempotency conflict in batch: %s", e.keys)
+        raise HTTPException(status_code=409, detail=f"Idempotency key already used with a different payload: {e.keys}")
+    except Exception:
+        logger.exception("Database error for batch of %d transactions", len(transactions_in))
         raise HTTPException(status_code=500, detail="Database commit failed")
 
-    return TransactionResponse(
-        transaction_id=db_transaction.transaction_id,
-        shopper_id=db_transaction.shopper_id,
-        store_id=db_transaction.store_id,
-        basket_total=db_transaction.basket_total,
-        stickers_awarded=db_transaction.stickers_awarded,
-        shopper_sticker_balance=shopper.sticker_balance
+    logger.info("Batch processed: %d transactions", len(responses))
+    # Our own models: encode once, no response_model re-validation
+    return Response(
+        content=serialization.transaction_response_list_adapter.dump_json(responses),
+        status_code=201,
+        media_type="application/json",
     )
 
+# -----------------------------------------------------------------------------
+# ENDPOINT 1c: File Import & Export (Onboarding Stores, Data Requests)
+# -----------------------------------------------------------------------------
+@app.post("/transactions/import")
+async def import_transactions_file(request: Request, format: Optional[str] = None):
+    """
+    Streams an NDJSON or CSV file of receipts (formats: see transfer.py) into
+    the database chunk by chunk; the body is never held in memory. The
+    response is NDJSON: a summary line, then one line per rejected record.
+    Sending the same file again is safe.
+    """
+    import transfer
+
+    content_type = request.headers.get("content-type", "")
+    fmt = format or ("csv" if content_type.startswith("text/csv") else "ndjson")
+    if fmt not in transfer.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format. Valid options: {list(transfer.FORMATS)}")
+
+    # Rejected rows stay in memory up to 1 MB, then spill to a temp file
+    rejects = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+    progress = {}
+
+    def log_progress(report):
+        progress.update(report)
+        logger.info("Import: %d read, %d accepted, %d rejected", report["records"], report["accepted"], report["rejected"])
+
+    try:
+        report = await asyncio.to_thread(
+            transfer.import_transactions,
+            transfer.blocking_chunks(request.stream(), asyncio.get_running_loop()), fmt, rejects,
+            progress=log_progress,
+        )
+    except transfer.TransferFormatError as e:
+        rejects.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        rejects.close()
+        logger.exception("Import failed after %d accepted receipts", progress.get("accepted", 0))
+        raise HTTPException(status_code=500, detail=f"Import failed after {progress.get('accepted', 0)} "
+                                                    "accepted receipts; sending the file again resumes it")
+
+    rejects.seek(0)
+
+    def body():
+        with rejects:
+            yield serialization.dumps(report) + b"\n"
+            yield from transfer.read_chunks(rejects)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def export_response(kind: str, shopper_id: Optional[str], start: Optional[datetime],
+                    end: Optional[datetime], fmt: str) -> StreamingResponse:
+    import transfer
+
+    if fmt not in transfer.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format. Valid options: {list(transfer.FORMATS)}")
+    if shopper_id is None and (start is None or end is None):
+        raise HTTPException(status_code=400, detail="Give a shopper_id, or both start and end")
+    start = to_naive_utc(start) if start else None
+    end = to_naive_utc(end) if end else None
+
+    def body():
+        # Sync generator: Starlette runs each step in the threadpool, and the
+        # server-side cursor lives as long as the download
+        with get_engine().connect() as connection:
+            yield from transfer.export_blocks(connection, kind, fmt, shopper_id, start, end)
+
+    return StreamingResponse(
+        body(), media_type="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{fmt}"'},
+    )
+
+@app.get("/transactions/export")
+async def export_transactions(shopper_id: Optional[str] = None, start: Optional[datetime] = None,
+                              end: Optional[datetime] = None, format: str = "ndjson"):
+    """A shopper's or a time range's receipts with their items, streamed (importable again)."""
+    return export_response("transactions", shopper_id, start, end, format)
+
+@app.get("/redemptions/export")
+async def export_redemptions(shopper_id: Optional[str] = None, start: Optional[datetime] = None,
+                             end: Optional[datetime] = None, format: str = "ndjson"):
+    """A shopper's or a time range's redemptions, streamed."""
+    return export_response("redemptions", shopper_id, start, end, format)
+
 # -----------------------------------------------------------------------------
 # ENDPOINT 2: Get Shopper Status
 # -----------------------------------------------------------------------------
+def encode_cursor(tx: Transaction) -> str:
+    """Opaque page cursor: the (timestamp, transaction_id) of the last row served."""
+    raw = f"{tx.timestamp.isoformat()}|{tx.transaction_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(timestamp), transaction_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.get("/shoppers/{shopper_id}")
-def get_shopper(shopper_id: str, session: Session = Depends(get_session)):
-    logger.info(f"🔍 Fetching data for Shopper: {shopper_id}")
+async def get_shopper(
+    shopper_id: str,
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    include_items: bool = False,
+    balance_only: bool = False,
+    session: AsyncSession = Depends(get_async_session)
+):
+    """
+    Returns the shopper's balance and one page of their history (newest first).
+
+    - Pass the returned `next_cursor` back as `cursor` to get the next page.
+    - `include_items=true` loads each transaction's items in one extra query.
+    - `balance_only=true` skips the transactions table entirely.
+    """
+    logger.debug("Fetching data for shopper %s", shopper_id)
     
-    shopper = session.get(Shopper, shopper_id)
-    if not shopper:
-        logger.warning(f"❌ Shopper not found: {shopper_id}")
+    balance = await read_balance(session, shopper_id)
+    if balance is None:
+        logger.warning("Shopper not found: %s", shopper_id)
         raise HTTPException(status_code=404, detail="Shopper not found")
-    
-    return {
-        "shopper_id": shopper.shopper_id,
-        "sticker_balance": shopper.sticker_balance,
-        "transactions": shopper.transactions
-    }
+
+    if balance_only:
+        return ORJSONResponse({"shopper_id": shopper_id, "sticker_balance": balance})
+
+    # Keyset pagination on (timestamp, transaction_id), served by
+    # ix_transaction_shopper_history. We fetch one extra row to know
+    # whether another page exists.
+    query = (
+        select(Transaction)
+        .where(Transaction.shopper_id == shopper_id)
+        .order_by(Transaction.timestamp.desc(), Transaction.transaction_id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        cursor_ts, cursor_id = decode_cursor(cursor)
+        # The row comparison is the exact bound; the plain one on timestamp is
+        # what Postgres can prune partitions with (newer months are skipped)
+        query = query.where(
+            Transaction.timestamp <= cursor_ts,
+            tuple_(Transaction.timestamp, Transaction.transaction_id) < (cursor_ts, cursor_id),
+        )
+
+    transactions = (await session.exec(query)).all()
+    next_cursor = encode_cursor(transactions[limit - 1]) if len(transactions) > limit else None
+    transactions = transactions[:limit]
+
+    # Plain dicts straight to orjson (no jsonable_encoder walk per object)
+    if include_items:
+        # One query for the page's items, with the catalog strings joined back in
+        rows = (await session.exec(items_stmt(transactions))).all()
+        items = items_by_transaction(rows)
+        history = [
+            {**tx.model_dump(), "items": items.get(tx.transaction_id, [])}
+            for tx in transactions
+        ]
+    else:
+        history = [tx.model_dump() for tx in transactions]
+
+    return ORJSONResponse({
+        "shopper_id": shopper_id,
+        "sticker_balance": balance,
+        "transactions": history,
+        "next_cursor": next_cursor
+    })
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 2b: Balance Cache Counters
+# -----------------------------------------------------------------------------
+@app.get("/cache/stats")
+def get_cache_stats():
+    return cache.balance_cache.stats()
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 2c: Prometheus Metrics
+# -----------------------------------------------------------------------------
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 2d: Readiness
+# -----------------------------------------------------------------------------
+# Answered only after the startup hooks ran (schema checked, reward catalog
+# loaded), and without a query, so load balancers can poll it freely.
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
 
 # -----------------------------------------------------------------------------
 # ENDPOINT 3: View Rewards Menu
 # -----------------------------------------------------------------------------
 @app.get("/rewards")
-def get_rewards():
-    logger.info("🔍 Fetching rewards list")
-    return REWARD_OPTIONS
+async def get_rewards(if_none_match: Optional[str] = Header(default=None)):
+    """
+    The reward menu ({code: cost}) from the in-process snapshot. The ETag is
+    the catalog version, so clients can revalidate with If-None-Match and
+    get an empty 304 until the menu changes.
+    """
+    snapshot = reward_catalog.active
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if if_none_match and snapshot.etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+@app.post("/rewards/reload")
+def reload_rewards():
+    # Immediate refresh on this worker; the others pick the edit up on their next check
+    snapshot = reward_catalog.refresh(get_engine(), force=True)
+    return {"version": snapshot.version}
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 3b: Earn Rules (view & hot reload)
+# -----------------------------------------------------------------------------
+@app.get("/rules")
+def get_rules():
+    return {"version": rule_engine.active.version}
+
+@app.post("/rules/reload")
+def reload_rules():
+    # In-flight requests finish on the rules they started with
+    compiled = rule_engine.reload()
+    return {"version": compiled.version}
+
+# -----------------------------------------------------------------------------
+# ENDPOINT 3c: Analytics (served from the rollups, never the receipt tables)
+# -----------------------------------------------------------------------------
+# analytics.py, like transfer.py and partitions.py, is imported where it is
+# first used: it serves a few report and admin calls, and `import main` is
+# on every worker's (and every CLI's) cold start.
+def analytics_range(start: datetime, end: datetime):
+    import analytics
+
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    problem = analytics.check_range(start, end)
+    if problem:
+        raise HTTPException(status_code=400, detail=f"Invalid range: {problem}")
+    return start, end
+
+async def analytics_as_of(session: AsyncSession) -> dict:
+    import analytics
+
+    state = (await session.exec(analytics.state_stmt())).first()
+    return {"xid_horizon": state.xid_horizon if state else None, "updated_at": state.updated_at if state else None}
+
+@app.get("/analytics/stores/{store_id}/hourly")
+async def get_store_hourly(
+    store_id: str,
+    start: datetime,
+    end: datetime,
+    session: AsyncSession = Depends(get_async_session)
+):
+    """
+    One row per hour in [start, end) that had receipts: transactions, basket
+    total, stickers awarded and promo units. `as_of` tells how fresh it is.
+    """
+    import analytics
+
+    start, end = analytics_range(start, end)
+    rows = (await session.exec(analytics.store_hours_stmt(store_id, start, end))).all()
+    return ORJSONResponse({
+        "store_id": store_id,
+        "hours": [analytics.store_hour_dict(row) for row in rows],
+        "as_of": await analytics_as_of(session)
+    })
+
+@app.get("/analytics/categories")
+async def get_category_totals(
+    start: datetime,
+    end: datetime,
+    store_id: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session)
+):
+    """Units, sales and item lines per category in [start, end), for one store or all."""
+    import analytics
+
+    start, end = analytics_range(start, end)
+    rows = (await session.exec(analytics.category_totals_stmt(start, end, store_id))).all()
+    return ORJSONResponse({
+        "store_id": store_id,
+        "categories": [analytics.category_total_dict(row) for row in rows],
+        "as_of": await analytics_as_of(session)
+    })
 
 # -----------------------------------------------------------------------------
 # ENDPOINT 4: Redeem Stickers
 # -----------------------------------------------------------------------------
 
-@app.post("/redemptions", response_model=RedemptionResponse, status_code=201)
-def redeem_rewards(
-    redemption_in: RedemptionRequest, 
-    session: Session = Depends(get_session)
+async def replay_redemption(session: AsyncSession, redemption_id: str) -> RedemptionResponse:
+    """
+    Builds the response for a redemption that was already processed
+    but has no idempotency record (written before the record table existed).
+    """
+    metrics.DUPLICATES.inc(idempotency.REDEMPTION)
+    existing_tx = await session.get(Redemption, redemption_id)
+    return RedemptionResponse(
+        redemption_id=existing_tx.redemption_id,
+        shopper_id=existing_tx.shopper_id,
+        reward_code=existing_tx.reward_code,
+        stickers_spent=existing_tx.stickers_spent,
+        shopper_sticker_balance=await read_balance(session, existing_tx.shopper_id),
+        timestamp=existing_tx.timestamp 
+    )
+
+@app.post(
+    "/redemptions", response_model=RedemptionResponse, status_code=201,
+    openapi_extra=serialization.request_body_schema(RedemptionRequest),
+)
+async def redeem_rewards(
+    redemption_in: RedemptionRequest = Depends(serialization.redemption_body),
+    session: AsyncSession = Depends(get_async_session)
 ):
-    logger.info(f"📥 Processing Redemption: {redemption_in.reward_code} for {redemption_in.shopper_id}")
-
-    # A. Idempotency Check
-    existing_tx = session.get(Redemption, redemption_in.redemption_id)
-    if existing_tx:
-        logger.warning(f"⚠️ Duplicate Redemption: {redemption_in.redemption_id}")
-        shopper = session.get(Shopper, existing_tx.shopper_id)
-        return RedemptionResponse(
-            redemption_id=existing_tx.redemption_id,
-            shopper_id=existing_tx.shopper_id,
-            reward_code=existing_tx.reward_code,
-            stickers_spent=existing_tx.stickers_spent,
-            shopper_sticker_balance=shopper.sticker_balance,
-            timestamp=existing_tx.timestamp 
-        )
+    logger.debug("Processing redemption %s for %s", redemption_in.reward_code, redemption_in.shopper_id)
 
-    # B. Validate Reward Code
-    if redemption_in.reward_code not in REWARD_OPTIONS:
-        valid_codes = list(REWARD_OPTIONS.keys())
+    # A. Idempotency Check (one key lookup, no ORM objects)
+    payload_hash = idempotency.request_hash(redemption_in)
+    stored = await find_stored_response(session, idempotency.REDEMPTION, redemption_in.redemption_id)
+    if stored:
+        return replay_stored_response(stored, payload_hash, idempotency.REDEMPTION, redemption_in.redemption_id)
+
+    # B. Validate Reward Code (in-memory catalog snapshot, no query)
+    reward = reward_catalog.active.options.get(redemption_in.reward_code)
+    if reward is None:
+        valid_codes = list(reward_catalog.active.options)
         raise HTTPException(status_code=400, detail=f"Invalid Reward Code. Valid options: {valid_codes}")
 
-    # C. Handle Shopper
-    shopper = session.get(Shopper, redemption_in.shopper_id)
-    if not shopper:
-        logger.warning(f"❌ Shopper not found: {redemption_in.shopper_id}")
-        raise HTTPException(status_code=404, detail="Shopper not found")
+    # C. Check Balance & Deduct in ONE conditional statement
+    #    The UPDATE only matches if the shopper exists AND can afford the reward,
+    #    so two concurrent redemptions can never spend the same stickers.
+    #    Hot shoppers spend from their balance shards (hot_shoppers.py).
+    cost = reward.cost
+    shards = hot_shoppers.directory.shards.get(redemption_in.shopper_id)
+    if shards:
+        new_balance = await hot_shoppers.debit(session, redemption_in.shopper_id, cost)
+    else:
+        result = await session.exec(debit_stmt(redemption_in.shopper_id, cost))
+        new_balance = result.scalar_one_or_none()
 
-    # D. Check Balance
-    cost = REWARD_OPTIONS[redemption_in.reward_code]
-    
-    if shopper.sticker_balance < cost:
-        logger.error(f"❌ Insufficient funds. Has {shopper.sticker_balance}, needs {cost}")
-        raise HTTPException(status_code=400, detail="Insufficient sticker balance")
-
-    # E. Deduct & Save
-    shopper.sticker_balance -= cost
-    session.add(shopper)
-
-    db_redemption = Redemption(
-        redemption_id=redemption_in.redemption_id,
-        shopper_id=redemption_in.shopper_id,
-        reward_code=redemption_in.reward_code,
-        stickers_spent=cost
-    )
-    session.add(db_redemption)
+    if new_balance is None:
+        # Only the failure path pays for a second query, to pick the right error
+        # (or to find shards this worker hasn't heard of yet)
+        balance = (await session.exec(balance_stmt(redemption_in.shopper_id))).scalar_one_or_none()
+        if balance is None:
+            logger.warning("Shopper not found: %s", redemption_in.shopper_id)
+            raise HTTPException(status_code=404, detail="Shopper not found")
+        if not shards and balance >= cost:
+            new_balance = await hot_shoppers.debit(session, redemption_in.shopper_id, cost)
+        if new_balance is None:
+            logger.warning("Insufficient funds for %s: has %d, needs %d", redemption_in.shopper_id, balance, cost)
+            metrics.INSUFFICIENT_BALANCE.inc()
+            raise HTTPException(status_code=400, detail="Insufficient sticker balance")
 
+    # C2. Stock: take one unit in the same DB transaction if the reward is
+    #     limited (the table says so, not our snapshot). The conditional UPDATE
+    #     locks the reward row, so concurrent redemptions queue up on it and
+    #     the last unit goes to exactly one of them.
+    result = await session.exec(rewards.take_stock_stmt(reward.code))
+    if result.first() is None:
+        await session.rollback()
+        logger.warning("Reward %s is out of stock", reward.code)
+        metrics.OUT_OF_STOCK.inc(reward.code)
+        raise HTTPException(status_code=409, detail="Reward out of stock")
+
+    # D. Save Redemption (a concurrent retry that got here first wins)
+    timestamp = datetime.utcnow()
     try:
-        session.commit()
-        session.refresh(db_redemption)
-        logger.info(f"✅ Redemption Successful! Spent {cost}. Remaining: {shopper.sticker_balance}")
-    except Exception as e:
-        logger.error(f"❌ DATABASE ERROR: {e}")
+        result = await session.exec(
+            pg_insert(Redemption).values(
+                redemption_id=redemption_in.redemption_id,
+                shopper_id=redemption_in.shopper_id,
+                reward_code=redemption_in.reward_code,
+                stickers_spent=cost,
+                timestamp=timestamp
+            ).on_conflict_do_nothing().returning(Redemption.redemption_id)
+        )
+        if result.first() is None:
+            await session.rollback()
+            stored = await find_stored_response(session, idempotency.REDEMPTION, redemption_in.redemption_id)
+            if stored:
+                return replay_stored_response(stored, payload_hash, idempotency.REDEMPTION, redemption_in.redemption_id)
+            logger.warning("Duplicate redemption: %s", redemption_in.redemption_id)
+            return await replay_redemption(session, redemption_in.redemption_id)
+
+        await session.exec(ledger.entry_stmt(), params={
+            "shopper_id": redemption_in.shopper_id,
+            "kind": ledger.SPEND,
+            "source_id": redemption_in.redemption_id,
+            "delta": -cost
+        })
+
+        response = RedemptionResponse(
+            redemption_id=redemption_in.redemption_id,
+            shopper_id=redemption_in.shopper_id,
+            reward_code=redemption_in.reward_code,
+            stickers_spent=cost,
+            shopper_sticker_balance=new_balance,
+            timestamp=timestamp
+        )
+        stored = StoredResponse(payload_hash, response.model_dump_json())
+        await session.exec(idempotency.record_stmt(), params={
+            "kind": idempotency.REDEMPTION,
+            "key": redemption_in.redemption_id,
+            "request_hash": stored.request_hash,
+            "response": stored.response
+        })
+
+        await session.commit()
+        await cache.balance_cache.aset(redemption_in.shopper_id, new_balance)
+        idempotency.remember(idempotency.REDEMPTION, redemption_in.redemption_id, stored)
+        logger.info(
+            "Redemption %s spent %d stickers, balance %d",
+            redemption_in.redemption_id, cost, new_balance,
+            extra={"sampled": True},
+        )
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Database error for redemption %s", redemption_in.redemption_id)
         raise HTTPException(status_code=500, detail="Database error during redemption")
 
-    return RedemptionResponse(
-        redemption_id=db_redemption.redemption_id,
-        shopper_id=db_redemption.shopper_id,
-        reward_code=db_redemption.reward_code,
-        stickers_spent=db_redemption.stickers_spent,
-        shopper_sticker_balance=shopper.sticker_balance,
-        timestamp=db_redemption.timestamp
-    )
-    
\ No newline at end of file
+    return Response(content=stored.response, status_code=201, media_type="application/json")
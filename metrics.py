@@ -0,0 +1,259 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# -----------------------------------------------------------------------------
+# Prometheus-style Metrics
+#
+# A deliberately tiny collector, rendered in the Prometheus text format at
+# GET /metrics. The hot path (observe / inc) never takes a lock:
+#
+# - Every thread writes to its own shard (threading.local), so there is no
+#   contention between the event loop and threadpool workers.
+# - A shard is a dict of label tuple -> list of counts. After the first
+#   request for a label combination, recording is a few integer increments.
+# - Shards are only summed when /metrics is scraped. A scrape that races a
+#   write may miss that one observation until the next scrape, which is fine
+#   for monitoring.
+# -----------------------------------------------------------------------------
+
+# Seconds. Prometheus' default latency buckets, with a finer low end
+# because most of our stages are sub-millisecond.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric registers itself here; render() walks it in creation order
+REGISTRY: list = []
+
+
+class _Sharded:
+    """Base for metrics whose values live in per-thread shards."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:  # once per thread, never per request
+                self._shards.append(shard)
+            return shard
+
+    def _label_str(self, labels: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.label_names, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def reset(self) -> None:
+        with self._shards_lock:
+            for shard in self._shards:
+                shard.clear()
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: int = 1) -> None:
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            cell = shard[labels] = [0]
+        cell[0] += amount
+
+    def values(self) -> Dict[Tuple[str, ...], int]:
+        totals: Dict[Tuple[str, ...], int] = {}
+        for shard in list(self._shards):
+            for labels, cell in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + cell[0]
+        return totals
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{self._label_str(labels)} {value}" for labels, value in sorted(self.values().items())]
+
+
+class Histogram(_Sharded):
+    """
+    Fixed-bucket histogram. Each cell is [count per bucket..., +Inf count, sum],
+    stored non-cumulatively and turned into Prometheus' cumulative form on render.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            cell = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], list]:
+        totals: Dict[Tuple[str, ...], list] = {}
+        for shard in list(self._shards):
+            for labels, cell in list(shard.items()):
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(cell)
+                else:
+                    for i, v in enumerate(cell):
+                        total[i] += v
+        return totals
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, cell in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), cell[:-1]):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_str(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(labels)} {cell[-1]:.6f}")
+            lines.append(f"{self.name}_count{self._label_str(labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read at scrape time from a callback (e.g. pool.checkedout)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._callbacks: Dict[Tuple[str, ...], Callable[[], float]] = {}
+        REGISTRY.append(self)
+
+    def set_function(self, fn: Callable[[], float], *labels: str) -> None:
+        self._callbacks[labels] = fn
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, fn in sorted(self._callbacks.items()):
+            pairs = ",".join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            lines.append(f"{self.name}{{{pairs}}} {fn()}" if pairs else f"{self.name} {fn()}")
+        return lines
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------------------------------------------------------------
+# The metrics the app records
+# -----------------------------------------------------------------------------
+REQUEST_SECONDS = Histogram(
+    "looplink_http_request_duration_seconds", "HTTP request latency by route",
+    ("method", "route", "status"),
+)
+STAGE_SECONDS = Histogram(
+    "looplink_stage_duration_seconds", "Time spent in each stage of a request handler",
+    ("handler", "stage"),
+)
+DUPLICATES = Counter("looplink_duplicate_requests_total", "Retries answered from an earlier result", ("kind",))
+INSUFFICIENT_BALANCE = Counter("looplink_insufficient_balance_total", "Redemptions rejected for lack of stickers")
+OUT_OF_STOCK = Counter("looplink_out_of_stock_total", "Redemptions rejected because a limited reward ran out", ("reward_code",))
+VALIDATION_FAILURES = Counter("looplink_validation_failures_total", "Requests rejected with 422", ("route",))
+CONTENDED_CREDITS = Counter(
+    "looplink_contended_balance_credits_total", "Balance credits slower than HOT_SHOPPER_SLOW_MS (row lock waits)",
+)
+SHOPPERS_SHARDED = Counter("looplink_shoppers_sharded_total", "Contended shoppers promoted to sharded balances")
+SHARDED_SHOPPERS = Gauge("looplink_sharded_shoppers", "Shoppers whose balance is split over BalanceShard rows")
+POOL_CONNECTIONS = Gauge(
+    "looplink_db_pool_connections", "Database pool connections by state", ("engine", "state"),
+)
+
+
+def register_pool(engine_name: str, pool) -> None:
+    """Exposes a SQLAlchemy QueuePool's size / checked-in / checked-out / overflow counts."""
+    if not hasattr(pool, "checkedout"):
+        return  # NullPool (external pooler): nothing to report
+    POOL_CONNECTIONS.set_function(pool.size, engine_name, "size")
+    POOL_CONNECTIONS.set_function(pool.checkedin, engine_name, "checked_in")
+    POOL_CONNECTIONS.set_function(pool.checkedout, engine_name, "checked_out")
+    POOL_CONNECTIONS.set_function(pool.overflow, engine_name, "overflow")
+
+
+class StageTimer:
+    """
+    Times consecutive stages of one handler:
+
+        timer = StageTimer("create_transaction")
+        ...lookup...
+        timer.mark("idempotency_lookup")
+        ...calculate...
+        timer.mark("calculate_stickers")
+
+    Each mark records (and returns) the seconds since the previous mark, or
+    since creation.
+    """
+
+    __slots__ = ("handler", "_last")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self._last = time.perf_counter()
+
+    def mark(self, stage: str) -> float:
+        now = time.perf_counter()
+        elapsed = now - self._last
+        STAGE_SECONDS.observe(elapsed, self.handler, stage)
+        self._last = now
+        return elapsed
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware task/stream overhead) that
+    records request latency labelled by the route *template*
+    (/shoppers/{shopper_id}), so shopper ids never become label values.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code),
+            )
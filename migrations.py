@@ -0,0 +1,549 @@
+"""
+Versioned schema migrations: the one place that creates or changes tables.
+
+Usage:
+    python migrations.py upgrade      # deploy step: apply pending migrations
+    python migrations.py status       # applied and pending versions
+
+API workers never touch the schema. At startup they read one number (the
+highest applied version) and refuse to start if it is older than the code
+they run, so a fleet restart costs Postgres one primary-key read per worker
+instead of a catalog check of every table.
+
+Each migration is a function of a connection, listed in MIGRATIONS under a
+version that never changes once shipped. `upgrade` applies the pending ones
+in order, each in its own transaction together with its SchemaMigration row,
+under an advisory lock so two deploys can't run the same step twice, and
+with no statement timeout whatever the serving configuration sets.
+
+Adding one: append (next version, name, function) and write its DDL out in
+full; never import the models for it, and never edit a shipped migration.
+Version 1 creates the schema from frozen DDL and adopts an existing database.
+Versions 2 and 3 convert the receipt tables of older deployments (string item
+columns, unpartitioned tables) and do nothing on a database that baseline
+created; version 4 adds the shopper history index.
+"""
+import argparse
+import logging
+import sys
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import func, select, text
+
+import rewards
+from models import SchemaMigration
+
+logger = logging.getLogger(__name__)
+
+# Serializes migration runs across deploy jobs (arbitrary constant)
+ADVISORY_LOCK_KEY = 7_245_002
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable
+
+
+class SchemaOutOfDateError(RuntimeError):
+    """The database is behind the code: run `python migrations.py upgrade`."""
+
+
+# -----------------------------------------------------------------------------
+# A. The frozen schema (version 1)
+# -----------------------------------------------------------------------------
+# The DDL as of the baseline, copied out of models.py once and never edited:
+# a database built today must match one built when version 1 shipped, even
+# after the models move on. Later changes are later migrations.
+BASELINE_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS shopper (
+        shopper_id VARCHAR NOT NULL,
+        sticker_balance INTEGER NOT NULL,
+        PRIMARY KEY (shopper_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS redemption (
+        redemption_id VARCHAR NOT NULL,
+        shopper_id VARCHAR NOT NULL,
+        reward_code VARCHAR NOT NULL,
+        stickers_spent INTEGER NOT NULL,
+        "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (redemption_id),
+        FOREIGN KEY (shopper_id) REFERENCES shopper (shopper_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_redemption_shopper_id ON redemption (shopper_id)",
+    """
+    CREATE TABLE IF NOT EXISTS idempotencyrecord (
+        kind VARCHAR NOT NULL,
+        key VARCHAR NOT NULL,
+        request_hash VARCHAR NOT NULL,
+        response VARCHAR NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT timezone('utc', now()) NOT NULL,
+        PRIMARY KEY (kind, key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ledgerentry (
+        id BIGSERIAL NOT NULL,
+        shopper_id VARCHAR NOT NULL,
+        kind VARCHAR NOT NULL,
+        source_id VARCHAR NOT NULL,
+        delta INTEGER NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT timezone('utc', now()) NOT NULL,
+        PRIMARY KEY (id),
+        CONSTRAINT uq_ledgerentry_source UNIQUE (kind, source_id),
+        FOREIGN KEY (shopper_id) REFERENCES shopper (shopper_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_ledgerentry_shopper_id_id ON ledgerentry (shopper_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS balancesnapshot (
+        shopper_id VARCHAR NOT NULL,
+        balance INTEGER NOT NULL,
+        ledger_id BIGINT NOT NULL,
+        taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (shopper_id),
+        FOREIGN KEY (shopper_id) REFERENCES shopper (shopper_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ingestqueueitem (
+        id BIGSERIAL NOT NULL,
+        transaction_id VARCHAR NOT NULL,
+        shopper_id VARCHAR NOT NULL,
+        request_hash VARCHAR NOT NULL,
+        payload VARCHAR NOT NULL,
+        status VARCHAR NOT NULL,
+        attempts INTEGER NOT NULL,
+        error VARCHAR,
+        enqueued_at TIMESTAMP WITHOUT TIME ZONE DEFAULT timezone('utc', now()) NOT NULL,
+        claimed_at TIMESTAMP WITHOUT TIME ZONE,
+        processed_at TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        UNIQUE (transaction_id)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_ingestqueueitem_pending ON ingestqueueitem (shopper_id, id)
+    WHERE status IN ('queued', 'processing')
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_ingestqueueitem_queued ON ingestqueueitem (id) WHERE status = 'queued'",
+    """
+    CREATE TABLE IF NOT EXISTS category (
+        id SMALLSERIAL NOT NULL,
+        name VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sku (
+        id SERIAL NOT NULL,
+        code VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        CONSTRAINT uq_sku_code_name UNIQUE (code, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS storehourrollup (
+        store_id VARCHAR NOT NULL,
+        hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        transactions BIGINT NOT NULL,
+        basket_total_cents BIGINT NOT NULL,
+        stickers_awarded BIGINT NOT NULL,
+        promo_units BIGINT NOT NULL,
+        PRIMARY KEY (store_id, hour)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS categoryhourrollup (
+        store_id VARCHAR NOT NULL,
+        category_id SMALLINT NOT NULL,
+        hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        units BIGINT NOT NULL,
+        sales_cents BIGINT NOT NULL,
+        lines BIGINT NOT NULL,
+        PRIMARY KEY (store_id, category_id, hour),
+        FOREIGN KEY (category_id) REFERENCES category (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_categoryhourrollup_hour ON categoryhourrollup (hour)",
+    """
+    CREATE TABLE IF NOT EXISTS rollupstate (
+        name VARCHAR NOT NULL,
+        ledger_id BIGINT NOT NULL,
+        updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reward (
+        code VARCHAR NOT NULL,
+        cost INTEGER NOT NULL,
+        stock INTEGER,
+        active BOOLEAN NOT NULL,
+        updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT timezone('utc', now()) NOT NULL,
+        PRIMARY KEY (code)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resourceversion (
+        name VARCHAR NOT NULL,
+        version BIGINT NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS balanceshard (
+        shopper_id VARCHAR NOT NULL,
+        shard SMALLINT NOT NULL,
+        balance INTEGER NOT NULL,
+        PRIMARY KEY (shopper_id, shard),
+        FOREIGN KEY (shopper_id) REFERENCES shopper (shopper_id)
+    )
+    """,
+]
+
+# The receipt tables in their current layout (catalog keys, monthly
+# partitions). Baseline creates them only on an empty database; older
+# layouts are converted into exactly these by migrations 2 and 3.
+RECEIPT_TABLES_SQL = {
+    "transaction": [
+        """
+        CREATE TABLE "transaction" (
+            transaction_id VARCHAR NOT NULL,
+            shopper_id VARCHAR NOT NULL,
+            store_id VARCHAR NOT NULL,
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            basket_total NUMERIC(10, 2) NOT NULL,
+            stickers_awarded INTEGER NOT NULL,
+            PRIMARY KEY (transaction_id, "timestamp"),
+            FOREIGN KEY (shopper_id) REFERENCES shopper (shopper_id)
+        ) PARTITION BY RANGE ("timestamp")
+        """,
+    ],
+    "item": [
+        """
+        CREATE TABLE item (
+            unit_price_cents BIGINT NOT NULL,
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            id SERIAL NOT NULL,
+            sku_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            category_id SMALLINT NOT NULL,
+            transaction_id VARCHAR NOT NULL,
+            PRIMARY KEY (id, "timestamp"),
+            FOREIGN KEY (sku_id) REFERENCES sku (id),
+            FOREIGN KEY (category_id) REFERENCES category (id)
+        ) PARTITION BY RANGE ("timestamp")
+        """,
+        "CREATE INDEX ix_item_transaction_id ON item (transaction_id)",
+    ],
+}
+
+SCHEMA_MIGRATION_SQL = """
+    CREATE TABLE IF NOT EXISTS schemamigration (
+        version INTEGER NOT NULL,
+        name VARCHAR NOT NULL,
+        applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (version)
+    )
+"""
+
+
+def _exists(connection, table: str) -> bool:
+    return connection.execute(text("SELECT to_regclass(:t) IS NOT NULL"), {"t": f'"{table}"'}).scalar()
+
+
+def _has_column(connection, table: str, column: str) -> bool:
+    return connection.execute(text(
+        "SELECT count(*) > 0 FROM pg_attribute WHERE attrelid = to_regclass(:t) AND attname = :c AND NOT attisdropped"
+    ), {"t": f'"{table}"', "c": column}).scalar()
+
+
+def _set_aside(connection, table: str, suffix: str) -> str:
+    """Renames a table and all of its indexes (index names are schema-wide) out of the way."""
+    old = f"{table}_{suffix}"
+    indexes = list(connection.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = to_regclass(:t)"
+    ), {"t": f'"{table}"'}).scalars())
+    connection.execute(text(f'ALTER TABLE "{table}" RENAME TO "{old}"'))
+    for index in indexes:
+        connection.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_{suffix}"'))
+    return old
+
+
+def _create_receipt_table(connection, table: str) -> None:
+    for sql in RECEIPT_TABLES_SQL[table]:
+        connection.execute(text(sql))
+
+
+def _partition_from_first_receipt(connection, source: str) -> None:
+    """Monthly partitions from the oldest receipt in `source` up to the months ahead."""
+    import partitions
+
+    first = connection.execute(text(f'SELECT min("timestamp") FROM "{source}"')).scalar()
+    partitions.ensure_partitions(connection, first_month=first.date() if first else None)
+
+
+# -----------------------------------------------------------------------------
+# B. The migrations, oldest first
+# -----------------------------------------------------------------------------
+def baseline(connection) -> None:
+    """
+    Every table the app has, as frozen in BASELINE_SQL, plus the monthly
+    partitions for the coming months and the default reward menu.
+
+    Key Decisions:
+    - Adopts an existing database: tables and indexes that already exist are
+      left alone (IF NOT EXISTS), missing ones are added.
+    - transaction and item are created only if absent. An older layout of
+      either is kept as it is here and converted by migrations 2 and 3, so a
+      legacy database is never recorded as being on the current schema.
+    - partitions.py is imported by the migrations that use it, not at the
+      top: every worker imports this module for check() alone.
+    """
+    import partitions
+
+    for sql in BASELINE_SQL:
+        connection.execute(text(sql))
+    for table in RECEIPT_TABLES_SQL:
+        if not _exists(connection, table):
+            _create_receipt_table(connection, table)
+    partitions.ensure_partitions(connection)
+    rewards.seed_defaults(connection)
+
+
+def item_catalog_keys(connection) -> None:
+    """
+    Converts a pre-catalog item table (sku / name / category strings, price in
+    dollars) to catalog keys and integer cents. The old table is kept as
+    item_legacy for checking; drop it when satisfied. No-op on the new layout.
+    """
+    if not _has_column(connection, "item", "sku"):
+        return
+    _set_aside(connection, "item", "legacy")
+    _create_receipt_table(connection, "item")
+    _partition_from_first_receipt(connection, "transaction")
+    connection.execute(text(
+        "INSERT INTO category (name) SELECT DISTINCT category FROM item_legacy ORDER BY 1 ON CONFLICT DO NOTHING"
+    ))
+    connection.execute(text(
+        "INSERT INTO sku (code, name) SELECT DISTINCT sku, name FROM item_legacy ORDER BY 1, 2 ON CONFLICT DO NOTHING"
+    ))
+    connection.execute(text("""
+        INSERT INTO item (id, "timestamp", transaction_id, sku_id, category_id, quantity, unit_price_cents)
+        SELECT l.id, t."timestamp", l.transaction_id, s.id, c.id, l.quantity, round(l.unit_price * 100)::bigint
+        FROM item_legacy l
+        JOIN "transaction" t ON t.transaction_id = l.transaction_id
+        JOIN sku s ON s.code = l.sku AND s.name = l.name
+        JOIN category c ON c.name = l.category
+    """))
+    connection.execute(text(
+        "SELECT setval(pg_get_serial_sequence('item', 'id'), coalesce(max(id), 0) + 1, false) FROM item"
+    ))
+
+
+def partition_receipts(connection) -> None:
+    """
+    Moves unpartitioned transaction / item tables into the monthly layout,
+    with a partition for every month that has data. The old tables are kept
+    as <table>_unpartitioned; drop them when satisfied. No-op once partitioned.
+    """
+    import partitions
+
+    todo = [table for table in ("transaction", "item") if not partitions._is_partitioned(connection, table)]
+    if not todo:
+        return
+    for table in todo:
+        _set_aside(connection, table, "unpartitioned")
+        _create_receipt_table(connection, table)
+    _partition_from_first_receipt(
+        connection, "transaction_unpartitioned" if "transaction" in todo else "transaction"
+    )
+
+    if "transaction" in todo:
+        connection.execute(text("""
+            INSERT INTO "transaction" (transaction_id, shopper_id, store_id, "timestamp",
+                                       basket_total, stickers_awarded)
+            SELECT transaction_id, shopper_id, store_id, "timestamp", basket_total, stickers_awarded
+            FROM transaction_unpartitioned
+        """))
+    if "item" in todo:
+        connection.execute(text("""
+            INSERT INTO item (unit_price_cents, "timestamp", id, sku_id, quantity, category_id, transaction_id)
+            SELECT i.unit_price_cents, t."timestamp", i.id, i.sku_id, i.quantity, i.category_id, i.transaction_id
+            FROM item_unpartitioned i JOIN "transaction" t USING (transaction_id)
+        """))
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('item', 'id'), coalesce(max(id), 0) + 1, false) FROM item"
+        ))
+
+
+def transaction_shopper_history_index(connection) -> None:
+    """
+    The keyset-pagination index for shopper history, which replaces the
+    original single-column shopper_id index. Built on the partitioned parent,
+    so every partition (and every later one) gets it.
+    """
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_transaction_shopper_history '
+        'ON "transaction" (shopper_id, "timestamp", transaction_id)'
+    ))
+    connection.execute(text("DROP INDEX IF EXISTS ix_transaction_shopper_id"))
+
+
+def ledgerentry_source_timestamp(connection) -> None:
+    """
+    The receipt timestamp on earn entries, so the rollups find each entry's
+    transaction in one partition. Nullable and without a default (instant,
+    no rewrite); existing entries stay NULL and the readers allow for that.
+    """
+    connection.execute(text(
+        "ALTER TABLE ledgerentry ADD COLUMN IF NOT EXISTS source_timestamp TIMESTAMP WITHOUT TIME ZONE"
+    ))
+
+
+def ledger_visibility_horizon(connection) -> None:
+    """
+    Snapshots consume ledger entries by writing transaction (xid) instead of
+    by id and age, so a slow writer's entries are never skipped.
+
+    Key Decisions:
+    - The column is added bare and gets its default afterwards: no rewrite,
+      and the ALTER waits for in-flight writers, so every entry left NULL had
+      committed before the first snapshot that reads it.
+    - Existing snapshots may already have skipped such entries; they are
+      dropped and the next run rebuilds them from the whole ledger.
+    - xid_horizon is NOT NULL, so a previous release still running its
+      snapshot task mid-deploy fails that task instead of writing snapshots
+      without a horizon.
+    """
+    for sql in [
+        "ALTER TABLE ledgerentry ADD COLUMN IF NOT EXISTS xid BIGINT",
+        "ALTER TABLE ledgerentry ALTER COLUMN xid SET DEFAULT (pg_current_xact_id()::text::bigint)",
+        "CREATE INDEX IF NOT EXISTS ix_ledgerentry_xid ON ledgerentry (xid) WHERE xid IS NOT NULL",
+        "DELETE FROM balancesnapshot",
+        "ALTER TABLE balancesnapshot ADD COLUMN IF NOT EXISTS xid_horizon BIGINT NOT NULL",
+    ]:
+        connection.execute(text(sql))
+
+
+def rollup_visibility_horizon(connection) -> None:
+    """
+    The rollups move to the same xid watermark as the snapshots.
+
+    Key Decisions:
+    - The rollups can't simply be rebuilt: archived months only live there.
+      So the old id mark stays, renamed to ledger_id_floor: entries at or
+      below it are already folded in, whatever their xid. The first run
+      after this folds in the rest of the settled ledger once.
+    - The rename makes a previous release's rollup task fail mid-deploy
+      instead of moving a mark this release no longer reads.
+    - Batches now find their entries by xid range. Until xid has statistics
+      the planner guesses a large range and scans every receipt partition,
+      so it gets them now rather than at the next autovacuum.
+    """
+    if _has_column(connection, "rollupstate", "ledger_id"):
+        connection.execute(text("ALTER TABLE rollupstate RENAME COLUMN ledger_id TO ledger_id_floor"))
+    connection.execute(text("ALTER TABLE rollupstate ADD COLUMN IF NOT EXISTS xid_horizon BIGINT"))
+    connection.execute(text("ANALYZE ledgerentry (xid)"))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", baseline),
+    Migration(2, "item_catalog_keys", item_catalog_keys),
+    Migration(3, "partition_receipts", partition_receipts),
+    Migration(4, "transaction_shopper_history_index", transaction_shopper_history_index),
+    Migration(5, "ledgerentry_source_timestamp", ledgerentry_source_timestamp),
+    Migration(6, "ledger_visibility_horizon", ledger_visibility_horizon),
+    Migration(7, "rollup_visibility_horizon", rollup_visibility_horizon),
+]
+
+LATEST = MIGRATIONS[-1].version
+
+
+# -----------------------------------------------------------------------------
+# C. Applying and checking
+# -----------------------------------------------------------------------------
+def current_version(connection) -> int:
+    """Highest applied version; 0 for a database that was never migrated."""
+    if connection.execute(text("SELECT to_regclass('schemamigration')")).scalar() is None:
+        return 0
+    return connection.execute(select(func.coalesce(func.max(SchemaMigration.version), 0))).scalar()
+
+
+def pending(connection, migrations: List[Migration] = MIGRATIONS) -> List[Migration]:
+    version = current_version(connection)
+    return [migration for migration in migrations if migration.version > version]
+
+
+def upgrade(engine, migrations: List[Migration] = MIGRATIONS) -> List[str]:
+    """Applies every pending migration, one transaction each. Returns what it applied."""
+    applied = []
+    while True:
+        with engine.begin() as connection:
+            # Rewrites and index builds outlast the serving statement timeout
+            # (DB_STATEMENT_TIMEOUT_MS, or one set on the role); lift it for
+            # this transaction only, so it also holds behind PgBouncer
+            connection.execute(text("SET LOCAL statement_timeout = 0"))
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            connection.execute(text(SCHEMA_MIGRATION_SQL))
+            # Re-read under the lock: another deploy may have got here first
+            todo = pending(connection, migrations)
+            if not todo:
+                return applied
+            migration = todo[0]
+            migration.apply(connection)
+            connection.execute(SchemaMigration.__table__.insert().values(
+                version=migration.version, name=migration.name
+            ))
+        logger.info("Migration %d (%s) applied", migration.version, migration.name)
+        applied.append(f"{migration.version} {migration.name}")
+
+
+def check(engine, latest: int = LATEST) -> int:
+    """
+    Worker startup check: one read, no DDL. Raises SchemaOutOfDateError when
+    the database is behind `latest`. A newer database is fine (migrations are
+    written so the previous release keeps working during a rolling deploy).
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version < latest:
+        raise SchemaOutOfDateError(
+            f"database schema is at version {version}, this code needs {latest}: "
+            "run `python migrations.py upgrade`"
+        )
+    return version
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["upgrade", "status"])
+    args = parser.parse_args(argv)
+
+    from database import get_engine
+    engine = get_engine()
+
+    if args.command == "upgrade":
+        applied = upgrade(engine)
+        print("\n".join(f"applied {name}" for name in applied) or f"already at version {LATEST}")
+        return 0
+
+    with engine.connect() as connection:
+        version = current_version(connection)
+        todo = pending(connection)
+    print(f"database at version {version}, code at version {LATEST}")
+    for migration in todo:
+        print(f"pending {migration.version} {migration.name}")
+    return 1 if todo else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
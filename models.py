@@ -1,6 +1,7 @@
 from datetime import datetime
 from decimal import Decimal
 from typing import List, Optional
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, SmallInteger, UniqueConstraint, text
 from sqlmodel import SQLModel, Field, Relationship
 
 class Shopper(SQLModel, table=True):
@@ -10,6 +11,10 @@ class Shopper(SQLModel, table=True):
     Key Decisions:
     - sticker_balance is stored here for O(1) access (fast reads),
       rather than recalculating it from transaction history every time.
+    - It is a projection of the LedgerEntry rows: every change to it is
+      written together with a ledger entry, and ledger.py can rebuild it.
+    - Hot shoppers (one account shared by many tills) also have BalanceShard
+      rows; their balance is this column plus the shards (balances.py).
     """
     shopper_id: str = Field(primary_key=True)
     sticker_balance: int = Field(default=0)
@@ -24,12 +29,26 @@ class Transaction(SQLModel, table=True):
     
     Key Decisions:
     - transaction_id is unique to ensure Idempotency (preventing double-counts).
+      The table is partitioned, so Postgres can only enforce (transaction_id,
+      timestamp); the earn LedgerEntry, unique on (kind, source_id), is what
+      guarantees a transaction_id is applied once.
     - basket_total uses Decimal (not Float) to avoid floating-point money errors.
+    - Range-partitioned by timestamp month (partitions.py): vacuum and index
+      maintenance work on one month at a time, old months are archived by
+      dropping a partition, and queries bounded on timestamp skip other months.
+    - History is read newest-first per shopper with keyset pagination, so the
+      composite index (shopper_id, timestamp, transaction_id) serves those pages
+      directly. It also covers plain shopper_id lookups, so no separate index.
     """
+    __table_args__ = (
+        Index("ix_transaction_shopper_history", "shopper_id", "timestamp", "transaction_id"),
+        {"postgresql_partition_by": 'RANGE ("timestamp")'},
+    )
+
     transaction_id: str = Field(primary_key=True)
-    shopper_id: str = Field(foreign_key="shopper.shopper_id", index=True)
+    shopper_id: str = Field(foreign_key="shopper.shopper_id")
     store_id: str
-    timestamp: datetime
+    timestamp: datetime = Field(primary_key=True)
     
     # max_digits=10, decimal_places=2 handles amounts up to 99,999,999.99
     basket_total: Decimal = Field(default=0, max_digits=10, decimal_places=2)
@@ -37,24 +56,56 @@ class Transaction(SQLModel, table=True):
     stickers_awarded: int = Field(default=0)
 
     shopper: Optional[Shopper] = Relationship(back_populates="transactions")
-    items: List["Item"] = Relationship(back_populates="transaction")
+    items: List["Item"] = Relationship(
+        back_populates="transaction",
+        sa_relationship_kwargs={
+            "primaryjoin": "and_(Transaction.transaction_id == foreign(Item.transaction_id), "
+                           "Transaction.timestamp == foreign(Item.timestamp))",
+            "viewonly": True,
+        },
+    )
 
 
 class Item(SQLModel, table=True):
     """
     A single line item within a transaction.
-    Separated into its own table to allow future analytics on specific product categories.
+    Separated into its own table to allow analytics on specific product categories (analytics.py).
+
+    Key Decisions:
+    - This is the biggest table, so a row holds no repeated strings: the SKU
+      and category are small integer keys into the catalog tables (Sku,
+      Category, see catalog.py) and the price is integer cents.
+    - It carries its transaction's timestamp and is partitioned by month like
+      Transaction, so a month of receipts and their items are archived
+      together. Items are always written in the same DB transaction as their
+      receipt, so there is no foreign key (one would stop old months from
+      being detached); ix_item_transaction_id serves the lookups instead.
+    - Fixed-width columns come first, widest first, so Postgres adds no
+      alignment padding between them.
+    - The API still sends and receives sku / name / category strings
+      (schemas.ItemCreate); catalog.py translates at the edge.
     """
-    id: Optional[int] = Field(default=None, primary_key=True)
-    transaction_id: str = Field(foreign_key="transaction.transaction_id")
-    
-    sku: str
-    name: str
-    category: str
+    __table_args__ = (
+        Index("ix_item_transaction_id", "transaction_id"),
+        {"postgresql_partition_by": 'RANGE ("timestamp")'},
+    )
+
+    unit_price_cents: int = Field(sa_column=Column(BigInteger, nullable=False))
+    timestamp: datetime = Field(primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
+    sku_id: int = Field(foreign_key="sku.id")
     quantity: int
-    unit_price: Decimal = Field(max_digits=10, decimal_places=2)
+    category_id: int = Field(sa_column=Column(SmallInteger, ForeignKey("category.id"), nullable=False))
+    transaction_id: str
 
-    transaction: Optional[Transaction] = Relationship(back_populates="items")
+    transaction: Optional[Transaction] = Relationship(
+        back_populates="items",
+        sa_relationship_kwargs={
+            "primaryjoin": "and_(Transaction.transaction_id == foreign(Item.transaction_id), "
+                           "Transaction.timestamp == foreign(Item.timestamp))",
+            "viewonly": True,
+        },
+    )
 
 
 # -----------------------------------------------------------------------------
@@ -68,4 +119,269 @@ class Redemption(SQLModel, table=True):
     shopper_id: str = Field(foreign_key="shopper.shopper_id", index=True)
     reward_code: str
     stickers_spent: int
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+# -----------------------------------------------------------------------------
+# 5. The Idempotency Record (Fast Replays)
+# -----------------------------------------------------------------------------
+class IdempotencyRecord(SQLModel, table=True):
+    """
+    Remembers the exact response we returned for a transaction_id / redemption_id.
+
+    Key Decisions:
+    - A replay is a single primary-key lookup here; no Transaction, Item or
+      Shopper objects are loaded.
+    - request_hash lets us spot a retry whose payload differs from the
+      original (a client bug), which we reject instead of silently accepting.
+    - It is written in the same DB transaction as the rows it describes,
+      so a record exists if and only if the write committed.
+    """
+    kind: str = Field(primary_key=True)  # "transaction" or "redemption"
+    key: str = Field(primary_key=True)
+    request_hash: str
+    response: str  # JSON body exactly as first returned
+    created_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column_kwargs={"server_default": text("timezone('utc', now())")},
+    )
+
+# -----------------------------------------------------------------------------
+# 6. The Sticker Ledger (Source of Truth for Balances)
+# -----------------------------------------------------------------------------
+class LedgerEntry(SQLModel, table=True):
+    """
+    One append-only row per balance change: +stickers for every Transaction,
+    -stickers for every Redemption. Rows are never updated or deleted.
+
+    Key Decisions:
+    - id is a BIGINT sequence, so "everything after entry N" is a range scan.
+      Snapshots and rebuilds use it as their position in the ledger.
+    - (kind, source_id) is unique: one entry per transaction / redemption,
+      even if a write path is retried.
+    - (shopper_id, id) serves "this shopper's entries since the snapshot".
+    - Earn entries record their receipt's timestamp, so readers going from
+      an entry to its Transaction row (analytics.py) probe one monthly
+      partition. NULL for other kinds and for entries older than the column.
+    - xid is the writing transaction's id (the database fills it in). Ids
+      and created_at can't tell a reader whether a slower writer will still
+      commit below them; xid below the oldest running transaction can
+      (ledger.HORIZON_SQL). NULL for entries older than the column.
+    """
+    __table_args__ = (
+        UniqueConstraint("kind", "source_id", name="uq_ledgerentry_source"),
+        Index("ix_ledgerentry_shopper_id_id", "shopper_id", "id"),
+        Index("ix_ledgerentry_xid", "xid", postgresql_where=text("xid IS NOT NULL")),
+    )
+
+    id: Optional[int] = Field(default=None, sa_column=Column(BigInteger, primary_key=True, autoincrement=True))
+    shopper_id: str = Field(foreign_key="shopper.shopper_id")
+    kind: str  # "earn", "spend" or "opening" (balance carried over from before the ledger)
+    source_id: str  # transaction_id / redemption_id / shopper_id for "opening"
+    source_timestamp: Optional[datetime] = None  # the receipt's timestamp, earn entries only
+    delta: int
+    created_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column_kwargs={"server_default": text("timezone('utc', now())")},
+    )
+    xid: Optional[int] = Field(
+        default=None,
+        sa_column=Column(BigInteger, server_default=text("(pg_current_xact_id()::text::bigint)")),
+    )
+
+
+class BalanceSnapshot(SQLModel, table=True):
+    """
+    A shopper's balance over every ledger entry whose xid is below
+    `xid_horizon` (plus those from before the xid column). A rebuild starts
+    here and only replays the entries at or above it. `ledger_id` is the
+    newest entry folded in, for reference.
+    """
+    shopper_id: str = Field(primary_key=True, foreign_key="shopper.shopper_id")
+    balance: int
+    ledger_id: int = Field(sa_column=Column(BigInteger, nullable=False))
+    xid_horizon: int = Field(sa_column=Column(BigInteger, nullable=False))
+    taken_at: datetime = Field(default_factory=datetime.utcnow)
+
+# -----------------------------------------------------------------------------
+# 7. The Ingest Queue (Accepted, Not Yet Applied)
+# -----------------------------------------------------------------------------
+class IngestQueueItem(SQLModel, table=True):
+    """
+    A validated transaction waiting for an ingest worker (queue mode).
+
+    Key Decisions:
+    - transaction_id is unique, so a POS retry never enqueues twice.
+    - Workers claim rows with FOR UPDATE SKIP LOCKED and take a lease
+      (status "processing", claimed_at). A crashed worker's rows go back to
+      "queued" once the lease expires.
+    - Per-shopper order: a row is only claimable when no earlier row for the
+      same shopper is still queued or processing ("ix_ingestqueueitem_pending").
+    """
+    __table_args__ = (
+        Index("ix_ingestqueueitem_pending", "shopper_id", "id",
+              postgresql_where=text("status IN ('queued', 'processing')")),
+        Index("ix_ingestqueueitem_queued", "id", postgresql_where=text("status = 'queued'")),
+    )
+
+    id: Optional[int] = Field(default=None, sa_column=Column(BigInteger, primary_key=True, autoincrement=True))
+    transaction_id: str = Field(unique=True)
+    shopper_id: str
+    request_hash: str
+    payload: str  # TransactionCreate as JSON
+    status: str = Field(default="queued")  # queued -> processing -> done | failed
+    attempts: int = Field(default=0)
+    error: Optional[str] = None
+    enqueued_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column_kwargs={"server_default": text("timezone('utc', now())")},
+    )
+    claimed_at: Optional[datetime] = None
+    processed_at: Optional[datetime] = None
+
+# -----------------------------------------------------------------------------
+# 8. The Catalog (Dimension Tables for Items)
+# -----------------------------------------------------------------------------
+class Category(SQLModel, table=True):
+    """
+    One row per category name ("grocery", "promo", ...). There are only a
+    handful, so a SMALLINT key is plenty.
+    """
+    id: Optional[int] = Field(default=None, sa_column=Column(SmallInteger, primary_key=True, autoincrement=True))
+    name: str = Field(unique=True)
+
+
+class Sku(SQLModel, table=True):
+    """
+    One row per (sku, name) pair seen on a receipt.
+
+    Key Decisions:
+    - The name is part of the key, so a SKU that was renamed gets a second
+      row and old receipts still show the name they were printed with.
+    - Rows are only ever inserted, never updated or deleted, so an id can be
+      cached forever once it is known (catalog.py).
+    """
+    __table_args__ = (
+        UniqueConstraint("code", "name", name="uq_sku_code_name"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    code: str
+    name: str
+
+# -----------------------------------------------------------------------------
+# 9. Analytics Rollups (Reporting Off the Hot Tables)
+# -----------------------------------------------------------------------------
+class StoreHourRollup(SQLModel, table=True):
+    """
+    Per store and hour: receipts, basket totals, stickers awarded and promo units.
+
+    Key Decisions:
+    - Maintained by analytics.py in micro-batches, never by the request path,
+      so reports don't run GROUP BYs over Transaction and Item.
+    - Money is integer cents (like Item), so folding in a batch is integer math.
+    - (store_id, hour) is the key, so a store's date range is one index range scan.
+    """
+    store_id: str = Field(primary_key=True)
+    hour: datetime = Field(primary_key=True)
+    transactions: int = Field(sa_column=Column(BigInteger, nullable=False))
+    basket_total_cents: int = Field(sa_column=Column(BigInteger, nullable=False))
+    stickers_awarded: int = Field(sa_column=Column(BigInteger, nullable=False))
+    promo_units: int = Field(sa_column=Column(BigInteger, nullable=False))
+
+
+class CategoryHourRollup(SQLModel, table=True):
+    """
+    Per store, category and hour: units sold, sales and item lines.
+    ix_categoryhourrollup_hour serves date ranges across all stores.
+    """
+    __table_args__ = (
+        Index("ix_categoryhourrollup_hour", "hour"),
+    )
+
+    store_id: str = Field(primary_key=True)
+    category_id: int = Field(sa_column=Column(SmallInteger, ForeignKey("category.id"), primary_key=True))
+    hour: datetime = Field(primary_key=True)
+    units: int = Field(sa_column=Column(BigInteger, nullable=False))
+    sales_cents: int = Field(sa_column=Column(BigInteger, nullable=False))
+    lines: int = Field(sa_column=Column(BigInteger, nullable=False))
+
+
+class RollupState(SQLModel, table=True):
+    """
+    How far the rollups have read: every earn LedgerEntry written below
+    xid_horizon, plus every entry up to ledger_id_floor (the id mark from
+    before migration 7), is folded in. xid_horizon is NULL until the first
+    run. The row is locked while a batch runs, so several workers never
+    fold in the same entries twice.
+    """
+    name: str = Field(primary_key=True)
+    ledger_id_floor: int = Field(sa_column=Column(BigInteger, nullable=False))
+    xid_horizon: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# -----------------------------------------------------------------------------
+# 10. The Reward Catalog (Prices & Stock)
+# -----------------------------------------------------------------------------
+class Reward(SQLModel, table=True):
+    """
+    One redeemable reward and its price in stickers.
+
+    Key Decisions:
+    - stock is NULL for unlimited rewards. Limited ones are decremented by a
+      conditional UPDATE in the redemption's own DB transaction, so
+      concurrent redemptions can never take the last unit twice.
+    - Requests validate codes and prices against an in-process snapshot
+      (rewards.py), not this table; edits bump ResourceVersion "rewards".
+    """
+    code: str = Field(primary_key=True)
+    cost: int
+    stock: Optional[int] = None
+    active: bool = Field(default=True)
+    updated_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column_kwargs={"server_default": text("timezone('utc', now())")},
+    )
+
+
+class ResourceVersion(SQLModel, table=True):
+    """
+    A counter per cached resource ("rewards"), bumped in the same DB
+    transaction as every edit. Workers poll this one row to know whether
+    their in-memory copy is stale.
+    """
+    name: str = Field(primary_key=True)
+    version: int = Field(sa_column=Column(BigInteger, nullable=False))
+
+# -----------------------------------------------------------------------------
+# 11. Balance Shards (Hot Shoppers)
+# -----------------------------------------------------------------------------
+class BalanceShard(SQLModel, table=True):
+    """
+    One of a hot shopper's balance counters (hot_shoppers.py).
+
+    Key Decisions:
+    - A shopper with shards has balance = Shopper.sticker_balance + the sum
+      of its shards. Earns add to one random shard, so concurrent receipts
+      for a shared account lock different rows instead of queueing on the
+      Shopper row.
+    - The Shopper column stays part of the total. A write path that doesn't
+      know about the shards (batch ingest, a worker that hasn't reloaded the
+      shard directory yet) is still correct, just not spread out.
+    - Only a handful of shoppers are ever sharded, so the table stays tiny
+      and the (shopper_id, shard) key serves every lookup.
+    """
+    shopper_id: str = Field(primary_key=True, foreign_key="shopper.shopper_id")
+    shard: int = Field(sa_column=Column(SmallInteger, primary_key=True))
+    balance: int = Field(default=0)
+
+# -----------------------------------------------------------------------------
+# 12. Schema Migrations
+# -----------------------------------------------------------------------------
+class SchemaMigration(SQLModel, table=True):
+    """
+    One row per applied migration (migrations.py). Workers read the highest
+    version at startup instead of checking every table themselves.
+    """
+    version: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    name: str
+    applied_at: datetime = Field(default_factory=datetime.utcnow)
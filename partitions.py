@@ -0,0 +1,258 @@
+"""
+Monthly partitions for the transaction and item tables.
+
+Usage:
+    python partitions.py ensure [--months-ahead 3]        # also runs in migrations and daily in the app
+    python partitions.py list
+    python partitions.py archive --keep-months 24 --archive-dir archive/ [--dry-run]
+
+Both tables are range-partitioned on "timestamp" (the receipt time), one
+partition per calendar month plus a default partition for anything outside
+the months that exist. Indexes are declared on the parent tables, so Postgres
+creates them on every partition, including partitions attached later.
+Unpartitioned tables from older deployments are moved over by
+`python migrations.py upgrade` (migration 3).
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import random
+from datetime import date, datetime
+from typing import Iterable, List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Parents, in archive order (items before the transactions they belong to)
+PARTITIONED_TABLES = ("item", "transaction")
+
+MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
+# Serializes partition DDL across workers and cron jobs (arbitrary constant)
+ADVISORY_LOCK_KEY = 7_245_001
+
+# App workers make their first maintenance pass within this long after startup
+FIRST_PASS_WITHIN_SECONDS = 60
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def _is_partitioned(connection, table: str) -> bool:
+    return connection.execute(
+        text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:t)"), {"t": f'"{table}"'}
+    ).scalar() or False
+
+
+def _partitions(connection, table: str) -> List[str]:
+    return list(connection.execute(text("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:t) ORDER BY c.relname
+    """), {"t": f'"{table}"'}).scalars())
+
+
+# -----------------------------------------------------------------------------
+# A. Ensure: the default partition plus one partition per month, ahead of time
+# -----------------------------------------------------------------------------
+def ensure_partitions(connection, months_ahead: int = MONTHS_AHEAD,
+                      first_month: Optional[date] = None, today: Optional[date] = None) -> List[str]:
+    """
+    Creates any missing monthly partitions from first_month (default: the
+    current month) up to months_ahead months from now, in the caller's
+    transaction. Returns the names it created.
+
+    Key Decisions:
+    - Partitions are created ahead of time, so inserts never wait on DDL and
+      nothing lands in the default partition in normal operation.
+    - If the default partition already holds rows for a new month (e.g. a
+      late backfill), they are moved into the new partition before it is
+      attached; Postgres refuses the attach otherwise.
+    - An advisory lock makes concurrent callers (several workers starting
+      at once) take turns instead of failing on CREATE TABLE.
+    """
+    current = month_start(today or datetime.utcnow().date())
+    month = month_start(first_month) if first_month else current
+    last = add_months(current, months_ahead)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    return ensure_months(connection, months)
+
+
+def ensure_months(connection, months: Iterable[date]) -> List[str]:
+    """
+    Creates the default partition and the partitions of exactly these months
+    (e.g. the months an import contains), in the caller's transaction, under
+    the same advisory lock. Returns the names it created.
+    """
+    tables = [table for table in PARTITIONED_TABLES if _is_partitioned(connection, table)]
+    if len(tables) < len(PARTITIONED_TABLES):
+        logger.warning("Unpartitioned transaction/item table found; run `python migrations.py upgrade`")
+
+    connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+    created = []
+    for table in tables:
+        existing = set(_partitions(connection, table))
+        default = default_partition_name(table)
+        if default not in existing:
+            connection.execute(text(f'CREATE TABLE "{default}" PARTITION OF "{table}" DEFAULT'))
+            created.append(default)
+
+        for month in sorted({month_start(m) for m in months}):
+            name = partition_name(table, month)
+            if name not in existing:
+                _create_month(connection, table, name, month, add_months(month, 1))
+                created.append(name)
+
+    if created:
+        logger.info("Partitions created: %s", ", ".join(created))
+    return created
+
+
+def _create_month(connection, table: str, name: str, start: date, end: date) -> None:
+    default = default_partition_name(table)
+    bounds = {"start": start, "end": end}
+    connection.execute(text(f'CREATE TABLE "{name}" (LIKE "{table}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    connection.execute(text(
+        f'INSERT INTO "{name}" SELECT * FROM "{default}" WHERE "timestamp" >= :start AND "timestamp" < :end'
+    ), bounds)
+    connection.execute(text(f'DELETE FROM "{default}" WHERE "timestamp" >= :start AND "timestamp" < :end'), bounds)
+    connection.execute(text(
+        f"ALTER TABLE \"{table}\" ATTACH PARTITION \"{name}\" FOR VALUES FROM ('{start}') TO ('{end}')"
+    ))
+
+
+async def maintain_forever(engine, interval_seconds: float) -> None:
+    """
+    Background task: keeps MONTHS_AHEAD months of partitions ready.
+    The first pass runs at a random point in the first minute after startup,
+    so a restarted fleet doesn't queue on the advisory lock all at once.
+    """
+    def run_once():
+        with engine.begin() as connection:
+            return ensure_partitions(connection)
+
+    delay = random.uniform(0, min(interval_seconds, FIRST_PASS_WITHIN_SECONDS))
+    while True:
+        await asyncio.sleep(delay)
+        delay = interval_seconds
+        try:
+            await asyncio.to_thread(run_once)
+        except Exception:
+            logger.exception("Partition maintenance failed")
+
+
+# -----------------------------------------------------------------------------
+# B. Retention: archive whole months to compressed CSV, then drop them
+# -----------------------------------------------------------------------------
+def archive_partitions(engine, keep_months: int, archive_dir: str,
+                       today: Optional[date] = None, dry_run: bool = False) -> List[str]:
+    """
+    Archives every monthly partition that ended more than keep_months ago:
+    COPY to <archive_dir>/<partition>.csv.gz, then DETACH and DROP.
+    Returns the archive paths (or, with dry_run, the paths it would write).
+
+    Key Decisions:
+    - Dropping a partition is instant and leaves no dead tuples to vacuum,
+      unlike DELETE ... WHERE timestamp < cutoff.
+    - The file is written and fsynced under a temporary name and renamed
+      before the partition is dropped, so a crash never loses a month: a
+      rerun just archives it again.
+    - Ledger entries and balances are untouched; only receipt detail goes.
+      Rows in the default partition are never archived.
+    """
+    cutoff = add_months(month_start(today or datetime.utcnow().date()), -keep_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+
+    with engine.connect() as connection:
+        expired = [
+            (table, name)
+            for table in PARTITIONED_TABLES
+            for name in _partitions(connection, table)
+            if name != default_partition_name(table)
+            and add_months(date(int(name[-7:-3]), int(name[-2:]), 1), 1) <= cutoff
+        ]
+
+    for table, name in expired:
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        archived.append(path)
+        if dry_run:
+            continue
+
+        raw = engine.raw_connection()
+        try:
+            with gzip.open(path + ".tmp", "wb") as out, raw.cursor() as cursor:
+                cursor.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', out)
+            raw.commit()
+        finally:
+            raw.close()
+        with open(path + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        with engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            connection.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+            connection.execute(text(f'DROP TABLE "{name}"'))
+        logger.info("Archived partition %s to %s", name, path)
+
+    return archived
+
+
+def describe(engine) -> List[dict]:
+    with engine.connect() as connection:
+        return [
+            {"table": table, "partition": name, **connection.execute(text(
+                "SELECT pg_get_expr(c.relpartbound, c.oid) AS bounds, c.reltuples::bigint AS rows_estimate, "
+                "pg_total_relation_size(c.oid) AS bytes FROM pg_class c WHERE c.oid = to_regclass(:p)"
+            ), {"p": f'"{name}"'}).mappings().one()}
+            for table in PARTITIONED_TABLES
+            for name in _partitions(connection, table)
+        ]
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["ensure", "list", "archive"])
+    parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    parser.add_argument("--keep-months", type=int, default=int(os.getenv("PARTITION_KEEP_MONTHS", "24")))
+    parser.add_argument("--archive-dir", default=os.getenv("PARTITION_ARCHIVE_DIR", "archive"))
+    parser.add_argument("--dry-run", action="store_true", help="archive: only list what would go")
+    args = parser.parse_args(argv)
+
+    from database import engine
+
+    if args.command == "ensure":
+        with engine.begin() as connection:
+            print("\n".join(ensure_partitions(connection, args.months_ahead)) or "nothing to create")
+    elif args.command == "list":
+        for row in describe(engine):
+            rows = f"~{row['rows_estimate']}" if row["rows_estimate"] >= 0 else "?"  # -1: never analyzed
+            print(f"{row['partition']:<24} {rows:>12} rows {row['bytes']:>14,} B  {row['bounds']}")
+    else:
+        paths = archive_partitions(engine, args.keep_months, args.archive_dir, dry_run=args.dry_run)
+        print("\n".join(paths) or "nothing to archive")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
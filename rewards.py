@@ -0,0 +1,215 @@
+"""
+Reward catalog: prices and stock live in Postgres; requests read an in-process snapshot.
+
+Usage:
+    python rewards.py list
+    python rewards.py set MUG --cost 12                 # add or reprice (unlimited stock)
+    python rewards.py set FERARI --cost 10000 --stock 1
+    python rewards.py set TOTE --cost 20 --inactive     # withdraw from the menu
+    python rewards.py restock FERARI 2
+
+Every edit bumps ResourceVersion "rewards" in the same DB transaction. Each
+worker compares that one number every REWARD_CATALOG_CHECK_SECONDS and
+reloads the (small) catalog only when it changed, so edits reach every
+worker without a redeploy and without a query per request.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Dict, NamedTuple, Optional
+
+import orjson
+from sqlalchemy import select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import ResourceVersion, Reward
+
+logger = logging.getLogger(__name__)
+
+RESOURCE = "rewards"
+
+CHECK_SECONDS = float(os.getenv("REWARD_CATALOG_CHECK_SECONDS", "5"))
+
+# Seeded into an empty reward table (the menu that used to be hardcoded in
+# main.py). None = unlimited stock.
+DEFAULT_REWARDS = {
+    "MUG": (10, None),
+    "TOTE": (20, None),
+    "HOODIE": (50, None),
+    "STICKER_PACK": (5, None),
+    "FERARI": (10000, 1),
+}
+
+
+class RewardOption(NamedTuple):
+    code: str
+    cost: int
+    limited: bool  # stock is tracked (informational: the stock UPDATE checks the table)
+
+
+class RewardSnapshot:
+    """
+    One version of the active catalog. Never mutated: a reload builds a new
+    one, so a request keeps the prices it started with.
+    GET /rewards is encoded once per version, not once per request.
+    """
+
+    def __init__(self, version: int, options: Dict[str, RewardOption]):
+        self.version = version
+        self.options = options
+        self.etag = f'"rewards-{version}"'
+        self.body = orjson.dumps({code: option.cost for code, option in options.items()})
+
+
+class RewardCatalog:
+    """
+    Holds the active RewardSnapshot. Like rules.RuleEngine, reading
+    `catalog.active` is a single attribute lookup and never touches Postgres.
+    """
+
+    def __init__(self):
+        self.active = RewardSnapshot(-1, {})
+
+    def refresh(self, engine, force: bool = False) -> RewardSnapshot:
+        """
+        One primary-key read of the version; the rewards are only loaded
+        when it differs from ours (or with force).
+        """
+        with engine.connect() as connection:
+            # Version first, then rows: an edit committing in between gives us
+            # newer rows under the older version, and the next check reloads.
+            version = connection.execute(
+                select(ResourceVersion.version).where(ResourceVersion.name == RESOURCE)
+            ).scalar()
+            if version is None or (version == self.active.version and not force):
+                return self.active
+            rows = connection.execute(
+                select(Reward.code, Reward.cost, Reward.stock).where(Reward.active).order_by(Reward.cost, Reward.code)
+            ).all()
+        self.active = RewardSnapshot(version, {
+            row.code: RewardOption(row.code, row.cost, row.stock is not None) for row in rows
+        })
+        logger.info("Reward catalog loaded: version %d, %d rewards", version, len(rows))
+        return self.active
+
+    async def watch(self, engine, interval_seconds: float) -> None:
+        """Background task: picks up catalog edits made by any process."""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await asyncio.to_thread(self.refresh, engine)
+            except Exception:
+                logger.exception("Reward catalog check failed")
+
+
+reward_catalog = RewardCatalog()
+
+
+# -----------------------------------------------------------------------------
+# A. Statements used by the redemption path
+# -----------------------------------------------------------------------------
+TAKE_STOCK_SQL = text("""
+    WITH taken AS (
+        UPDATE reward SET stock = stock - 1 WHERE code = :code AND stock > 0 RETURNING stock
+    )
+    SELECT stock FROM taken
+    UNION ALL
+    SELECT stock FROM reward WHERE code = :code AND stock IS NULL
+""")
+
+
+def take_stock_stmt(code: str):
+    """
+    Takes one unit of a reward if its stock is limited. Returns one row (the
+    units left, or NULL for an unlimited reward), or no row when it is sold out.
+    Run it in the redemption's DB transaction, so a rollback puts the unit back.
+
+    Key Decisions:
+    - The database decides whether stock is tracked, not the worker's catalog
+      snapshot: a reward that just became limited (`rewards.py set --stock`)
+      is decremented from the first redemption on, not after the next reload.
+    - Unlimited rewards only cost a primary-key read. Nothing is written or
+      locked, so their redemptions don't queue on the reward row.
+    """
+    return TAKE_STOCK_SQL.bindparams(code=code)
+
+
+# -----------------------------------------------------------------------------
+# B. Edits (each bumps the version in the same DB transaction)
+# -----------------------------------------------------------------------------
+BUMP_SQL = text("""
+    INSERT INTO resourceversion (name, version) VALUES (:name, 1)
+    ON CONFLICT (name) DO UPDATE SET version = resourceversion.version + 1
+""")
+
+
+def seed_defaults(connection) -> None:
+    """Fills an empty reward table with DEFAULT_REWARDS (baseline migration)."""
+    if connection.execute(select(Reward.code).limit(1)).first() is not None:
+        return
+    connection.execute(pg_insert(Reward).on_conflict_do_nothing(), [
+        {"code": code, "cost": cost, "stock": stock} for code, (cost, stock) in DEFAULT_REWARDS.items()
+    ])
+    connection.execute(BUMP_SQL, {"name": RESOURCE})
+
+
+def set_reward(connection, code: str, cost: int, stock: Optional[int] = None, active: bool = True) -> None:
+    """Adds or replaces a reward. stock=None makes it unlimited."""
+    stmt = pg_insert(Reward).values(code=code, cost=cost, stock=stock, active=active)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[Reward.code],
+        set_={"cost": stmt.excluded.cost, "stock": stmt.excluded.stock, "active": stmt.excluded.active,
+              "updated_at": text("timezone('utc', now())")},
+    ))
+    connection.execute(BUMP_SQL, {"name": RESOURCE})
+
+
+def restock(connection, code: str, units: int) -> Optional[int]:
+    """
+    Adds units to a limited reward, atomically with concurrent redemptions.
+    Returns the new stock (None if the reward is unknown or unlimited).
+    Stock isn't part of the cached snapshot, so the version is not bumped.
+    """
+    return connection.execute(
+        update(Reward)
+        .where(Reward.code == code, Reward.stock.is_not(None))
+        .values(stock=Reward.stock + units, updated_at=text("timezone('utc', now())"))
+        .returning(Reward.stock)
+    ).scalar()
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["list", "set", "restock"])
+    parser.add_argument("code", nargs="?")
+    parser.add_argument("units", nargs="?", type=int, help="restock: units to add")
+    parser.add_argument("--cost", type=int)
+    parser.add_argument("--stock", type=int, help="set: limited stock (default: unlimited)")
+    parser.add_argument("--inactive", action="store_true", help="set: hide from the menu and refuse redemptions")
+    args = parser.parse_args(argv)
+
+    from database import engine
+
+    if args.command == "list":
+        with engine.connect() as connection:
+            for row in connection.execute(select(Reward).order_by(Reward.cost, Reward.code)):
+                stock = "unlimited" if row.stock is None else row.stock
+                print(f"{row.code:<16} {row.cost:>8} stickers  stock {stock:<10} {'' if row.active else 'inactive'}")
+    elif args.command == "set":
+        if not args.code or args.cost is None:
+            parser.error("set needs a code and --cost")
+        with engine.begin() as connection:
+            set_reward(connection, args.code, args.cost, args.stock, not args.inactive)
+        print(f"{args.code} saved")
+    else:
+        if not args.code or args.units is None:
+            parser.error("restock needs a code and a number of units")
+        with engine.begin() as connection:
+            stock = restock(connection, args.code, args.units)
+        print(f"{args.code}: {stock} in stock" if stock is not None else f"{args.code} is unknown or unlimited")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,12 +1,21 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timezone
 
 # -----------------------------------------------------------------------------
 # TRANSACTION SCHEMAS (Earning Stickers)
 # -----------------------------------------------------------------------------
 
+def to_naive_utc(value: datetime) -> datetime:
+    """
+    Our timestamp columns have no time zone, so we store UTC.
+    Offset-aware input (e.g. '...Z' or '+02:00') is converted here at the edge.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 class ItemCreate(BaseModel):
     """
     Represents an item in the shopping basket during a request.
@@ -29,6 +38,11 @@ class TransactionCreate(BaseModel):
     timestamp: datetime
     items: List[ItemCreate]
 
+    @field_validator("timestamp")
+    @classmethod
+    def timestamp_to_naive_utc(cls, value: datetime) -> datetime:
+        return to_naive_utc(value)
+
 class TransactionResponse(BaseModel):
     """
     What we return after processing.
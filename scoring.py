@@ -0,0 +1,85 @@
+import numpy as np
+
+from rules import CompiledRules
+from services import (
+    DOLLARS_PER_STICKER,
+    MAX_STICKERS_PER_TRANSACTION,
+    PROMO_BONUS_PER_UNIT,
+    PROMO_CATEGORY,
+)
+
+# -----------------------------------------------------------------------------
+# Vectorized Sticker Scoring
+#
+# The same rules as services.calculate_stickers, applied to whole columns of
+# transactions at once. Used to rescore history when a rule changes.
+# -----------------------------------------------------------------------------
+
+
+def score_batch(
+    basket_totals_cents,
+    categories,
+    quantities,
+    offsets,
+    *,
+    cents_per_sticker: int = DOLLARS_PER_STICKER * 100,
+    promo_category=PROMO_CATEGORY,
+    promo_bonus_per_unit: int = PROMO_BONUS_PER_UNIT,
+    cap: int = MAX_STICKERS_PER_TRANSACTION,
+) -> np.ndarray:
+    """
+    Scores N transactions in one vectorized pass.
+
+    Inputs (columnar, CSR-style):
+    - basket_totals_cents: N integer basket totals in cents.
+    - categories / quantities: one entry per item, for all transactions
+      back to back. categories may be strings or integer codes
+      (pass the matching promo_category).
+    - offsets: N + 1 integers; items of transaction i are
+      categories[offsets[i]:offsets[i + 1]].
+
+    Key Decisions:
+    - Money stays in integer cents, so `cents // 1000` is exactly the
+      `Decimal // 10` floor used by calculate_stickers (for totals with
+      at most 2 decimal places, which is what the database stores).
+    - Promo units per transaction are a prefix-sum difference over the item
+      columns, so there is no Python loop per transaction or per item.
+    - The keyword arguments let a backfill try a repriced rule
+      (e.g. a different promo bonus or cap) before it ships.
+    """
+    totals = np.asarray(basket_totals_cents, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    promo_units = np.where(np.asarray(categories) == promo_category, np.asarray(quantities, dtype=np.int64), 0)
+    cumulative = np.concatenate(([0], np.cumsum(promo_units, dtype=np.int64)))
+    promo_per_tx = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+    stickers = totals // cents_per_sticker + promo_per_tx * promo_bonus_per_unit
+    return np.minimum(stickers, cap)
+
+
+def score_with_rules(rules: CompiledRules, basket_totals_cents, categories, quantities, offsets) -> np.ndarray:
+    """
+    score_batch for a compiled rule set (e.g. a candidate rules.json).
+
+    Only "simple" rule sets vectorize over these columns: a flat rate in whole
+    cents, per-category unit bonuses and a cap. Store rates, multipliers, SKU
+    bonuses and campaigns need per-line prices, SKUs, stores and timestamps,
+    so those raise ValueError; score them with calculate_stickers instead.
+    """
+    cents_per_sticker = rules.dollars_per_sticker * 100
+    if not rules.is_simple or cents_per_sticker != cents_per_sticker.to_integral_value():
+        raise ValueError(f"Rule set {rules.version!r} cannot be scored from these columns")
+
+    totals = np.asarray(basket_totals_cents, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    categories = np.asarray(categories)
+
+    bonus_per_unit = np.zeros(len(categories), dtype=np.int64)
+    for category, bonus in rules.category_unit_bonus.items():
+        bonus_per_unit[categories == category] = bonus
+    bonus_units = bonus_per_unit * np.asarray(quantities, dtype=np.int64)
+    cumulative = np.concatenate(([0], np.cumsum(bonus_units, dtype=np.int64)))
+
+    stickers = totals // int(cents_per_sticker) + cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+    return np.minimum(stickers, rules.cap)
@@ -0,0 +1,58 @@
+"""
+Production serving profile: the API across N worker processes.
+
+Usage:
+    python serve.py --workers 4 --port 8000
+    DB_POOLER=pgbouncer DATABASE_URL=postgresql://app@localhost:6432/sticker_db python serve.py
+
+Each worker is a separate process with its own event loop and its own
+connection pools, sized by config.pool_sizes() so that all workers together
+stay within DB_CONNECTION_BUDGET connections per engine. Pending schema
+migrations (migrations.py) are applied once here, before the workers start;
+the workers themselves only check the schema version. Pass --skip-migrations
+when a deploy step already ran `python migrations.py upgrade`.
+"""
+import argparse
+import os
+
+import uvicorn
+
+# Serving defaults; anything already set in the environment wins
+SERVING_DEFAULTS = {
+    "DB_STATEMENT_TIMEOUT_MS": "5000",
+    "LOG_FORMAT": "json",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--skip-migrations", action="store_true", help="don't apply pending schema migrations")
+    args = parser.parse_args()
+
+    # Workers are spawned fresh and read their pool sizes from the environment
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+    for name, value in SERVING_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+
+    # The serving defaults above are already in effect here; upgrade() lifts
+    # the statement timeout inside its own transactions
+    if not args.skip_migrations:
+        import migrations
+        from database import get_engine
+        migrations.upgrade(get_engine())
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        access_log=False,  # /metrics has per-route latency; no per-request access lines
+        timeout_keep_alive=30,
+    )
+
+
+if __name__ == "__main__":
+    main()
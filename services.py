@@ -1,34 +1,44 @@
+import os
+from datetime import datetime
 from decimal import Decimal
-from typing import List
-from models import Item
+from typing import List, Optional
+from schemas import ItemCreate
+from rules import RuleEngine
 
-def calculate_stickers(basket_total: Decimal, items: List[Item]) -> int:
+# The default earn rules (scoring.py and backfill.py use the same numbers)
+DOLLARS_PER_STICKER = 10
+PROMO_CATEGORY = "promo"
+PROMO_BONUS_PER_UNIT = 1
+MAX_STICKERS_PER_TRANSACTION = 5
+
+# Used when no rule file is present
+DEFAULT_RULES = {
+    "version": "built-in",
+    "dollars_per_sticker": str(DOLLARS_PER_STICKER),
+    "category_unit_bonus": {PROMO_CATEGORY: PROMO_BONUS_PER_UNIT},
+    "max_stickers_per_transaction": MAX_STICKERS_PER_TRANSACTION,
+}
+
+# Loaded and compiled once at startup; see rules.py for the file format
+rule_engine = RuleEngine(
+    os.getenv("STICKER_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")),
+    DEFAULT_RULES,
+)
+
+def calculate_stickers(
+    basket_total: Decimal,
+    items: List[ItemCreate],
+    store_id: Optional[str] = None,
+    timestamp: Optional[datetime] = None,
+) -> int:
     """
     Calculates the number of stickers earned for a transaction.
     
-    Rules:
+    The rules come from the active rule file (rules.json). By default:
     1. Base: 1 sticker per $10 spent (floored).
     2. Bonus: +1 sticker for every item with category 'promo'.
     3. Cap: Max 5 stickers total per transaction.
+
+    store_id and timestamp are only needed for store rates and campaigns.
     """
-    
-    # Rule 1: Base Earn Rate (1 per $10)
-    # convert 25.50 -> 2.55 -> int(2)
-    base_stickers = int(basket_total // 10)
-    
-    # Rule 2: Promo Item Bonus
-    # We count how many items have the category "promo"
-    promo_bonus = 0
-    for item in items:
-        if item.category == "promo":
-            # We add 1 sticker for EACH promo unit (quantity * 1)
-            promo_bonus += item.quantity
-            
-    # Calculate raw total
-    total = base_stickers + promo_bonus
-    
-    # Rule 3: Per-transaction cap
-    # If total is 8, return 5. If total is 3, return 3.
-    final_stickers = min(total, 5)
-    
-    return final_stickers
\ No newline at end of file
+    return rule_engine.active.evaluate(basket_total, items, store_id, timestamp)
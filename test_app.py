@@ -1,12 +1,52 @@
+import gzip
+import json
+import os
+import logging
+import random
+import subprocess
+import sys
 import uuid
+import pytest
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
 from decimal import Decimal
+from datetime import datetime
 from main import app
 from services import calculate_stickers
-from models import Item
+from schemas import ItemCreate, TransactionCreate
+from rules import CompiledRules, RuleConfigError, RuleEngine
+import cache
+from cache import LRUCache, RedisCache
+from logging_config import JsonFormatter, SuccessSampler
+import metrics
+import ledger
+import ingest_queue
+import config
+import catalog
+import partitions
+import analytics
+import rewards
+import hot_shoppers
+import migrations
+from rewards import reward_catalog
+from benchmarks import suite
+from benchmarks.workload import Workload
+from datetime import date
+from sqlmodel import Session, text
+from database import engine
 
 client = TestClient(app)
 
+# The async handlers share one asyncpg pool, and asyncpg connections belong to
+# the event loop that opened them. Entering the client once keeps every test
+# request on the same loop (and runs the startup hook, which needs the schema
+# that `python migrations.py upgrade` creates).
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    migrations.upgrade(engine)
+    with client:
+        yield
+
 # Helper to get a unique ID string
 def get_id():
     return str(uuid.uuid4())
@@ -16,14 +56,15 @@ def get_id():
 # -----------------------------------------------------------------------------
 def test_sticker_calculation_logic():
     items = [
-        Item(sku="A", name="Milk", category="grocery", quantity=2, unit_price=Decimal("5.00")), # $10
-        Item(sku="B", name="Toy", category="promo", quantity=1, unit_price=Decimal("15.00"))   # $15
+        ItemCreate(sku="A", name="Milk", category="grocery", quantity=2, unit_price=Decimal("5.00")), # $10
+        ItemCreate(sku="B", name="Toy", category="promo", quantity=1, unit_price=Decimal("15.00"))   # $15
     ]
     assert calculate_stickers(Decimal("25.00"), items) == 3
 
 def test_calculation_zero_promo_quantity():
+    # The API rejects quantity 0; build the item unvalidated to test the math alone
     items = [
-        Item(sku="B", name="Toy", category="promo", quantity=0, unit_price=Decimal("15.00"))
+        ItemCreate.model_construct(sku="B", name="Toy", category="promo", quantity=0, unit_price=Decimal("15.00"))
     ]
     assert calculate_stickers(Decimal("0.00"), items) == 0
 
@@ -119,4 +160,1187 @@ def test_redemption_flow():
     # 4. Idempotency (Replay the MUG redemption)
     r_replay = client.post("/redemptions", json=redemption_payload)
     assert r_replay.status_code == 201
-    assert r_replay.json()["shopper_sticker_balance"] == 5
\ No newline at end of file
+    assert r_replay.json()["shopper_sticker_balance"] == 5
+# -----------------------------------------------------------------------------
+# 5. BATCH INGESTION TESTS
+# -----------------------------------------------------------------------------
+def test_batch_ingestion_dedupes_and_sums_per_shopper():
+    shopper_a = f"shopper-{get_id()}"
+    shopper_b = f"shopper-{get_id()}"
+
+    def tx(tx_id, shopper_id, price):
+        return {
+            "transaction_id": tx_id,
+            "shopper_id": shopper_id,
+            "store_id": "store-1",
+            "timestamp": "2025-01-01T10:00:00Z",
+            "items": [
+                {"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": price}
+            ]
+        }
+
+    tx1, tx2, tx3 = get_id(), get_id(), get_id()
+    batch = [
+        tx(tx1, shopper_a, 30.00),   # 3 stickers
+        tx(tx2, shopper_a, 20.00),   # 2 stickers
+        tx(tx1, shopper_a, 30.00),   # retry inside the batch -> no extra stickers
+        tx(tx3, shopper_b, 50.00),   # 5 stickers
+    ]
+    r1 = client.post("/transactions/batch", json=batch)
+    assert r1.status_code == 201
+    body = r1.json()
+    assert [r["shopper_sticker_balance"] for r in body] == [3, 5, 3, 5]
+    assert [r["stickers_awarded"] for r in body] == [3, 2, 3, 5]
+
+    # Replaying the whole batch must not award anything twice
+    r2 = client.post("/transactions/batch", json=batch)
+    assert r2.status_code == 201
+    assert client.get(f"/shoppers/{shopper_a}").json()["sticker_balance"] == 5
+    assert client.get(f"/shoppers/{shopper_b}").json()["sticker_balance"] == 5
+
+# -----------------------------------------------------------------------------
+# 6. CONCURRENCY TESTS
+# -----------------------------------------------------------------------------
+def test_concurrent_writers_keep_balance_exact():
+    shopper_id = f"shopper-{get_id()}"
+
+    def earn(_):
+        return client.post("/transactions", json={
+            "transaction_id": get_id(),
+            "shopper_id": shopper_id,
+            "store_id": "store-1",
+            "timestamp": "2025-01-01T10:00:00Z",
+            "items": [
+                {"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 50.00}
+            ]
+        }).status_code
+
+    def redeem(_):
+        return client.post("/redemptions", json={
+            "redemption_id": get_id(),
+            "shopper_id": shopper_id,
+            "reward_code": "MUG"
+        }).status_code
+
+    # 40 concurrent earns of 5 stickers each -> exactly 200
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        assert set(pool.map(earn, range(40))) == {201}
+    assert client.get(f"/shoppers/{shopper_id}").json()["sticker_balance"] == 200
+
+    # 30 concurrent MUG redemptions (10 each) -> exactly 20 succeed, never overdrawn
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        statuses = list(pool.map(redeem, range(30)))
+    assert statuses.count(201) == 20
+    assert statuses.count(400) == 10
+    assert client.get(f"/shoppers/{shopper_id}").json()["sticker_balance"] == 0
+
+# -----------------------------------------------------------------------------
+# 7. SHOPPER HISTORY TESTS
+# -----------------------------------------------------------------------------
+def test_shopper_history_pagination():
+    shopper_id = f"shopper-{get_id()}"
+    for hour in (10, 11, 12):
+        client.post("/transactions", json={
+            "transaction_id": get_id(),
+            "shopper_id": shopper_id,
+            "store_id": "store-1",
+            "timestamp": f"2025-01-01T{hour}:00:00Z",
+            "items": [
+                {"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 10.00}
+            ]
+        })
+
+    # Page 1: newest two, plus a cursor
+    page1 = client.get(f"/shoppers/{shopper_id}", params={"limit": 2}).json()
+    assert page1["sticker_balance"] == 3
+    assert [tx["timestamp"][11:13] for tx in page1["transactions"]] == ["12", "11"]
+    assert page1["next_cursor"]
+
+    # Page 2: the oldest one, no more pages (with items loaded)
+    page2 = client.get(
+        f"/shoppers/{shopper_id}",
+        params={"limit": 2, "cursor": page1["next_cursor"], "include_items": True}
+    ).json()
+    assert [tx["timestamp"][11:13] for tx in page2["transactions"]] == ["10"]
+    assert page2["transactions"][0]["items"][0]["sku"] == "A"
+    assert page2["next_cursor"] is None
+
+    # Balance-only mode never returns history
+    balance = client.get(f"/shoppers/{shopper_id}", params={"balance_only": True}).json()
+    assert balance == {"shopper_id": shopper_id, "sticker_balance": 3}
+
+    assert client.get(f"/shoppers/{shopper_id}", params={"cursor": "not-a-cursor"}).status_code == 400
+
+# -----------------------------------------------------------------------------
+# 8. BALANCE CACHE TESTS
+# -----------------------------------------------------------------------------
+def test_lru_cache_ttl_and_eviction():
+    now = [0.0]
+    lru = LRUCache(max_size=2, ttl_seconds=10, clock=lambda: now[0])
+
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1       # "a" is now the most recently used
+    lru.set("c", 3)                # evicts "b"
+    assert lru.get("b") is None
+
+    now[0] = 11                    # everything has expired
+    assert lru.get("a") is None
+    assert lru.stats() == {"backend": "memory", "hits": 1, "misses": 2, "evictions": 1, "size": 1}
+
+
+class FakeRedis:
+    """Just enough of the Redis client API for RedisCache."""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value).encode()
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [k for k in list(self.data) if k.startswith(match.rstrip("*"))]
+
+
+class FakeAsyncRedis:
+    """The redis.asyncio side of FakeRedis (same data)."""
+    def __init__(self, sync):
+        self.sync = sync
+
+    async def get(self, key):
+        return self.sync.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.sync.data[key] = str(value).encode()
+
+
+def test_balance_reads_go_through_cache(monkeypatch):
+    sync_client = FakeRedis()
+    fake_cache = RedisCache(sync_client, async_client=FakeAsyncRedis(sync_client))
+    monkeypatch.setattr(cache, "balance_cache", fake_cache)
+    # The async handlers must not make blocking client calls
+    monkeypatch.setattr(sync_client, "get", lambda key: pytest.fail("sync Redis call on the event loop"))
+    shopper_id = f"shopper-{get_id()}"
+
+    # The write path puts the new balance in the cache on commit
+    client.post("/transactions", json={
+        "transaction_id": get_id(),
+        "shopper_id": shopper_id,
+        "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [
+            {"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 20.00}
+        ]
+    })
+    r = client.get(f"/shoppers/{shopper_id}", params={"balance_only": True})
+    assert r.json()["sticker_balance"] == 2
+    assert client.get("/cache/stats").json()["hits"] == 1
+
+    # After a cache flush, the first read misses and refills from Postgres
+    fake_cache.clear()
+    client.get(f"/shoppers/{shopper_id}", params={"balance_only": True})
+    client.get(f"/shoppers/{shopper_id}", params={"balance_only": True})
+    assert client.get("/cache/stats").json() == {"backend": "redis", "hits": 2, "misses": 1, "evictions": 0}
+
+# -----------------------------------------------------------------------------
+# 9. IDEMPOTENCY STORE TESTS
+# -----------------------------------------------------------------------------
+def test_replay_returns_stored_response_and_rejects_changed_payload():
+    payload = {
+        "transaction_id": get_id(),
+        "shopper_id": f"shopper-{get_id()}",
+        "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [
+            {"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 30.00}
+        ]
+    }
+    r1 = client.post("/transactions", json=payload)
+    assert r1.status_code == 201
+
+    # Same payload (even with 30.0 instead of 30.00) -> byte-identical replay
+    replay = {**payload, "items": [{**payload["items"][0], "unit_price": "30.0"}]}
+    r2 = client.post("/transactions", json=replay)
+    assert r2.status_code == 201
+    assert r2.content == r1.content
+
+    # Same id, different basket -> conflict, on both endpoints
+    changed = {**payload, "items": [{**payload["items"][0], "quantity": 2}]}
+    assert client.post("/transactions", json=changed).status_code == 409
+    assert client.post("/transactions/batch", json=[changed]).status_code == 409
+
+    # Redemptions: replay is identical, a different reward under the same id is a conflict
+    redemption = {"redemption_id": get_id(), "shopper_id": payload["shopper_id"], "reward_code": "STICKER_PACK"}
+    client.post("/transactions", json={**payload, "transaction_id": get_id()})  # 3 + 3 = 6 stickers
+    r3 = client.post("/redemptions", json=redemption)
+    assert r3.status_code == 201
+    assert client.post("/redemptions", json=redemption).content == r3.content
+    assert client.post("/redemptions", json={**redemption, "reward_code": "MUG"}).status_code == 409
+
+# -----------------------------------------------------------------------------
+# 10. VECTORIZED SCORING TESTS
+# -----------------------------------------------------------------------------
+def test_score_batch_matches_calculate_stickers():
+    np = pytest.importorskip("numpy")
+    from scoring import score_batch
+
+    rng = random.Random(7)
+    totals, categories, quantities, offsets, expected = [], [], [], [0], []
+    for _ in range(2000):
+        basket = [
+            ItemCreate(sku="X", name="X", category=rng.choice(["grocery", "promo", "toys"]),
+                       quantity=rng.randint(1, 4), unit_price=Decimal(rng.randint(0, 4000)) / 100)
+            for _ in range(rng.randint(0, 8))
+        ]
+        total = sum((item.unit_price * item.quantity for item in basket), Decimal("0"))
+        expected.append(calculate_stickers(total, basket))
+        totals.append(int(total * 100))
+        categories += [item.category for item in basket]
+        quantities += [item.quantity for item in basket]
+        offsets.append(len(categories))
+
+    scored = score_batch(np.array(totals), np.array(categories), np.array(quantities), np.array(offsets))
+    assert scored.tolist() == expected
+
+
+def test_backfill_scores_with_the_active_rule_file(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    import backfill
+
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"version": "live", "dollars_per_sticker": "5", "max_stickers_per_transaction": 9,
+                                "store_dollars_per_sticker": {"store-vip": "2"}}))
+    monkeypatch.setattr(backfill.rule_engine, "path", str(path))
+    assert backfill.load_rules().version == "live"
+
+    # The default run works for rule files that can't be vectorized too
+    shopper_id = f"backfill-{get_id()}"
+    assert client.post("/transactions", json={
+        "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": "2025-06-01T12:00:00Z",
+        "items": [{"sku": "M", "name": "Milk", "category": "grocery", "quantity": 1, "unit_price": "20.00"}],
+    }).status_code == 201
+    assert backfill.run_backfill(100, backfill.load_rules(), shopper_id) == {shopper_id: 2}
+
+    monkeypatch.setattr(backfill.rule_engine, "path", str(tmp_path / "missing.json"))
+    assert backfill.load_rules().version == "built-in"
+    with pytest.raises(FileNotFoundError):
+        backfill.load_rules(str(tmp_path / "candidate.json"))
+
+
+def test_backfill_scores_rules_it_cannot_vectorize_one_transaction_at_a_time():
+    pytest.importorskip("numpy")
+    import backfill
+
+    prefix = f"backfill-{get_id()}-"
+    receipts = [
+        (prefix + "a", "store-vip", {"sku": "TV", "name": "TV", "category": "electronics", "quantity": 1,
+                                     "unit_price": "40.00"}),
+        (prefix + "b", "store-1", {"sku": "SKU-BONUS", "name": "Toy", "category": "promo", "quantity": 1,
+                                   "unit_price": "10.00"}),
+    ]
+    for shopper_id, store_id, item in receipts:
+        assert client.post("/transactions", json={
+            "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": store_id,
+            "timestamp": "2025-06-01T12:00:00Z", "items": [item],
+        }).status_code == 201
+
+    candidate = CompiledRules({
+        "version": "candidate", "dollars_per_sticker": "10", "store_dollars_per_sticker": {"store-vip": "5"},
+        "category_unit_bonus": {"promo": 1}, "sku_unit_bonus": {"SKU-BONUS": 2}, "max_stickers_per_transaction": 10,
+    })
+    # a: $40 at 1 per $5 = 8 (was 4); b: 1 + promo 1 + SKU 2 = 4 (was 2)
+    assert backfill.run_backfill(1, candidate, prefix) == {prefix + "a": 4, prefix + "b": 2}
+
+# -----------------------------------------------------------------------------
+# 11. EARN-RULE ENGINE TESTS
+# -----------------------------------------------------------------------------
+def test_compiled_rules_features():
+    rules = CompiledRules({
+        "version": "test",
+        "dollars_per_sticker": "10",
+        "store_dollars_per_sticker": {"store-vip": "5"},
+        "category_multipliers": {"electronics": "0.5"},
+        "category_unit_bonus": {"promo": 1},
+        "sku_unit_bonus": {"SKU-BONUS": 2},
+        "campaigns": [{
+            "name": "black-friday", "starts_at": "2025-11-28T00:00:00Z", "ends_at": "2025-11-29T00:00:00Z",
+            "stores": ["store-1"], "bonus_stickers": 1
+        }],
+        "max_stickers_per_transaction": 10
+    })
+    tv = ItemCreate(sku="TV", name="TV", category="electronics", quantity=1, unit_price=Decimal("40.00"))
+    toy = ItemCreate(sku="SKU-BONUS", name="Toy", category="promo", quantity=1, unit_price=Decimal("10.00"))
+    total = Decimal("50.00")
+    outside = datetime(2025, 11, 1)
+    during = datetime(2025, 11, 28, 12)
+
+    # spend = 40 * 0.5 + 10 = 30 -> 3, +1 promo unit, +2 SKU bonus
+    assert rules.evaluate(total, [tv, toy], "store-1", outside) == 6
+    # VIP store earns 1 per $5 -> 6 + 3
+    assert rules.evaluate(total, [tv, toy], "store-vip", outside) == 9
+    # Campaign window and store match -> +1
+    assert rules.evaluate(total, [tv, toy], "store-1", during) == 7
+    assert rules.evaluate(total, [tv, toy], "store-2", during) == 6
+
+    with pytest.raises(RuleConfigError):
+        CompiledRules({"dollars_per_sticker": "0"})
+
+
+def test_rules_hot_reload(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"version": "v1", "category_unit_bonus": {"promo": 1}}))
+    rule_engine = RuleEngine(str(path), default={})
+    v1 = rule_engine.active
+    promo = [ItemCreate(sku="P", name="P", category="promo", quantity=3, unit_price=Decimal("1.00"))]
+    assert v1.evaluate(Decimal("3.00"), promo) == 3
+
+    path.write_text(json.dumps({"version": "v2", "category_unit_bonus": {"promo": 0}}))
+    rule_engine.reload()
+    assert rule_engine.active.version == "v2"
+    assert rule_engine.active.evaluate(Decimal("3.00"), promo) == 0
+    # A request that grabbed v1 before the reload still evaluates with v1
+    assert v1.evaluate(Decimal("3.00"), promo) == 3
+
+    # A broken file keeps the last good rules
+    path.write_text("{not json")
+    rule_engine.reload()
+    assert rule_engine.active.version == "v2"
+
+# -----------------------------------------------------------------------------
+# 12. LOGGING TESTS
+# -----------------------------------------------------------------------------
+def test_log_sampling_and_json_fields():
+    """Sampled success lines can be dropped; warnings always pass and extras become JSON fields."""
+    sampler = SuccessSampler(rate=0)
+    success = logging.makeLogRecord({"msg": "ok %s", "args": ("tx-1",), "levelno": logging.INFO, "sampled": True})
+    warning = logging.makeLogRecord({"msg": "dup %s", "args": ("tx-1",), "levelno": logging.WARNING, "path": "/transactions"})
+
+    assert sampler.filter(success) is False
+    assert sampler.filter(warning) is True
+    assert SuccessSampler(rate=1).filter(success) is True
+
+    line = json.loads(JsonFormatter().format(warning))
+    assert line["msg"] == "dup tx-1"
+    assert line["path"] == "/transactions"
+    assert "sampled" not in json.loads(JsonFormatter().format(success))
+
+# -----------------------------------------------------------------------------
+# 13. METRICS TESTS
+# -----------------------------------------------------------------------------
+def test_metrics_endpoint_counts_stages_and_rejections():
+    duplicates_before = metrics.DUPLICATES.values().get(("transaction",), 0)
+    invalid_before = metrics.VALIDATION_FAILURES.values().get(("/transactions",), 0)
+    insufficient_before = metrics.INSUFFICIENT_BALANCE.values().get((), 0)
+
+    shopper_id = f"shopper-{get_id()}"
+    payload = {
+        "transaction_id": get_id(),
+        "shopper_id": shopper_id,
+        "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 10.00}]
+    }
+    assert client.post("/transactions", json=payload).status_code == 201
+    assert client.post("/transactions", json=payload).status_code == 201
+    assert client.post("/transactions", json={**payload, "items": "nope"}).status_code == 422
+    r_fail = client.post("/redemptions", json={"redemption_id": get_id(), "shopper_id": shopper_id, "reward_code": "MUG"})
+    assert r_fail.status_code == 400
+
+    assert metrics.DUPLICATES.values()[("transaction",)] == duplicates_before + 1
+    assert metrics.VALIDATION_FAILURES.values()[("/transactions",)] == invalid_before + 1
+    assert metrics.INSUFFICIENT_BALANCE.values()[()] == insufficient_before + 1
+
+    body = client.get("/metrics").text
+    assert 'looplink_stage_duration_seconds_count{handler="create_transaction",stage="commit"}' in body
+    assert 'looplink_http_request_duration_seconds_bucket{method="POST",route="/transactions",status="201",le="+Inf"}' in body
+    assert 'looplink_db_pool_connections{engine="async",state="checked_out"}' in body
+
+# -----------------------------------------------------------------------------
+# 14. LEDGER TESTS
+# -----------------------------------------------------------------------------
+def test_ledger_records_every_change_and_rebuilds_balances():
+    shopper_id = f"ledger-{get_id()}"
+    payload = {
+        "shopper_id": shopper_id,
+        "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 50.00}]
+    }
+    for _ in range(3):
+        assert client.post("/transactions", json={**payload, "transaction_id": get_id()}).status_code == 201
+    client.post("/transactions/batch", json=[{**payload, "transaction_id": get_id()}])
+    r_redeem = client.post("/redemptions", json={"redemption_id": get_id(), "shopper_id": shopper_id, "reward_code": "MUG"})
+    assert r_redeem.json()["shopper_sticker_balance"] == 10
+
+    with Session(engine) as session:
+        kinds = session.exec(
+            text("SELECT kind, delta FROM ledgerentry WHERE shopper_id = :s ORDER BY id"), params={"s": shopper_id}
+        ).all()
+        assert [tuple(row) for row in kinds] == [("earn", 5)] * 4 + [("spend", -10)]
+
+        # Snapshot everything so far, then corrupt the projection and add one more entry
+        assert ledger.take_snapshots(session) >= 1
+        session.exec(text("UPDATE shopper SET sticker_balance = 999 WHERE shopper_id = :s"), params={"s": shopper_id})
+        session.commit()
+    client.post("/transactions", json={**payload, "transaction_id": get_id()})
+
+    with Session(engine) as session:
+        assert ledger.rebuild_balances(session, chunk_size=2, shopper_prefix=shopper_id) == 1
+    assert client.get(f"/shoppers/{shopper_id}?balance_only=true").json()["sticker_balance"] == 15
+
+def test_ledger_snapshots_wait_for_slow_writers_instead_of_skipping_them():
+    shopper_id = f"ledger-{get_id()}"
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO shopper VALUES (:s, 0)"), {"s": shopper_id})
+
+    def entry(connection, delta):
+        connection.execute(ledger.entry_stmt(), {"shopper_id": shopper_id, "kind": ledger.EARN,
+                                                 "source_id": get_id(), "delta": delta})
+
+    # A slow writer takes the lower id and stays open while a later one commits
+    slow = engine.connect()
+    slow_tx = slow.begin()
+    entry(slow, 1)
+    with engine.begin() as connection:
+        entry(connection, 10)
+
+    def snapshot_balance():
+        with Session(engine) as session:
+            ledger.take_snapshots(session)
+            return session.exec(text("SELECT balance FROM balancesnapshot WHERE shopper_id = :s"),
+                                params={"s": shopper_id}).scalar_one_or_none()
+
+    try:
+        # Nothing newer than the slow writer is settled yet
+        assert snapshot_balance() is None
+    finally:
+        slow_tx.commit()
+        slow.close()
+    assert snapshot_balance() == 11
+
+    with Session(engine) as session:
+        session.exec(text("UPDATE shopper SET sticker_balance = 0 WHERE shopper_id = :s"), params={"s": shopper_id})
+        session.commit()
+        assert ledger.rebuild_balances(session, shopper_prefix=shopper_id) == 1
+    assert client.get(f"/shoppers/{shopper_id}?balance_only=true").json()["sticker_balance"] == 11
+
+# -----------------------------------------------------------------------------
+# 15. INGEST QUEUE TESTS
+# -----------------------------------------------------------------------------
+def test_queue_mode_accepts_then_workers_apply_in_order():
+    shopper_id = f"queued-{get_id()}"
+    async_header = {"Prefer": "respond-async"}
+    first = {
+        "transaction_id": get_id(),
+        "shopper_id": shopper_id,
+        "store_id": "store-1",
+        "timestamp": "2025-11-28T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 30.00}]
+    }
+    second = {**first, "transaction_id": get_id()}
+
+    r_first = client.post("/transactions", json=first, headers=async_header)
+    assert r_first.status_code == 202
+    assert r_first.headers["location"] == f"/transactions/{first['transaction_id']}/status"
+    assert client.post("/transactions", json=second, headers=async_header).status_code == 202
+    # Retries are idempotent; a changed payload is rejected
+    assert client.post("/transactions", json=first, headers=async_header).json()["status"] == "queued"
+    changed = {**first, "store_id": "store-2"}
+    assert client.post("/transactions", json=changed, headers=async_header).status_code == 409
+    assert client.get(r_first.headers["location"]).json()["status"] == "queued"
+
+    with Session(engine) as session:
+        # One row per shopper per claim: the second waits for the first
+        claimed = [row.transaction_id for row in ingest_queue.claim_batch(session, limit=1000)]
+        assert first["transaction_id"] in claimed and second["transaction_id"] not in claimed
+        session.exec(text("UPDATE ingestqueueitem SET status = 'queued' WHERE transaction_id = ANY(:ids)"),
+                     params={"ids": claimed})
+        session.commit()
+        ingest_queue.drain(session)
+
+    status_first = client.get(r_first.headers["location"]).json()
+    assert status_first["status"] == "done"
+    assert status_first["result"]["shopper_sticker_balance"] == 3
+    status_second = client.get(f"/transactions/{second['transaction_id']}/status").json()
+    assert status_second["result"]["shopper_sticker_balance"] == 6
+    assert client.get("/transactions/missing-tx/status").status_code == 404
+
+# -----------------------------------------------------------------------------
+# 16. SERVING CONFIG TESTS
+# -----------------------------------------------------------------------------
+def test_pool_sizes_split_the_connection_budget(monkeypatch):
+    monkeypatch.setattr(config, "DB_CONNECTION_BUDGET", 40)
+    monkeypatch.delenv("DB_POOL_SIZE", raising=False)
+    monkeypatch.delenv("DB_MAX_OVERFLOW", raising=False)
+
+    assert config.pool_sizes(1) == (20, 20)
+    for workers in (2, 4, 8):
+        pool_size, max_overflow = config.pool_sizes(workers)
+        assert workers * (pool_size + max_overflow) <= 40
+
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    assert config.pool_sizes(8) == (3, 0)
+
+# -----------------------------------------------------------------------------
+# 17. SERIALIZATION TESTS
+# -----------------------------------------------------------------------------
+def test_large_basket_round_trip_and_validation_errors():
+    shopper_id = f"shopper-{get_id()}"
+    payload = {
+        "transaction_id": get_id(),
+        "shopper_id": shopper_id,
+        "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [
+            {"sku": f"SKU-{i}", "name": f"Item {i}", "category": "grocery", "quantity": 1, "unit_price": "0.50"}
+            for i in range(250)
+        ]
+    }
+    response = client.post("/transactions", json=payload)
+    assert response.status_code == 201
+    # Money keeps its exact decimal form in every response
+    assert response.json()["basket_total"] == "125.00"
+
+    history = client.get(f"/shoppers/{shopper_id}", params={"include_items": True}).json()
+    assert history["transactions"][0]["basket_total"] == "125.00"
+    assert len(history["transactions"][0]["items"]) == 250
+
+    # Errors from the fast parser keep FastAPI's shape (minus the leading "body")
+    bad = {**payload, "transaction_id": get_id()}
+    bad["items"] = [{**payload["items"][0], "quantity": -1}]
+    errors = client.post("/transactions", json=bad).json()["errors"]
+    assert errors[0].startswith("Field 'items -> 0 -> quantity'")
+    assert client.post("/transactions", content=b"{not json",
+                       headers={"content-type": "application/json"}).status_code == 422
+
+    # The parsed bodies are still documented
+    schema = client.get("/openapi.json").json()["paths"]["/transactions"]["post"]["requestBody"]
+    assert "items" in schema["content"]["application/json"]["schema"]["properties"]
+
+def test_basket_totals_are_whole_cents_in_every_response():
+    def receipt(unit_price, quantity):
+        return {
+            "transaction_id": get_id(), "shopper_id": f"shopper-{get_id()}", "store_id": "store-1",
+            "timestamp": "2025-01-01T10:00:00Z",
+            "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": quantity, "unit_price": unit_price}],
+        }
+
+    single = receipt("50", 3)
+    created = client.post("/transactions", json=single)
+    assert created.json()["basket_total"] == "150.00"
+    assert client.post("/transactions", json=single).content == created.content
+
+    batch = client.post("/transactions/batch", json=[receipt("0.333", 3), receipt("7", 1)])
+    assert [r["basket_total"] for r in batch.json()] == ["1.00", "7.00"]
+
+# -----------------------------------------------------------------------------
+# 18. CATALOG TESTS
+# -----------------------------------------------------------------------------
+def test_items_are_stored_as_catalog_keys_and_read_back_as_strings():
+    shopper_id = f"shopper-{get_id()}"
+    sku = f"SKU-{get_id()}"
+    lines = [
+        {"sku": sku, "name": "Oat Milk", "category": "grocery", "quantity": 2, "unit_price": "1.995"},
+        {"sku": sku, "name": "Oat Milk", "category": "grocery", "quantity": 1, "unit_price": "2.00"},
+        {"sku": sku, "name": "Oat Milk 1L", "category": f"cat-{get_id()}", "quantity": 1, "unit_price": "3.10"},
+    ]
+    response = client.post("/transactions", json={
+        "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z", "items": lines,
+    })
+    assert response.status_code == 201
+
+    with Session(engine) as session:
+        rows = session.exec(text(
+            "SELECT i.sku_id, i.category_id, i.unit_price_cents FROM item i "
+            "JOIN transaction t USING (transaction_id) WHERE t.shopper_id = :s ORDER BY i.id"
+        ), params={"s": shopper_id}).all()
+    # Same (sku, name) -> same id; a renamed SKU gets its own row; prices in cents
+    assert rows[0].sku_id == rows[1].sku_id != rows[2].sku_id
+    assert rows[0].category_id == rows[1].category_id != rows[2].category_id
+    assert [row.unit_price_cents for row in rows] == [200, 200, 310]
+
+    history = client.get(f"/shoppers/{shopper_id}", params={"include_items": True}).json()
+    items = history["transactions"][0]["items"]
+    assert [(i["sku"], i["name"], i["category"]) for i in items] == [
+        (line["sku"], line["name"], line["category"]) for line in lines
+    ]
+    assert [i["unit_price"] for i in items] == ["2.00", "2.00", "3.10"]
+
+    # Each distinct key is looked up once per basket, then served from the LRU
+    fresh = catalog.Catalog(max_size=10)
+    with Session(engine) as session:
+        first = fresh.resolve(session, [ItemCreate(**line) for line in lines])
+        assert fresh.resolve(session, [ItemCreate(**line) for line in lines]) == first
+    assert (fresh.skus.misses, fresh.skus.hits) == (2, 2)
+
+def test_retry_is_answered_before_any_catalog_work(monkeypatch):
+    payload = {
+        "transaction_id": get_id(), "shopper_id": f"shopper-{get_id()}", "store_id": "store-1",
+        "timestamp": "2025-01-01T10:00:00Z",
+        "items": [{"sku": f"NEW-{get_id()}", "name": "New", "category": "grocery", "quantity": 1, "unit_price": "1.00"}]
+    }
+    assert client.post("/transactions", json=payload).status_code == 201
+
+    async def no_catalog(*args, **kwargs):
+        raise AssertionError("a replay must not intern catalog keys")
+    monkeypatch.setattr(catalog.catalog, "resolve_async", no_catalog)
+    catalog.catalog.skus.delete((payload["items"][0]["sku"], "New"))
+    assert client.post("/transactions", json=payload).status_code == 201
+
+# -----------------------------------------------------------------------------
+# 19. PARTITIONING TESTS
+# -----------------------------------------------------------------------------
+def test_monthly_partitions_route_prune_and_archive(tmp_path):
+    # A month of its own, far from anything else the suite writes
+    with engine.begin() as connection:
+        partitions.ensure_partitions(connection, months_ahead=0, today=date(2001, 1, 15))
+
+    shopper_id = f"shopper-{get_id()}"
+    tx_id = get_id()
+    assert client.post("/transactions", json={
+        "transaction_id": tx_id, "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": "2001-01-15T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": "20.00"}]
+    }).status_code == 201
+    # Same id again: the ledger guard still catches it on the partitioned table
+    assert client.post("/transactions", json={
+        "transaction_id": tx_id, "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": "2001-01-15T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": "20.00"}]
+    }).json()["shopper_sticker_balance"] == 2
+
+    with Session(engine) as session:
+        where = session.exec(text(
+            "SELECT tableoid::regclass::text FROM transaction WHERE transaction_id = :id"
+        ), params={"id": tx_id}).scalar_one()
+        assert where == "transaction_p2001_01"
+        # A lookup bounded on timestamp only touches that month
+        plan = "\n".join(session.exec(text(
+            "EXPLAIN SELECT * FROM item WHERE transaction_id = :id "
+            "AND timestamp BETWEEN '2001-01-15' AND '2001-01-16'"
+        ), params={"id": tx_id}).scalars())
+        assert "item_p2001_01" in plan and "item_p2025" not in plan
+
+    history = client.get(f"/shoppers/{shopper_id}", params={"include_items": True}).json()
+    assert history["transactions"][0]["items"][0]["unit_price"] == "20.00"
+
+    archived = partitions.archive_partitions(engine, keep_months=1, archive_dir=str(tmp_path), today=date(2001, 3, 1))
+    assert sorted(os.path.basename(path) for path in archived) == [
+        "item_p2001_01.csv.gz", "transaction_p2001_01.csv.gz"
+    ]
+    with gzip.open(tmp_path / "transaction_p2001_01.csv.gz", "rt") as f:
+        assert tx_id in f.read()
+    with Session(engine) as session:
+        assert session.exec(text("SELECT to_regclass('transaction_p2001_01')")).scalar_one() is None
+    # Balances live in the ledger, not in the archived receipts
+    assert client.get(f"/shoppers/{shopper_id}", params={"balance_only": True}).json()["sticker_balance"] == 2
+
+def test_archived_receipts_replayed_through_batch_are_still_duplicates(tmp_path):
+    with engine.begin() as connection:
+        partitions.ensure_partitions(connection, months_ahead=0, today=date(2002, 1, 15))
+
+    shopper_id = f"shopper-{get_id()}"
+    batch = [{
+        "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": "2002-01-15T10:00:00Z",
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": "30.00"}]
+    } for _ in range(2)]
+    first = client.post("/transactions/batch", json=batch)
+    assert first.status_code == 201
+    # The second receipt also loses its stored response: only the ledger knows it
+    with Session(engine) as session:
+        session.exec(text("DELETE FROM idempotencyrecord WHERE key = :id"), params={"id": batch[1]["transaction_id"]})
+        session.commit()
+
+    partitions.archive_partitions(engine, keep_months=1, archive_dir=str(tmp_path), today=date(2002, 3, 1))
+    with Session(engine) as session:
+        assert session.exec(text(
+            "SELECT count(*) FROM transaction WHERE transaction_id IN (:a, :b)"
+        ), params={"a": batch[0]["transaction_id"], "b": batch[1]["transaction_id"]}).scalar_one() == 0
+
+    replay = client.post("/transactions/batch", json=batch)
+    assert replay.status_code == 201
+    assert replay.json()[0] == first.json()[0]
+    assert [r["stickers_awarded"] for r in replay.json()] == [3, 3]
+    assert replay.json()[1]["basket_total"] == "30.00"
+    assert client.get(f"/shoppers/{shopper_id}", params={"balance_only": True}).json()["sticker_balance"] == 6
+
+    changed = [dict(batch[0], store_id="store-2")]
+    assert client.post("/transactions/batch", json=changed).status_code == 409
+
+def test_history_pages_and_rollup_batches_touch_only_their_months():
+    with engine.begin() as connection:
+        partitions.ensure_partitions(connection, months_ahead=1, today=date(2003, 1, 15))
+
+    shopper_id = f"shopper-{get_id()}"
+    ids = [get_id(), get_id()]
+    for tx_id, timestamp in zip(ids, ["2003-01-15T10:00:00Z", "2003-02-15T10:00:00Z"]):
+        assert client.post("/transactions", json={
+            "transaction_id": tx_id, "shopper_id": shopper_id, "store_id": "store-1", "timestamp": timestamp,
+            "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": "20.00"}]
+        }).status_code == 201
+
+    # Cursor pages cross months correctly
+    first = client.get(f"/shoppers/{shopper_id}", params={"limit": 1}).json()
+    second = client.get(f"/shoppers/{shopper_id}", params={"limit": 1, "cursor": first["next_cursor"]}).json()
+    assert [first["transactions"][0]["transaction_id"], second["transactions"][0]["transaction_id"]] == ids[::-1]
+
+    # Earn entries know their receipt's month, so the rollup batch probes
+    # exactly one partition per entry (run-time pruning)
+    with Session(engine) as session:
+        low, high = session.exec(text(
+            "SELECT min(xid), max(xid) + 1 FROM ledgerentry WHERE source_id IN (:a, :b)"
+        ), params={"a": ids[0], "b": ids[1]}).one()
+        plan = session.exec(text("EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF, SUMMARY OFF) " + analytics.BATCH_SOURCE),
+                            params={"earn": "earn", "floor": 0, "low": low, "high": high}).scalars().all()
+    executed = {line.split(" on ")[1].split()[0] for line in plan
+                if "transaction_p" in line and " on " in line and "never executed" not in line}
+    assert executed == {"transaction_p2003_01", "transaction_p2003_02"}
+
+# -----------------------------------------------------------------------------
+# 20. ANALYTICS TESTS
+# -----------------------------------------------------------------------------
+def test_rollups_fold_new_transactions_and_serve_ranges(tmp_path):
+    store_id = f"store-{get_id()}"
+    promo_and_milk = [
+        {"sku": "P", "name": "Promo", "category": "promo", "quantity": 2, "unit_price": "5.00"},
+        {"sku": "M", "name": "Milk", "category": "grocery", "quantity": 1, "unit_price": "12.50"},
+    ]
+    receipts = [
+        (get_id(), "2025-03-10T09:15:00Z", promo_and_milk),
+        (get_id(), "2025-03-10T09:45:00Z", promo_and_milk),
+        (get_id(), "2025-03-10T10:05:00Z",
+         [{"sku": "M", "name": "Milk", "category": "grocery", "quantity": 2, "unit_price": "15.00"}]),
+    ]
+
+    def post(tx_id, timestamp, items):
+        response = client.post("/transactions", json={
+            "transaction_id": tx_id, "shopper_id": f"shopper-{tx_id}", "store_id": store_id,
+            "timestamp": timestamp, "items": items,
+        })
+        assert response.status_code == 201
+
+    def fold():
+        with Session(engine) as session:
+            analytics.catch_up(session)
+
+    for receipt in receipts:
+        post(*receipt)
+    fold()
+    # A retried receipt has no new ledger entry, so it isn't counted twice
+    post(*receipts[0])
+    fold()
+
+    day = {"start": "2025-03-10T00:00:00Z", "end": "2025-03-11T00:00:00Z"}
+    hours = client.get(f"/analytics/stores/{store_id}/hourly", params=day).json()["hours"]
+    assert hours == [
+        {"hour": "2025-03-10T09:00:00", "transactions": 2, "basket_total": "45.00",
+         "stickers_awarded": 8, "promo_units": 4},
+        {"hour": "2025-03-10T10:00:00", "transactions": 1, "basket_total": "30.00",
+         "stickers_awarded": 3, "promo_units": 0},
+    ]
+
+    categories = client.get("/analytics/categories", params={**day, "store_id": store_id}).json()["categories"]
+    assert categories == [
+        {"category": "grocery", "units": 4, "sales": "55.00", "lines": 3},
+        {"category": "promo", "units": 4, "sales": "20.00", "lines": 2},
+    ]
+    assert client.get("/analytics/categories", params={"start": day["end"], "end": day["start"]}).status_code == 400
+
+    # Exports stream item detail to Parquet, money in integer cents
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "items.parquet")
+    with Session(engine) as session:
+        analytics.export(session, "items", path, start=datetime(2025, 3, 10), end=datetime(2025, 3, 11), chunk_size=2)
+    rows = [row for row in pq.read_table(path).to_pylist() if row["store_id"] == store_id]
+    assert sorted(row["unit_price_cents"] * row["quantity"] for row in rows) == [1000, 1000, 1250, 1250, 3000]
+
+def test_rollups_wait_for_slow_writers_instead_of_skipping_them():
+    store_id = f"store-{get_id()}"
+    shopper_id = f"rollup-{get_id()}"
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO shopper VALUES (:s, 0)"), {"s": shopper_id})
+
+    def post(connection):
+        params = {"t": get_id(), "s": store_id, "shopper": shopper_id}
+        connection.execute(text(
+            'INSERT INTO "transaction" (transaction_id, shopper_id, store_id, "timestamp", basket_total, '
+            "stickers_awarded) VALUES (:t, :shopper, :s, '2025-04-01 09:00', 10, 1)"
+        ), params)
+        connection.execute(text(
+            "INSERT INTO ledgerentry (shopper_id, kind, source_id, delta, source_timestamp, created_at) "
+            "VALUES (:shopper, 'earn', :t, 1, '2025-04-01 09:00', timezone('utc', now()) - interval '1 hour')"
+        ), params)
+
+    def transactions():
+        with Session(engine) as session:
+            analytics.catch_up(session)
+            return session.exec(text("SELECT transactions FROM storehourrollup WHERE store_id = :s"),
+                                params={"s": store_id}).scalar_one_or_none()
+
+    # A slow writer takes the lower id, and an old created_at, while a later one commits
+    slow = engine.connect()
+    slow_tx = slow.begin()
+    post(slow)
+    with engine.begin() as connection:
+        post(connection)
+    try:
+        assert transactions() is None
+    finally:
+        slow_tx.commit()
+        slow.close()
+    assert transactions() == 2
+
+# -----------------------------------------------------------------------------
+# 21. REWARD CATALOG TESTS
+# -----------------------------------------------------------------------------
+def test_reward_catalog_versions_etag_and_limited_stock():
+    menu = client.get("/rewards")
+    assert menu.json()["MUG"] == 10
+    etag = menu.headers["etag"]
+    assert client.get("/rewards", headers={"If-None-Match": etag}).status_code == 304
+
+    # An edit from any process bumps the version; workers reload on their next check
+    code = f"LIMITED-{get_id()}"
+    with engine.begin() as connection:
+        rewards.set_reward(connection, code, cost=5, stock=3)
+    reward_catalog.refresh(engine)
+    menu = client.get("/rewards", headers={"If-None-Match": etag})
+    assert menu.status_code == 200 and menu.json()[code] == 5
+    assert menu.headers["etag"] != etag
+
+    # 8 shoppers who can all afford it race for 3 units: exactly 3 win
+    shoppers = [f"shopper-{get_id()}" for _ in range(8)]
+    for shopper_id in shoppers:
+        client.post("/transactions", json={
+            "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+            "timestamp": "2025-01-01T10:00:00Z",
+            "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 50.00}]
+        })
+
+    def redeem(shopper_id):
+        return client.post("/redemptions", json={
+            "redemption_id": get_id(), "shopper_id": shopper_id, "reward_code": code
+        }).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(redeem, shoppers))
+    assert sorted(statuses) == [201] * 3 + [409] * 5
+    with Session(engine) as session:
+        assert session.exec(text("SELECT stock FROM reward WHERE code = :c"), params={"c": code}).scalar_one() == 0
+    # Losers keep their stickers
+    balances = [client.get(f"/shoppers/{s}", params={"balance_only": True}).json()["sticker_balance"] for s in shoppers]
+    assert sorted(balances) == [0] * 3 + [5] * 5
+
+    # Unlimited -> 1 unit, before this worker reloads: the table still decides
+    with engine.begin() as connection:
+        rewards.set_reward(connection, code, cost=5, stock=None)
+    reward_catalog.refresh(engine)
+    with engine.begin() as connection:
+        rewards.set_reward(connection, code, cost=5, stock=1)
+    assert not reward_catalog.active.options[code].limited
+    losers = [s for s, b in zip(shoppers, balances) if b == 5]
+    assert [redeem(s) for s in losers[:2]] == [201, 409]
+    with engine.begin() as connection:
+        rewards.set_reward(connection, code, cost=5, stock=0, active=False)
+
+# -----------------------------------------------------------------------------
+# 22. BENCHMARK SUITE TESTS
+# -----------------------------------------------------------------------------
+def test_benchmark_workload_is_reproducible_and_compare_flags_regressions(tmp_path):
+    def stream(run_id):
+        workload = Workload(seed=7, run_id=run_id, shoppers=50)
+        return workload.with_retries(workload.transaction, 300, retry_rate=0.3)
+
+    first, second = stream("a"), stream("b")
+    # Same seed, same bodies; only the run prefix in the ids differs
+    assert json.dumps(first).replace("bench-a-", "") == json.dumps(second).replace("bench-b-", "")
+    # Retries resend earlier bodies unchanged, and every body is a valid request
+    assert len({body["transaction_id"] for body in first}) < len(first)
+    assert all(TransactionCreate.model_validate(body).items for body in first)
+
+    def result_file(name, us_per_call, rps):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps({
+            "meta": {"commit": name},
+            "micro": [{"case": "calculate_stickers, 10 lines", "us_per_call": us_per_call}],
+            "load": [{"endpoint": "POST /transactions", "concurrency": 16, "throughput_rps": rps, "p99_ms": 50.0}],
+        }))
+        return str(path)
+
+    base = result_file("base", 1.0, 100.0)
+    assert suite.main(["compare", base, result_file("faster", 0.9, 120.0)]) == 0
+    assert suite.main(["compare", base, result_file("slower", 1.0, 80.0)]) == 1
+
+# -----------------------------------------------------------------------------
+# 23. HOT SHOPPER TESTS
+# -----------------------------------------------------------------------------
+def test_contended_shopper_is_sharded_and_balance_stays_exact(monkeypatch):
+    shopper_id = f"shopper-{get_id()}"
+
+    def earn():
+        r = client.post("/transactions", json={
+            "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+            "timestamp": "2025-01-01T10:00:00Z",
+            "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": 50.00}],
+        })
+        assert r.status_code == 201
+        return r.json()["shopper_sticker_balance"]
+
+    def redeem(code):
+        return client.post("/redemptions", json={
+            "redemption_id": get_id(), "shopper_id": shopper_id, "reward_code": code,
+        })
+
+    def shard_balances():
+        with Session(engine) as session:
+            return session.exec(text(
+                "SELECT balance FROM balanceshard WHERE shopper_id = :s ORDER BY shard"
+            ), params={"s": shopper_id}).scalars().all()
+
+    # Every credit counts as contended: two of them queue the shopper for promotion
+    monkeypatch.setattr(hot_shoppers, "SHARDS", 4)
+    monkeypatch.setattr(hot_shoppers, "detector", hot_shoppers.ContentionDetector(True, 0.0, 2, 60))
+    assert [earn(), earn()] == [5, 10]
+    assert hot_shoppers.promote_pending(engine, hot_shoppers.detector.take_pending()) == [shopper_id]
+    assert hot_shoppers.directory.shards[shopper_id] == 4
+    assert shard_balances() == [3, 3, 2, 2]
+
+    # Earns land on random shards; every response and read sees the total
+    assert [earn() for _ in range(8)] == list(range(15, 55, 5))
+    assert sum(shard_balances()) == 50
+    cache.balance_cache.delete(shopper_id)
+    assert client.get(f"/shoppers/{shopper_id}?balance_only=true").json()["sticker_balance"] == 50
+
+    # No single shard holds 50: the consolidated check spends from the total
+    r = redeem("HOODIE")
+    assert r.status_code == 201 and r.json()["shopper_sticker_balance"] == 0
+    assert shard_balances() == [0, 0, 0, 0]
+
+    # A shard that covers the cost is used on its own
+    assert earn() == 5
+    assert redeem("STICKER_PACK").json()["shopper_sticker_balance"] == 0
+    assert redeem("STICKER_PACK").status_code == 400
+
+    # The ledger agrees with base row + shards; demoting folds them back
+    with Session(engine) as session:
+        assert ledger.rebuild_balances(session, shopper_prefix=shopper_id) == 0
+    with engine.begin() as connection:
+        assert hot_shoppers.demote(connection, shopper_id)
+    hot_shoppers.directory.refresh(engine)
+    assert shopper_id not in hot_shoppers.directory.shards
+    assert shard_balances() == []
+    assert earn() == 5
+
+# -----------------------------------------------------------------------------
+# 24. FILE IMPORT / EXPORT TESTS
+# -----------------------------------------------------------------------------
+def test_import_files_stream_through_sticker_logic_and_export_round_trips():
+    shopper_id = f"shopper-{get_id()}"
+    receipts = [{
+        "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1",
+        "timestamp": f"2025-01-0{n + 1}T10:00:00Z",
+        "items": [
+            {"sku": "A", "name": "A", "category": "grocery", "quantity": n + 1, "unit_price": "10.00"},
+            {"sku": "P", "name": "Toy", "category": "promo", "quantity": 1, "unit_price": "5.00"},
+        ],
+    } for n in range(5)]
+    changed = {**receipts[0], "store_id": "store-2"}
+    bad_quantity = {**receipts[1], "transaction_id": get_id(), "items": [{**receipts[1]["items"][0], "quantity": -1}]}
+    lines = [json.dumps(r) for r in receipts] + ["", "{not json", json.dumps(bad_quantity), json.dumps(changed)]
+    body = "\n".join(lines).encode()
+
+    r = client.post("/transactions/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    summary, *rejected = [json.loads(line) for line in r.text.splitlines()]
+    expected_stickers = sum(calculate_stickers(
+        sum(Decimal(i["unit_price"]) * i["quantity"] for i in rc["items"]),
+        [ItemCreate(**i) for i in rc["items"]],
+    ) for rc in receipts)
+    assert summary == {"records": 8, "accepted": 5, "rejected": 3, "stickers_awarded": expected_stickers}
+    assert [row["line"] for row in rejected] == [7, 8, 9]
+    assert "items.0.quantity" in rejected[1]["errors"][0]
+    assert "line 1" in rejected[2]["errors"][0]
+    assert client.get(f"/shoppers/{shopper_id}?balance_only=true").json()["sticker_balance"] == expected_stickers
+
+    # Sending the file again applies nothing twice
+    again = client.post("/transactions/import", content=body).text.splitlines()
+    assert json.loads(again[0])["accepted"] == 5
+    assert client.get(f"/shoppers/{shopper_id}?balance_only=true").json()["sticker_balance"] == expected_stickers
+
+    # Export: receipts in time order with their items, importable as they are
+    exported = client.get("/transactions/export", params={"shopper_id": shopper_id})
+    assert exported.headers["content-type"] == "application/x-ndjson"
+    records = [TransactionCreate.model_validate_json(line) for line in exported.text.splitlines()]
+    assert [tx.transaction_id for tx in records] == [rc["transaction_id"] for rc in receipts]
+    assert [len(tx.items) for tx in records] == [2] * 5
+    assert records[2].items[0].quantity == 3 and records[2].items[0].unit_price == Decimal("10.00")
+
+    # CSV: one row per item line; rows of one receipt are grouped back together
+    csv_export = client.get("/transactions/export", params={
+        "start": "2025-01-01T00:00:00Z", "end": "2025-01-03T00:00:00Z", "shopper_id": shopper_id, "format": "csv",
+    }).text.splitlines()
+    assert csv_export[0].startswith("transaction_id,shopper_id,store_id,timestamp,sku")
+    assert len(csv_export) == 1 + 4
+    other, new_ids = f"shopper-{get_id()}", [get_id(), get_id()]
+    csv_body = "\n".join([csv_export[0]] + [
+        line.replace(shopper_id, other).replace(receipts[0]["transaction_id"], new_ids[0])
+        .replace(receipts[1]["transaction_id"], new_ids[1]) for line in csv_export[1:]
+    ])
+    summary = json.loads(client.post("/transactions/import?format=csv", content=csv_body).text.splitlines()[0])
+    assert summary["records"] == 2 and summary["accepted"] == 2
+    assert client.get(f"/shoppers/{other}?balance_only=true").json()["sticker_balance"] == sum(
+        json.loads(line)["stickers_awarded"] for line in exported.text.splitlines()[:2]
+    )
+
+    # Redemptions export, and the filters the export needs
+    assert client.post("/redemptions", json={
+        "redemption_id": get_id(), "shopper_id": shopper_id, "reward_code": "STICKER_PACK",
+    }).status_code == 201
+    redemptions = client.get("/redemptions/export", params={"shopper_id": shopper_id}).text.splitlines()
+    assert [json.loads(line)["reward_code"] for line in redemptions] == ["STICKER_PACK"]
+    assert client.get("/transactions/export").status_code == 400
+    assert client.post("/transactions/import?format=csv", content=b"id,shopper\n1,2\n").status_code == 400
+
+def test_import_creates_partitions_only_for_months_it_contains():
+    shopper_id = f"shopper-{get_id()}"
+    lines = [{
+        "transaction_id": get_id(), "shopper_id": shopper_id, "store_id": "store-1", "timestamp": timestamp,
+        "items": [{"sku": "A", "name": "A", "category": "grocery", "quantity": 1, "unit_price": "10.00"}],
+    } for timestamp in ("0001-01-01T00:00:00Z", "2019-05-20T10:00:00Z")]
+    body = "\n".join(json.dumps(line) for line in lines)
+    summary = json.loads(client.post("/transactions/import", content=body).text.splitlines()[0])
+    assert summary["accepted"] == 2
+
+    with Session(engine) as session:
+        def where(tx_id):
+            return session.exec(text(
+                "SELECT tableoid::regclass::text FROM transaction WHERE transaction_id = :id"
+            ), params={"id": tx_id}).scalar_one()
+        assert where(lines[0]["transaction_id"]) == "transaction_default"
+        assert where(lines[1]["transaction_id"]) == "transaction_p2019_05"
+        assert session.exec(text(
+            "SELECT count(*) FROM pg_class WHERE relname IN ('transaction_p0001_01', 'transaction_p2019_06')"
+        )).scalar_one() == 0
+
+# -----------------------------------------------------------------------------
+# 25. STARTUP & MIGRATION TESTS
+# -----------------------------------------------------------------------------
+def test_migrations_are_versioned_and_workers_start_without_database_work():
+    # The fixture already upgraded: nothing pending, and the startup check passes
+    assert migrations.upgrade(engine) == []
+    assert migrations.check(engine) == migrations.LATEST
+    with pytest.raises(migrations.SchemaOutOfDateError):
+        migrations.check(engine, latest=migrations.LATEST + 1)
+
+    # A new migration is applied exactly once
+    calls = []
+    extra = migrations.MIGRATIONS + [migrations.Migration(migrations.LATEST + 1, "probe", calls.append)]
+    try:
+        assert migrations.upgrade(engine, extra) == [f"{migrations.LATEST + 1} probe"]
+        assert migrations.upgrade(engine, extra) == []
+        assert len(calls) == 1
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM schemamigration WHERE version > :v"), {"v": migrations.LATEST})
+
+    # Migrations run without the serving statement timeout (serve.py sets one first)
+    from sqlmodel import create_engine
+    timed = create_engine(str(engine.url.render_as_string(hide_password=False)),
+                          connect_args={"options": "-c statement_timeout=50"})
+    slow = migrations.MIGRATIONS + [migrations.Migration(
+        migrations.LATEST + 1, "slow", lambda connection: connection.execute(text("SELECT pg_sleep(0.2)"))
+    )]
+    try:
+        assert migrations.upgrade(timed, slow) == [f"{migrations.LATEST + 1} slow"]
+    finally:
+        timed.dispose()
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM schemamigration WHERE version > :v"), {"v": migrations.LATEST})
+
+    # Importing the app builds no engine and loads no database driver
+    probe = subprocess.run([sys.executable, "-c", (
+        "import sys, main, database; "
+        "print(database.get_engine.cache_info().currsize, database.get_async_engine.cache_info().currsize, "
+        "'asyncpg' in sys.modules, 'psycopg2' in sys.modules)"
+    )], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert probe.stdout.split() == ["0", "0", "False", "False"]
+
+    assert client.get("/healthz").json() == {"status": "ok"}
+
+
+def test_migrations_build_the_models_and_convert_legacy_receipt_tables():
+    from sqlalchemy import inspect as sa_inspect
+    from sqlmodel import SQLModel, create_engine
+
+    def schema_engine(schema):
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE SCHEMA "{schema}"'))
+        return create_engine(str(engine.url.render_as_string(hide_password=False)),
+                             connect_args={"options": f"-c search_path={schema}"})
+
+    def columns(bind, schema):
+        inspector = sa_inspect(bind)
+        return {t: sorted(c["name"] for c in inspector.get_columns(t, schema=schema))
+                for t in SQLModel.metadata.tables}
+
+    fresh, legacy = f"fresh_{uuid.uuid4().hex[:8]}", f"legacy_{uuid.uuid4().hex[:8]}"
+    fresh_engine, legacy_engine = schema_engine(fresh), schema_engine(legacy)
+    try:
+        # An empty database ends up with exactly the tables and indexes the models declare
+        assert len(migrations.upgrade(fresh_engine)) == migrations.LATEST
+        assert columns(fresh_engine, fresh) == {
+            name: sorted(c.name for c in table.columns) for name, table in SQLModel.metadata.tables.items()
+        }
+        with fresh_engine.connect() as connection:
+            indexes = set(connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = :s"), {"s": fresh}
+            ).scalars())
+        assert {i.name for t in SQLModel.metadata.tables.values() for i in t.indexes} <= indexes
+
+        # The layout the app started with: string item columns, no partitions
+        with legacy_engine.begin() as connection:
+            for sql in [
+                "CREATE TABLE shopper (shopper_id VARCHAR PRIMARY KEY, sticker_balance INTEGER NOT NULL)",
+                'CREATE TABLE "transaction" (transaction_id VARCHAR PRIMARY KEY, '
+                "shopper_id VARCHAR NOT NULL REFERENCES shopper, store_id VARCHAR NOT NULL, "
+                '"timestamp" TIMESTAMP NOT NULL, basket_total NUMERIC(10, 2) NOT NULL, stickers_awarded INTEGER NOT NULL)',
+                'CREATE INDEX ix_transaction_shopper_id ON "transaction" (shopper_id)',
+                'CREATE TABLE item (id SERIAL PRIMARY KEY, transaction_id VARCHAR NOT NULL REFERENCES "transaction", '
+                "sku VARCHAR NOT NULL, name VARCHAR NOT NULL, category VARCHAR NOT NULL, "
+                "quantity INTEGER NOT NULL, unit_price NUMERIC(10, 2) NOT NULL)",
+                "INSERT INTO shopper VALUES ('legacy-shopper', 3)",
+                "INSERT INTO \"transaction\" VALUES ('legacy-tx', 'legacy-shopper', 'store-1', '2019-05-04', 30, 3)",
+                "INSERT INTO item (transaction_id, sku, name, category, quantity, unit_price) "
+                "VALUES ('legacy-tx', 'A', 'Milk', 'grocery', 2, 15.00)",
+            ]:
+                connection.execute(text(sql))
+
+        assert migrations.upgrade(legacy_engine) == [f"{m.version} {m.name}" for m in migrations.MIGRATIONS]
+        assert columns(legacy_engine, legacy) == columns(fresh_engine, fresh)
+        with legacy_engine.connect() as connection:
+            assert partitions._is_partitioned(connection, "transaction")
+            assert partitions._is_partitioned(connection, "item")
+            assert connection.execute(text(
+                "SELECT i.unit_price_cents, s.code, c.name, t.shopper_id FROM item_p2019_05 i "
+                "JOIN sku s ON s.id = i.sku_id JOIN category c ON c.id = i.category_id "
+                'JOIN transaction_p2019_05 t USING (transaction_id)'
+            )).one() == (1500, "A", "grocery", "legacy-shopper")
+            indexes = set(connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = :s"), {"s": legacy}
+            ).scalars())
+            assert "ix_transaction_shopper_history" in indexes and "ix_transaction_shopper_id" not in indexes
+            assert connection.execute(text("SELECT count(*) FROM item_legacy")).scalar() == 1
+    finally:
+        fresh_engine.dispose()
+        legacy_engine.dispose()
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP SCHEMA "{fresh}", "{legacy}" CASCADE'))
@@ -0,0 +1,421 @@
+"""
+Bulk import and export of receipts as NDJSON or CSV files.
+
+Usage:
+    python transfer.py import history.ndjson --rejects rejected.ndjson
+    python transfer.py import history.csv.gz --format csv --chunk-size 2000
+    python transfer.py export --shopper-id shopper-42 --output shopper-42.ndjson
+    python transfer.py export --start 2025-01-01 --end 2025-02-01 --format csv --output january.csv
+    python transfer.py export --kind redemptions --start 2025-01-01 --end 2025-02-01 --output -
+
+Import formats (the export writes the same, so an export can be imported elsewhere):
+- NDJSON: one TransactionCreate per line, exactly like the POST /transactions body.
+- CSV: one row per item line, with the header
+      transaction_id,shopper_id,store_id,timestamp,sku,name,category,quantity,unit_price
+  Consecutive rows with the same transaction_id form one receipt. A row with
+  an empty sku is a receipt without items.
+
+Rejected records go to the rejects file as NDJSON:
+{"line", "transaction_id", "errors", "record"}. Fix them and import that file again.
+Re-importing a file is safe: receipts already applied are recognised as retries.
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import gzip
+import io
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import orjson
+from pydantic import ValidationError
+from sqlalchemy import and_, select
+from sqlmodel import Session
+
+import idempotency
+import partitions
+import serialization
+from catalog import from_cents
+from database import get_engine
+from idempotency import IdempotencyConflictError
+from ingest import ingest_transactions
+from models import Category, Item, Redemption, Sku, Transaction
+from schemas import TransactionCreate
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv")
+EXPORT_KINDS = ("transactions", "redemptions")
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_SIZE = 5000
+READ_BYTES = 1 << 16
+# Imports create monthly partitions for at most this far back; older
+# receipts are still accepted and go to the default partition.
+IMPORT_PARTITION_YEARS = int(os.getenv("IMPORT_PARTITION_YEARS", "10"))
+
+RECEIPT_COLUMNS = ["transaction_id", "shopper_id", "store_id", "timestamp"]
+ITEM_COLUMNS = ["sku", "name", "category", "quantity", "unit_price"]
+CSV_COLUMNS = RECEIPT_COLUMNS + ITEM_COLUMNS
+REDEMPTION_COLUMNS = ["redemption_id", "shopper_id", "reward_code", "stickers_spent", "timestamp"]
+
+
+class TransferFormatError(ValueError):
+    """The file can't be read at all (e.g. a CSV header without the required columns)."""
+
+
+# -----------------------------------------------------------------------------
+# A. Reading records from a byte stream
+# -----------------------------------------------------------------------------
+def read_chunks(f: BinaryIO) -> Iterator[bytes]:
+    return iter(lambda: f.read(READ_BYTES), b"")
+
+
+def blocking_chunks(stream: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop) -> Iterator[bytes]:
+    """
+    Lets an import running in a worker thread pull an async byte stream (a
+    request body) from the event loop, one chunk at a time.
+    """
+    iterator = stream.__aiter__()
+
+    async def next_chunk():
+        try:
+            return await iterator.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(next_chunk(), loop).result()
+        if chunk is None:
+            return
+        if chunk:
+            yield chunk
+
+
+def _lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Complete lines (newline included) from arbitrarily split byte chunks."""
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if rest:
+        yield rest
+
+
+def _ndjson_records(chunks: Iterable[bytes]) -> Iterator[Tuple[int, bytes]]:
+    for number, line in enumerate(_lines(chunks), 1):
+        line = line.strip()
+        if line:
+            yield number, line
+
+
+def _csv_records(chunks: Iterable[bytes]) -> Iterator[Tuple[int, List[dict]]]:
+    """(first line number, rows) per receipt: consecutive rows sharing a transaction_id."""
+    reader = csv.DictReader(codecs.iterdecode(_lines(chunks), "utf-8-sig"))
+    missing = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise TransferFormatError(f"CSV header is missing {', '.join(missing)}")
+    rows: List[dict] = []
+    first_line = 0
+    for row in reader:
+        if rows and row["transaction_id"] != rows[0]["transaction_id"]:
+            yield first_line, rows
+            rows = []
+        if not rows:
+            first_line = reader.line_num
+        rows.append(row)
+    if rows:
+        yield first_line, rows
+
+
+def _csv_receipt(rows: List[dict]) -> dict:
+    for column in RECEIPT_COLUMNS[1:]:
+        if any(row[column] != rows[0][column] for row in rows):
+            raise ValueError(f"rows of one transaction disagree on {column}")
+    receipt = {column: rows[0][column] for column in RECEIPT_COLUMNS}
+    receipt["items"] = [{column: row[column] for column in ITEM_COLUMNS} for row in rows if row["sku"]]
+    return receipt
+
+
+def _errors(error: ValidationError) -> List[str]:
+    return [f"{'.'.join(str(part) for part in e['loc']) or 'record'}: {e['msg']}" for e in error.errors()]
+
+
+# -----------------------------------------------------------------------------
+# B. Import: validate in chunks, write each chunk like POST /transactions/batch
+# -----------------------------------------------------------------------------
+def import_transactions(chunks: Iterable[bytes], fmt: str, rejects: BinaryIO,
+                        chunk_size: int = IMPORT_CHUNK_SIZE,
+                        progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+    """
+    Imports receipts from a stream of byte chunks (a file or a request body).
+    Invalid ones are written to `rejects`; the rest are applied. Returns the
+    counts: records read, accepted (new or already imported), rejected, and
+    the stickers awarded to the accepted ones.
+
+    Key Decisions:
+    - Memory is flat: records are parsed one line (CSV: one receipt) at a
+      time, and only the current chunk of validated receipts is held.
+    - Each chunk goes through ingest.ingest_transactions, the same code as
+      POST /transactions/batch: stickers come from services.calculate_stickers,
+      balances and the ledger are updated set-based, and a chunk commits
+      as a whole. A crash loses at most the chunk in flight, and a re-run
+      skips what was already applied (idempotent by transaction_id).
+    - A transaction_id that reappears with a different payload is rejected,
+      whether the first copy is earlier in the chunk or already in the
+      database. The rest of its chunk still goes in.
+    - Old receipts get their monthly partitions before the first chunk that
+      needs them, instead of piling up in the default partition. Only months
+      the file contains are created, and only within IMPORT_PARTITION_YEARS
+      of today: a stray "0001-01-01" lands in the default partition instead
+      of costing thousands of CREATE TABLEs on the request path.
+    """
+    report = {"records": 0, "accepted": 0, "rejected": 0, "stickers_awarded": 0}
+    batch: List[Tuple[int, TransactionCreate]] = []
+    hashes: Dict[str, Tuple[int, str]] = {}
+    partitioned: set = set()
+    oldest = partitions.add_months(partitions.month_start(datetime.utcnow().date()), -12 * IMPORT_PARTITION_YEARS)
+
+    def reject(line: int, errors: List[str], record, transaction_id: Optional[str] = None):
+        report["rejected"] += 1
+        rejects.write(orjson.dumps({
+            "line": line, "transaction_id": transaction_id, "errors": errors, "record": record,
+        }) + b"\n")
+
+    def flush():
+        if not batch:
+            return
+        months = {partitions.month_start(tx.timestamp.date()) for _, tx in batch} - partitioned
+        # Months ahead of the maintained window are left to the default partition too
+        newest = partitions.add_months(partitions.month_start(datetime.utcnow().date()), partitions.MONTHS_AHEAD)
+        wanted = {month for month in months if oldest <= month <= newest}
+        if wanted:
+            with get_engine().begin() as connection:
+                partitions.ensure_months(connection, wanted)
+        partitioned.update(months)
+
+        pending = list(batch)
+        with Session(get_engine()) as session:
+            while pending:
+                try:
+                    responses = ingest_transactions(session, [tx for _, tx in pending])
+                except IdempotencyConflictError as e:
+                    session.rollback()
+                    conflicts = set(e.keys)
+                    for line, tx in pending:
+                        if tx.transaction_id in conflicts:
+                            reject(line, ["transaction_id was already imported with a different payload"],
+                                   orjson.loads(tx.model_dump_json()), tx.transaction_id)
+                    pending = [(line, tx) for line, tx in pending if tx.transaction_id not in conflicts]
+                    continue
+                report["accepted"] += len(responses)
+                report["stickers_awarded"] += sum(response.stickers_awarded for response in responses)
+                break
+        batch.clear()
+        hashes.clear()
+        if progress:
+            progress(report)
+
+    if fmt == "ndjson":
+        records = _ndjson_records(chunks)
+        validate = TransactionCreate.model_validate_json
+    else:
+        records = _csv_records(chunks)
+        validate = lambda rows: TransactionCreate.model_validate(_csv_receipt(rows))
+
+    for line, raw in records:
+        report["records"] += 1
+        try:
+            tx = validate(raw)
+        except (ValidationError, ValueError) as e:
+            errors = _errors(e) if isinstance(e, ValidationError) else [str(e)]
+            reject(line, errors, raw.decode("utf-8", "replace") if isinstance(raw, bytes) else raw)
+            continue
+
+        payload_hash = idempotency.request_hash(tx)
+        earlier = hashes.get(tx.transaction_id)
+        if earlier is not None and earlier[1] != payload_hash:
+            reject(line, [f"transaction_id was used on line {earlier[0]} with a different payload"],
+                   raw.decode("utf-8", "replace") if isinstance(raw, bytes) else raw, tx.transaction_id)
+            continue
+        hashes.setdefault(tx.transaction_id, (line, payload_hash))
+        batch.append((line, tx))
+        if len(batch) >= chunk_size:
+            flush()
+    flush()
+    return report
+
+
+# -----------------------------------------------------------------------------
+# C. Export: server-side cursor, one block of lines per fetched chunk
+# -----------------------------------------------------------------------------
+def _export_query(kind: str, shopper_id: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    if kind == "transactions":
+        # One row per item line (or per receipt without items), already in
+        # receipt order, so receipts can be put back together while streaming
+        query = (
+            select(
+                Transaction.transaction_id, Transaction.shopper_id, Transaction.store_id, Transaction.timestamp,
+                Transaction.basket_total, Transaction.stickers_awarded,
+                Sku.code.label("sku"), Sku.name, Category.name.label("category"),
+                Item.quantity, Item.unit_price_cents,
+            )
+            .select_from(Transaction)
+            .outerjoin(Item, and_(Item.transaction_id == Transaction.transaction_id,
+                                  Item.timestamp == Transaction.timestamp))
+            .outerjoin(Sku, Sku.id == Item.sku_id)
+            .outerjoin(Category, Category.id == Item.category_id)
+            .order_by(Transaction.timestamp, Transaction.transaction_id, Item.id)
+        )
+        model = Transaction
+    else:
+        query = select(*(getattr(Redemption, column) for column in REDEMPTION_COLUMNS)).order_by(
+            Redemption.timestamp, Redemption.redemption_id
+        )
+        model = Redemption
+    if shopper_id is not None:
+        query = query.where(model.shopper_id == shopper_id)
+    if start is not None:
+        query = query.where(model.timestamp >= start)
+    if end is not None:
+        query = query.where(model.timestamp < end)
+    return query
+
+
+def _receipts(rows) -> Iterator[dict]:
+    """Groups the export's item rows back into receipts (items nested, like the API)."""
+    receipt = None
+    for row in rows:
+        if receipt is None or receipt["transaction_id"] != row.transaction_id:
+            if receipt is not None:
+                yield receipt
+            receipt = {
+                "transaction_id": row.transaction_id,
+                "shopper_id": row.shopper_id,
+                "store_id": row.store_id,
+                "timestamp": row.timestamp,
+                "basket_total": row.basket_total,
+                "stickers_awarded": row.stickers_awarded,
+                "items": [],
+            }
+        if row.sku is not None:
+            receipt["items"].append({
+                "sku": row.sku,
+                "name": row.name,
+                "category": row.category,
+                "quantity": row.quantity,
+                "unit_price": from_cents(row.unit_price_cents),
+            })
+    if receipt is not None:
+        yield receipt
+
+
+def export_blocks(connection, kind: str, fmt: str, shopper_id: Optional[str] = None,
+                  start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    A shopper's or a time range's receipts (with their items) or redemptions,
+    as NDJSON or CSV. Yields one block of encoded lines per fetched chunk.
+
+    Key Decisions:
+    - Rows come through a server-side cursor (stream_results) as plain
+      tuples, never ORM objects, so memory is bounded by chunk_size.
+    - Receipts and their items come from one ordered join. Only the receipt
+      being assembled is held between chunks.
+    - A shopper's receipts are read in index order (ix_transaction_shopper_history),
+      and a time range only scans the months it covers.
+    """
+    result = connection.execute(
+        _export_query(kind, shopper_id, start, end).execution_options(stream_results=True, yield_per=chunk_size)
+    )
+    rows = (row for partition in result.partitions() for row in partition)
+
+    if fmt == "csv":
+        columns = CSV_COLUMNS + ["basket_total", "stickers_awarded"] if kind == "transactions" else REDEMPTION_COLUMNS
+        yield (",".join(columns) + "\r\n").encode()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for block in _blocks(rows, chunk_size):
+            for row in block:
+                if kind == "transactions":
+                    unit_price = from_cents(row.unit_price_cents) if row.sku is not None else None
+                    writer.writerow([
+                        row.transaction_id, row.shopper_id, row.store_id, row.timestamp.isoformat(),
+                        row.sku, row.name, row.category, row.quantity, unit_price,
+                        row.basket_total, row.stickers_awarded,
+                    ])
+                else:
+                    writer.writerow([*row[:-1], row.timestamp.isoformat()])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        return
+
+    records = _receipts(rows) if kind == "transactions" else (row._asdict() for row in rows)
+    for block in _blocks(records, chunk_size):
+        yield b"".join(serialization.dumps(record) + b"\n" for record in block)
+
+
+def _blocks(iterable, size: int) -> Iterator[list]:
+    block = []
+    for value in iterable:
+        block.append(value)
+        if len(block) >= size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", nargs="?", help="import: file to read (.gz is decompressed, - for stdin)")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file name, else ndjson")
+    parser.add_argument("--chunk-size", type=int, help="receipts per DB transaction (import) or rows per fetch (export)")
+    parser.add_argument("--rejects", default="rejected.ndjson", help="import: where rejected records go")
+    parser.add_argument("--kind", choices=EXPORT_KINDS, default="transactions", help="export: what to export")
+    parser.add_argument("--shopper-id", help="export: only this shopper")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="export: from this time (UTC, inclusive)")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="export: up to this time (UTC, exclusive)")
+    parser.add_argument("--output", default="-", help="export: file to write (- for stdout)")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        if not args.path:
+            parser.error("import needs a file")
+        fmt = args.format or ("csv" if ".csv" in args.path else "ndjson")
+        if args.path == "-":
+            source = sys.stdin.buffer
+        elif args.path.endswith(".gz"):
+            source = gzip.open(args.path, "rb")
+        else:
+            source = open(args.path, "rb")
+        with source, open(args.rejects, "wb") as rejects:
+            report = import_transactions(
+                read_chunks(source), fmt, rejects, args.chunk_size or IMPORT_CHUNK_SIZE,
+                progress=lambda r: print(f"   {r['records']} read, {r['accepted']} accepted, "
+                                         f"{r['rejected']} rejected", file=sys.stderr),
+            )
+        print(f"{report['accepted']} receipts accepted ({report['stickers_awarded']} stickers), "
+              f"{report['rejected']} rejected -> {args.rejects}")
+        return
+
+    if args.shopper_id is None and (args.start is None or args.end is None):
+        parser.error("export needs --shopper-id or both --start and --end")
+    fmt = args.format or ("csv" if args.output.endswith(".csv") else "ndjson")
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    with get_engine().connect() as connection, output:
+        for block in export_blocks(connection, args.kind, fmt, args.shopper_id, args.start, args.end,
+                                   args.chunk_size or EXPORT_CHUNK_SIZE):
+            output.write(block)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()